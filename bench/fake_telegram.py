@@ -0,0 +1,191 @@
+import asyncio
+import itertools
+import json
+import time
+import types
+from collections import Counter
+from typing import Any, List, Optional, Tuple
+
+import aiohttp
+from aiohttp import web
+
+# Just enough of telegram.Update / Message / CallbackQuery for the handlers in
+# telegram_bot.py: every reply is recorded instead of going to the Bot API.
+
+_file_ids = itertools.count(1)
+
+
+class FakePhoto:
+    def __init__(self) -> None:
+        self.file_id = f"bench-file-{next(_file_ids)}"
+
+
+class FakeChat:
+    def __init__(self, chat_id: int) -> None:
+        self.id = chat_id
+
+    async def send_action(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+
+class FakeMessage:
+    def __init__(self, chat_id: int = 1, text: str = "", photo: Optional[List[FakePhoto]] = None) -> None:
+        self.chat = FakeChat(chat_id)
+        self.text = text
+        self.photo = photo or []
+        self.document = None
+        self.reply_to_message = None
+        self.replies: List[str] = []
+        self.edits: List[str] = []
+        self.sent: List["FakeMessage"] = []
+        self.photos_sent = 0
+
+    async def reply_text(self, text: str, **kwargs: Any) -> "FakeMessage":
+        self.replies.append(text)
+        reply = FakeMessage(self.chat.id, text)
+        self.sent.append(reply)
+        return reply
+
+    async def reply_photo(self, photo: Any, **kwargs: Any) -> "FakeMessage":
+        self.photos_sent += 1
+        return FakeMessage(self.chat.id, photo=[FakePhoto()])
+
+    async def reply_media_group(self, media: List[Any], **kwargs: Any) -> List["FakeMessage"]:
+        self.photos_sent += len(media)
+        return [FakeMessage(self.chat.id, photo=[FakePhoto()]) for _ in media]
+
+    async def reply_document(self, document: Any, **kwargs: Any) -> "FakeMessage":
+        return FakeMessage(self.chat.id)
+
+    async def edit_text(self, text: str, **kwargs: Any) -> "FakeMessage":
+        self.edits.append(text)
+        self.text = text
+        return self
+
+
+class FakeCallbackQuery:
+    def __init__(self, data: str, chat_id: int = 1) -> None:
+        self.data = data
+        self.message = FakeMessage(chat_id)
+        self.edits: List[str] = []
+
+    async def answer(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    async def edit_message_text(self, text: str, **kwargs: Any) -> None:
+        self.edits.append(text)
+
+    async def edit_message_reply_markup(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+
+def make_update(user_id: int, message: Optional[FakeMessage] = None, query: Optional[FakeCallbackQuery] = None) -> Any:
+    return types.SimpleNamespace(
+        message=message,
+        callback_query=query,
+        effective_user=types.SimpleNamespace(id=user_id),
+        effective_chat=types.SimpleNamespace(id=user_id),
+    )
+
+
+def make_context(app: Any, args: Optional[List[str]] = None) -> Any:
+    return types.SimpleNamespace(bot_data=app.bot_data, args=args or [], application=app, bot=None)
+
+
+class FakeBotApi:
+    """A local stand-in for api.telegram.org, for driving a real Application.
+
+    Answers the Bot API methods the bot uses, serves queued updates to
+    getUpdates (long polling) and records every outgoing message in
+    ``replies``; ``post_webhook`` delivers an update the way Telegram does
+    in webhook mode. While ``flood_next`` is above zero, sendMessage calls
+    are refused with a 429 and ``retry_after`` of one second, as Telegram
+    does when a chat gets too many messages.
+    """
+
+    def __init__(self, host: str = "127.0.0.1") -> None:
+        self.host = host
+        self.port = 0
+        self.updates: "asyncio.Queue[dict]" = asyncio.Queue()
+        self.replies: "asyncio.Queue[Tuple[str, str]]" = asyncio.Queue()
+        self.calls: Counter = Counter()
+        self.flood_next = 0
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def url(self) -> str:
+        """Value for TELEGRAM_API_URL (Settings.api_url)."""
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, 0)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def _message(self, chat_id: int, text: str = "") -> dict:
+        return {"message_id": next(self._message_ids), "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "text": text}
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        params = dict(await request.post())
+        chat_id = int(params.get("chat_id") or 0)
+        if method == "sendMessage" and self.flood_next > 0:
+            self.flood_next -= 1
+            return web.json_response(
+                {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1", "parameters": {"retry_after": 1}},
+                status=429,
+            )
+        result: Any = True
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method == "getUpdates":
+            result = await self._poll(float(params.get("timeout") or 0))
+        elif method in ("sendMessage", "editMessageText", "sendPhoto", "sendDocument"):
+            text = str(params.get("text") or params.get("caption") or "")
+            self.replies.put_nowait((method, text))
+            result = self._message(chat_id, text)
+        elif method == "sendMediaGroup":
+            media = json.loads(params.get("media") or "[]")
+            self.replies.put_nowait((method, ""))
+            result = [self._message(chat_id) for _ in media]
+        return web.json_response({"ok": True, "result": result})
+
+    async def _poll(self, timeout: float) -> List[dict]:
+        try:
+            first = await asyncio.wait_for(self.updates.get(), timeout=timeout) if timeout else self.updates.get_nowait()
+        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+            return []
+        batch = [first]
+        while not self.updates.empty():
+            batch.append(self.updates.get_nowait())
+        return batch
+
+    def command_update(self, text: str, user_id: int = 1) -> dict:
+        """An update carrying a private-chat command message such as "/list"."""
+        command = text.split()[0]
+        message = self._message(user_id, text)
+        message["from"] = {"id": user_id, "is_bot": False, "first_name": "bench"}
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return {"update_id": next(self._update_ids), "message": message}
+
+    def push_update(self, update: dict) -> None:
+        """Queue an update for the next getUpdates call (polling mode)."""
+        self.updates.put_nowait(update)
+
+    async def post_webhook(self, session: "aiohttp.ClientSession", url: str, secret: str, update: dict) -> int:
+        """Deliver an update to a webhook as Telegram does; returns the HTTP status."""
+        async with session.post(url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": secret}) as resp:
+            await resp.read()
+            return resp.status
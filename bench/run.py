@@ -0,0 +1,896 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+BOT_DIR = os.path.join(REPO_DIR, "bot")
+CLI_PATH = os.path.join(BOT_DIR, "scripts", "vless")
+STUBS_DIR = os.path.join(BENCH_DIR, "stubs")
+
+sys.path.insert(0, BOT_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import aiohttp  # noqa: E402
+
+from fake_telegram import FakeBotApi, FakeCallbackQuery, FakeMessage, make_context, make_update  # noqa: E402
+from synth import client_name, write_config  # noqa: E402
+
+# External commands the CLI may run; the spawn pass puts a counting shim in
+# front of each one found on PATH (the stubs in stubs/ count themselves)
+TRACED_TOOLS = (
+    "awk", "base64", "basename", "cat", "chmod", "chown", "cp", "cut", "date", "dirname",
+    "find", "flock", "grep", "head", "id", "jq", "ls", "mkdir", "mktemp", "mv", "paste",
+    "python3", "readlink", "rm", "sed", "sha256sum", "sleep", "sort", "ss", "stat", "tail",
+    "tee", "timeout", "touch", "tr", "uniq", "uuidgen", "wc", "xargs",
+)
+
+ADMIN_ID = 1
+
+
+@dataclass
+class Workspace:
+    """A throwaway install: config, state dir and PATH with the stubs for one client count."""
+
+    root: str
+    clients: int
+    config: str
+    state_dir: str
+    output_dir: str
+    vless: str
+    env: Dict[str, str]
+
+
+def make_workspace(parent: str, clients: int, seed: int) -> Workspace:
+    root = os.path.join(parent, f"clients-{clients}")
+    bin_dir = os.path.join(root, "bin")
+    for path in (root, bin_dir):
+        os.makedirs(path, exist_ok=True)
+    config = os.path.join(root, "config.json")
+    write_config(config, clients, seed)
+    vless = os.path.join(bin_dir, "vless")
+    with open(vless, "w", encoding="utf-8") as f:
+        f.write(f'#!/bin/bash\n[[ -n "${{BENCH_SPAWN_LOG:-}}" ]] && echo vless >> "$BENCH_SPAWN_LOG"\nexec bash {CLI_PATH} "$@"\n')
+    os.chmod(vless, 0o755)
+    env = dict(os.environ)
+    env.pop("BENCH_SPAWN_LOG", None)
+    env.update(
+        PATH=os.pathsep.join([bin_dir, STUBS_DIR, os.environ.get("PATH", "")]),
+        VLESS_CONFIG=config,
+        VLESS_CONFDIR=os.path.join(root, "conf.d"),
+        VLESS_STATE_DIR=os.path.join(root, "state"),
+        VLESS_OUTPUT_DIR=os.path.join(root, "out"),
+        VLESS_READY_TIMEOUT="1",
+    )
+    return Workspace(root, clients, config, env["VLESS_STATE_DIR"], env["VLESS_OUTPUT_DIR"], vless, env)
+
+
+def counting_env(ws: Workspace, log_path: str) -> Dict[str, str]:
+    """ws.env with every traced tool routed through the counting shim."""
+    shim_dir = os.path.join(ws.root, "shims")
+    if not os.path.isdir(shim_dir):
+        os.makedirs(shim_dir)
+        for tool in TRACED_TOOLS:
+            if shutil.which(tool, path=ws.env["PATH"]) and not os.path.exists(os.path.join(STUBS_DIR, tool)):
+                os.symlink(os.path.join(STUBS_DIR, "count"), os.path.join(shim_dir, tool))
+    env = dict(ws.env)
+    env.update(
+        PATH=os.pathsep.join([shim_dir, ws.env["PATH"]]),
+        BENCH_REAL_PATH=ws.env["PATH"],
+        BENCH_SPAWN_LOG=log_path,
+    )
+    return env
+
+
+def read_spawns(log_path: str) -> Counter:
+    try:
+        with open(log_path, "r", encoding="utf-8") as f:
+            return Counter(line.strip() for line in f if line.strip())
+    except OSError:
+        return Counter()
+
+
+def percentile(samples: List[float], q: float) -> float:
+    """Nearest-rank percentile of sorted ``samples``."""
+    index = max(0, min(len(samples) - 1, int(round(q / 100 * len(samples) + 0.5)) - 1))
+    return samples[index]
+
+
+def summarize(target: str, op: str, clients: int, samples: List[float], spawns: Counter) -> dict:
+    ordered = sorted(samples)
+    return {
+        "target": target,
+        "op": op,
+        "clients": clients,
+        "runs": len(ordered),
+        "p50_ms": round(percentile(ordered, 50) * 1000, 2),
+        "p90_ms": round(percentile(ordered, 90) * 1000, 2),
+        "p99_ms": round(percentile(ordered, 99) * 1000, 2),
+        "max_ms": round(ordered[-1] * 1000, 2),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 2),
+        "spawns": sum(spawns.values()),
+        "spawns_by_command": dict(sorted(spawns.items())),
+    }
+
+
+# --- CLI ---
+
+def run_cli(ws: Workspace, args: List[str], env: Optional[Dict[str, str]] = None) -> str:
+    res = subprocess.run([ws.vless] + args, env=env or ws.env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if res.returncode != 0:
+        raise RuntimeError(f"vless {' '.join(args)} failed ({res.returncode}): {res.stderr.strip() or res.stdout.strip()}")
+    return res.stdout
+
+
+def show_key(ws: Workspace, i: int) -> str:
+    # Spread lookups over the whole client list instead of hitting the first entries
+    return client_name((i * 7919) % ws.clients)
+
+
+def bench_cli(ws: Workspace, iterations: int, log) -> List[dict]:
+    ops: Dict[str, Callable[[int], List[str]]] = {
+        "list": lambda i: ["list"],
+        "show": lambda i: ["show", show_key(ws, i)],
+        "add": lambda i: ["add", f"bench_new_{i}"],
+        "del": lambda i: ["del", f"bench_new_{i}"],
+    }
+    results = []
+    for op, make_args in ops.items():
+        if op in ("list", "show"):
+            run_cli(ws, make_args(0))  # warm-up
+        samples = []
+        for i in range(iterations):
+            args = make_args(i)
+            start = time.perf_counter()
+            run_cli(ws, args)
+            samples.append(time.perf_counter() - start)
+        spawn_log = os.path.join(ws.root, f"spawns-cli-{op}.log")
+        # add/del of an extra client keep the client count unchanged across ops
+        run_cli(ws, make_args(iterations), counting_env(ws, spawn_log))
+        results.append(summarize("cli", op, ws.clients, samples, read_spawns(spawn_log)))
+        log(results[-1])
+    return results
+
+
+# --- live apply through the Xray API ---
+
+@contextlib.contextmanager
+def listening(ports: List[int]):
+    """Accept connections on ``ports`` so that restart_xray sees Xray come back up."""
+    sockets = []
+    try:
+        for port in ports:
+            s = socket.socket()
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                s.bind(("127.0.0.1", port))
+            except OSError:
+                # Something already listens there, which serves as well
+                s.close()
+                continue
+            s.listen(16)
+            sockets.append(s)
+        yield
+    finally:
+        for s in sockets:
+            s.close()
+
+
+def vless_tags(ws: Workspace) -> List[str]:
+    with open(ws.config, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    return [i["tag"] for i in config["inbounds"] if i.get("protocol") == "vless"]
+
+
+def client_ids(ws: Workspace, names: List[str]) -> List[str]:
+    with open(ws.config, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    by_name = {c.get("email"): c["id"] for i in config["inbounds"] if i.get("protocol") == "vless" for c in i["settings"]["clients"]}
+    return [by_name[name] for name in names]
+
+
+def bench_apply(ws: Workspace, iterations: int, log) -> List[dict]:
+    """`vless add`, `del` and `import` with the Xray API up (live) and down (restart).
+
+    The xray stub checks every `api adu`/`rmu` request and logs it; each run
+    asserts the "Applied:" marker and, when live, that the requests named
+    exactly the changed clients on every VLESS inbound.
+    """
+    tags = vless_tags(ws)
+    api_log = os.path.join(ws.root, "xray-api.log")
+    results = []
+    for mode in ("live", "restart"):
+        env = dict(ws.env, BENCH_XRAY_API_LOG=api_log, BENCH_XRAY_API="up" if mode == "live" else "down")
+
+        def run(args: List[str]) -> Tuple[float, str, List[str]]:
+            open(api_log, "w").close()
+            start = time.perf_counter()
+            out = run_cli(ws, args, env)
+            elapsed = time.perf_counter() - start
+            if f"Applied: {mode}" not in out:
+                raise RuntimeError(f"vless {args[0]} with the API {env['BENCH_XRAY_API']}: no 'Applied: {mode}' in {out[-300:]!r}")
+            with open(api_log, "r", encoding="utf-8") as f:
+                calls = f.read().splitlines()
+            if mode == "restart" and calls:
+                raise RuntimeError(f"vless {args[0]}: API calls accepted while the API was down: {calls}")
+            return elapsed, out, calls
+
+        def expect(op: str, calls: List[str], added: List[str], removed: List[str]) -> None:
+            if mode != "live":
+                return
+            # One rmu per inbound with the removed emails, then one adu with the added ids on every inbound
+            wanted = [("rmu", tag, sorted(removed)) for tag in tags] if removed else []
+            if added:
+                wanted.append(("adu", "", sorted((tag, cid) for tag in tags for cid in client_ids(ws, added))))
+            got = []
+            for call in calls:
+                kind, _, rest = call.partition(" ")
+                if kind == "adu":
+                    got.append(("adu", "", sorted((i["tag"], cid) for i in json.loads(rest) for cid in i["ids"])))
+                else:
+                    tag, *emails = rest.split()
+                    got.append((kind, tag, sorted(emails)))
+            if got != wanted:
+                raise RuntimeError(f"vless {op}: expected API calls {wanted}, got {got}")
+
+        samples: Dict[str, List[float]] = {"add": [], "del": [], "import": []}
+        with listening([443, 80]):
+            for i in range(iterations):
+                name = f"bench_apply_{mode}_{i}"
+                elapsed, _, calls = run(["add", name])
+                expect("add", calls, [name], [])
+                samples["add"].append(elapsed)
+
+                elapsed, _, calls = run(["del", name])
+                expect("del", calls, [], [name])
+                samples["del"].append(elapsed)
+
+                # One batch that adds two clients and removes them again in the next one
+                pair = [f"{name}_a", f"{name}_b"]
+                request = os.path.join(ws.root, "apply-import.json")
+                with open(request, "w", encoding="utf-8") as f:
+                    json.dump({"add": [{"name": n} for n in pair], "del": []}, f)
+                elapsed, _, calls = run(["import", request])
+                expect("import", calls, pair, [])
+                samples["import"].append(elapsed)
+                with open(request, "w", encoding="utf-8") as f:
+                    json.dump({"add": [], "del": pair}, f)
+                _, _, calls = run(["import", request])
+                expect("import", calls, [], pair)
+        for op, op_samples in samples.items():
+            results.append(summarize("apply", f"{op}:{mode}", ws.clients, op_samples, Counter()))
+            log(results[-1])
+    return results
+
+
+# --- bot handlers ---
+
+def bot_settings(ws: Workspace, **overrides):
+    import telegram_bot as tb
+
+    return tb.Settings(
+        token="0:bench",
+        admins=[ADMIN_ID],
+        vless_path=ws.vless,
+        output_dir=ws.output_dir,
+        config_path=ws.config,
+        confdir=ws.env["VLESS_CONFDIR"],
+        state_dir=ws.state_dir,
+        limits_file=os.path.join(ws.state_dir, "vless-limits.json"),
+        **{"batch_window": 0, "stats_interval": 0, "access_log": "off", **overrides},
+    )
+
+
+async def bench_bot(ws: Workspace, iterations: int, log) -> List[dict]:
+    import telegram_bot as tb
+
+    settings = bot_settings(ws)
+    app = tb.build_app(settings)
+    last_page = max(0, (ws.clients - 1) // settings.list_page_size)
+
+    def command(handler, args: List[str]) -> Callable[[], Awaitable[None]]:
+        return lambda: handler(make_update(ADMIN_ID, message=FakeMessage()), make_context(app, args), settings)
+
+    def callback(handler, data: str) -> Callable[[], Awaitable[None]]:
+        return lambda: handler(make_update(ADMIN_ID, query=FakeCallbackQuery(data)), make_context(app), settings)
+
+    ops: Dict[str, Callable[[int], Callable[[], Awaitable[None]]]] = {
+        "list": lambda i: command(tb.cmd_list, []),
+        "list_page": lambda i: callback(tb.handle_list_callback, f"list:{last_page}"),
+        "show": lambda i: command(tb.cmd_show, [show_key(ws, i + 1)]),
+        # A name with its last digit cut off: a prefix shared by up to ten clients
+        "find": lambda i: command(tb.cmd_find, [show_key(ws, i + 1)[:-1]]),
+        "add": lambda i: command(tb.cmd_add, [f"bench_bot_{i}"]),
+        "del": lambda i: callback(tb.handle_delete_callback, f"delete_confirm:bench_bot_{i}"),
+    }
+    results = []
+    saved_env = dict(os.environ)
+    try:
+        # The executor starts vless with the bot's own environment
+        os.environ.clear()
+        os.environ.update(ws.env)
+        for op, make_call in ops.items():
+            if op in ("list", "list_page", "find"):
+                await make_call(0)()  # warm-up: first registry load and index build
+            samples = []
+            for i in range(iterations):
+                call = make_call(i)
+                start = time.perf_counter()
+                await call()
+                samples.append(time.perf_counter() - start)
+            spawn_log = os.path.join(ws.root, f"spawns-bot-{op}.log")
+            os.environ.update(counting_env(ws, spawn_log))
+            await make_call(iterations)()
+            os.environ.clear()
+            os.environ.update(ws.env)
+            results.append(summarize("bot", op, ws.clients, samples, read_spawns(spawn_log)))
+            log(results[-1])
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_env)
+        app.bot_data["file_ids"].close()
+    return results
+
+
+# --- fleet ---
+
+def make_nodes(ws: Workspace, count: int, seed: int) -> str:
+    """``count`` fake remote nodes, each its own install reached through the ssh stub; returns the nodes file."""
+    nodes = []
+    for k in range(count):
+        node_ws = make_workspace(os.path.join(ws.root, f"node{k}"), ws.clients, seed + k + 1)
+        # What the node's login shell would see: its own config and state
+        remote = os.path.join(node_ws.root, "vless-remote")
+        exports = "".join(
+            f"export {key}={shlex.quote(value)}\n" for key, value in node_ws.env.items() if key.startswith("VLESS_")
+        )
+        with open(remote, "w", encoding="utf-8") as f:
+            f.write(f"#!/bin/bash\n{exports}exec {shlex.quote(node_ws.vless)} \"$@\"\n")
+        os.chmod(remote, 0o755)
+        nodes.append({"name": f"node{k}", "host": f"node{k}.bench", "vless": remote})
+    path = os.path.join(ws.root, "nodes.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"nodes": nodes}, f)
+    return path
+
+
+async def bench_fleet(ws: Workspace, iterations: int, nodes: int, seed: int, log) -> List[dict]:
+    """/add name@all, /del name@all and /doctor all across this server and ``nodes`` fake ones.
+
+    The nodes are separate installs behind the ssh stub, so the timings cover
+    the fan-out, the OpenSSH transport and the progress message, not the network.
+    """
+    import telegram_bot as tb
+    from fleet import OpenSshTransport
+
+    settings = bot_settings(ws, fleet_file=make_nodes(ws, nodes, seed))
+    app = tb.build_app(settings)
+    fleet = app.bot_data["fleet"]
+    # Always the ssh(1) transport, even where asyncssh is installed: the stub stands in for the nodes
+    fleet.transport = OpenSshTransport(os.path.join(ws.state_dir, "ssh"))
+    names = fleet.names()
+
+    def check(message: FakeMessage) -> None:
+        progress = message.sent[0]
+        final = progress.edits[-1] if progress.edits else progress.text
+        if f"из {len(names)}" not in final or "❌" in final or "🔌" in final or "⌛" in final:
+            raise RuntimeError(f"fleet fan-out failed:\n{final}")
+
+    async def add(i: int) -> None:
+        message = FakeMessage()
+        await tb.cmd_add(make_update(ADMIN_ID, message=message), make_context(app, [f"bench_fleet_{i}@all"]), settings)
+        check(message)
+
+    async def delete(i: int) -> None:
+        query = FakeCallbackQuery(f"delete_confirm:bench_fleet_{i}@all")
+        await tb.handle_delete_callback(make_update(ADMIN_ID, query=query), make_context(app), settings)
+        final = query.message.edits[-1] if query.message.edits else ""
+        if f"на {len(names)} из {len(names)}" not in final:
+            raise RuntimeError(f"fleet delete failed:\n{final}")
+
+    async def doctor(i: int) -> None:
+        message = FakeMessage()
+        await tb.cmd_doctor(make_update(ADMIN_ID, message=message), make_context(app, ["all"]), settings)
+        progress = message.sent[0]
+        if f"из {len(names)}" not in (progress.edits[-1] if progress.edits else ""):
+            raise RuntimeError("fleet doctor did not finish")
+
+    ops: Dict[str, Callable[[int], Awaitable[None]]] = {"add@all": add, "del@all": delete, "doctor@all": doctor}
+    results = []
+    saved_env = dict(os.environ)
+    try:
+        os.environ.clear()
+        os.environ.update(ws.env)
+        for op, call in ops.items():
+            samples = []
+            for i in range(iterations):
+                start = time.perf_counter()
+                await call(i)
+                samples.append(time.perf_counter() - start)
+            spawn_log = os.path.join(ws.root, f"spawns-fleet-{op}.log")
+            os.environ.update(counting_env(ws, spawn_log))
+            await call(iterations)
+            os.environ.clear()
+            os.environ.update(ws.env)
+            result = summarize("fleet", op, ws.clients, samples, read_spawns(spawn_log))
+            result["nodes"] = len(names)
+            results.append(result)
+            log(result)
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_env)
+        await fleet.close()
+        app.bot_data["file_ids"].close()
+    return results
+
+
+# --- access log ---
+
+ACCESS_LINES = 20000
+
+
+def write_access_log(path: str, clients: int, lines: int, seed: int) -> None:
+    """Xray access log lines for ``clients`` clients, with one in twenty rejected (a UUID scan)."""
+    stamp = time.strftime("%Y/%m/%d %H:%M:%S")
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(lines):
+            k = (i * 7919 + seed) % 1000003
+            if i % 20 == 19:
+                f.write(f"{stamp}.000000 from 198.51.{k % 256}.{k // 256 % 256}:40000 rejected  proxy/vless/encoding: invalid request user id\n")
+            else:
+                f.write(
+                    f"{stamp}.000000 from 203.0.113.{k % 250}:{10000 + k % 50000} accepted tcp:example.com:443"
+                    f" [vless-443 >> direct] email: {client_name(k % clients)}\n"
+                )
+
+
+async def bench_access(ws: Workspace, iterations: int, seed: int, log) -> List[dict]:
+    """Reading ACCESS_LINES access log lines through the tail -> parse -> analyzer pipeline.
+
+    Every run starts from offset 0 with a fresh analyzer, as after a log
+    rotation; the analyzer's memory is bounded by the client count.
+    """
+    from access_log import AccessAnalyzer, follow_file, parse_events
+
+    path = os.path.join(ws.root, "access.log")
+    write_access_log(path, ws.clients, ACCESS_LINES, seed)
+    inode = os.stat(path).st_ino
+
+    async def consume() -> AccessAnalyzer:
+        analyzer = AccessAnalyzer()
+        async for item in parse_events(follow_file(path, {"inode": inode, "offset": 0}, poll_interval=0)):
+            if item is None:
+                break
+            event, _ = item
+            if event is not None:
+                analyzer.feed(event)
+        return analyzer
+
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        analyzer = await consume()
+        samples.append(time.perf_counter() - start)
+    if analyzer.total_accepted + analyzer.total_rejected != ACCESS_LINES:
+        raise RuntimeError(f"access log: {analyzer.total_accepted + analyzer.total_rejected} of {ACCESS_LINES} lines parsed")
+    result = summarize("access", "follow", ws.clients, samples, Counter())
+    result["lines"] = ACCESS_LINES
+    result["lines_per_s"] = round(ACCESS_LINES / (result["p50_ms"] / 1000))
+    log(result)
+    return [result]
+
+
+# --- traffic statistics ---
+
+def write_counters(path: str, clients: int, round_no: int) -> Dict[str, Tuple[int, int]]:
+    """Xray statsquery output with traffic for every client; returns the (up, down) written."""
+    stat = [
+        {"name": "inbound>>>vless-443>>>traffic>>>uplink", "value": 123456},
+        # Xray leaves out "value" when a counter is zero
+        {"name": f"user>>>{client_name(0)}>>>traffic>>>downlink"},
+    ]
+    written = {}
+    for k in range(1, clients):
+        up, down = (k + 1) * 1000 * round_no, (k + 1) * 3000 * round_no
+        name = client_name(k)
+        stat.append({"name": f"user>>>{name}>>>traffic>>>uplink", "value": up})
+        stat.append({"name": f"user>>>{name}>>>traffic>>>downlink", "value": down})
+        written[name] = (up, down)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"stat": stat}, f)
+    return written
+
+
+async def bench_stats(ws: Workspace, iterations: int, log) -> List[dict]:
+    """Poll canned counters through the xray stub into TrafficStats and check what comes out.
+
+    Every round writes new counters for every client; the stub clears them on
+    ``-reset``, so a poll in between must add nothing. Checks the totals from
+    top() and get(), the ring rates against the deltas of the window and the
+    SQLite rollups from history() after flush(), also after reopening.
+    """
+    from traffic_stats import StatsPoller, TrafficStats, XrayStatsSource
+
+    counters = os.path.join(ws.root, "xray-stats.json")
+    db = os.path.join(ws.root, "stats-bench.sqlite3")
+    for path in (db, db + "-wal", db + "-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+    # Room for both polls of every round, so the ring covers the whole run
+    stats = TrafficStats(db, ring_slots=2 * (iterations + 1))
+    poller = StatsPoller(XrayStatsSource(), stats)
+    totals: Dict[str, List[int]] = {}
+    window: Dict[str, List[int]] = {}
+    samples = []
+    spawn_log = os.path.join(ws.root, "spawns-stats.log")
+    saved_env = dict(os.environ)
+    try:
+        os.environ.clear()
+        os.environ.update(ws.env, BENCH_XRAY_STATS=counters)
+        # Round 0 only reaches the totals: it covers an unknown period. The
+        # last round is not timed; it counts the spawns of one poll
+        for round_no in range(iterations + 1):
+            if round_no == iterations:
+                os.environ.update(counting_env(ws, spawn_log))
+            written = write_counters(counters, ws.clients, round_no + 1)
+            start = time.perf_counter()
+            await poller.poll_once()
+            if round_no < iterations:
+                samples.append(time.perf_counter() - start)
+            if poller.last_error:
+                raise RuntimeError(f"stats poll failed: {poller.last_error}")
+            for name, (up, down) in written.items():
+                total = totals.setdefault(name, [0, 0])
+                total[0] += up
+                total[1] += down
+                if round_no > 0:
+                    delta = window.setdefault(name, [0, 0])
+                    delta[0] += up
+                    delta[1] += down
+            if round_no == iterations:
+                os.environ.update(ws.env)
+                os.environ.pop("BENCH_SPAWN_LOG", None)
+            # The stub reset the counters: polling again adds nothing
+            await poller.poll_once()
+            await asyncio.sleep(0.01)
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_env)
+
+    try:
+        if stats.get(client_name(0)) is not None:
+            raise RuntimeError("a client whose counters were zero got traffic")
+        top = stats.top(3)
+        expected_top = sorted(totals, key=lambda name: -sum(totals[name]))[:3]
+        if [t.email for t in top] != expected_top:
+            raise RuntimeError(f"top(3) is {[t.email for t in top]}, expected {expected_top}")
+        span = stats.ring.span()
+        for name, (up, down) in totals.items():
+            got = stats.get(name)
+            if got is None or (got.total_up, got.total_down) != (up, down):
+                raise RuntimeError(f"totals of {name}: {got}, expected {(up, down)}")
+            delta_up, delta_down = window.get(name, [0, 0])
+            if abs(got.rate_up * span - delta_up) > 1 or abs(got.rate_down * span - delta_down) > 1:
+                raise RuntimeError(f"rates of {name}: {got.rate_up:.1f}/{got.rate_down:.1f} B/s over {span:.3f}s, window {delta_up}/{delta_down}")
+        stats.flush()
+        stats.close()
+        reopened = TrafficStats(db)
+        try:
+            for name, (up, down) in totals.items():
+                history = reopened.history(name, 0)
+                if (sum(h[1] for h in history), sum(h[2] for h in history)) != (up, down):
+                    raise RuntimeError(f"history of {name}: {history}, expected totals {(up, down)}")
+                got = reopened.get(name)
+                if got is None or (got.total_up, got.total_down) != (up, down):
+                    raise RuntimeError(f"persisted totals of {name}: {got}, expected {(up, down)}")
+        finally:
+            reopened.close()
+    finally:
+        stats.close()
+    result = summarize("stats", "poll", ws.clients, samples, read_spawns(spawn_log))
+    log(result)
+    return [result]
+
+
+# --- client expiry ---
+
+EXPIRY_BATCH = 50
+
+
+async def bench_expiry(ws: Workspace, iterations: int, log) -> List[dict]:
+    """Removing EXPIRY_BATCH clients whose deadlines fall in one window.
+
+    Each run adds the batch, gives the clients deadlines a millisecond apart
+    and times the scheduler's sweep: heap pops, one `vless import` and the
+    notification. The spawn count covers the whole sweep.
+    """
+    import telegram_bot as tb
+
+    settings = bot_settings(ws)
+    app = tb.build_app(settings)
+    scheduler = app.bot_data["limits"]
+    notified: List[int] = []
+
+    async def notify(done) -> None:
+        notified.append(len(done))
+
+    scheduler.notify = notify
+
+    async def sweep(i: int) -> float:
+        names = [f"bench_exp_{i}_{k}" for k in range(EXPIRY_BATCH)]
+        path = os.path.join(ws.root, "expiry-import.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"add": names}, f)
+        run_cli(ws, ["import", path])
+        now = time.time()
+        reg = app.bot_data["registry"]
+        for k, name in enumerate(names):
+            await scheduler.set_expiry(reg.get(name), now + k / 1000, ADMIN_ID)
+        start = time.perf_counter()
+        done = await scheduler.run_due(now + 1)
+        elapsed = time.perf_counter() - start
+        if len(done) != EXPIRY_BATCH or any(reg.has_name(name) for name in names):
+            raise RuntimeError(f"expiry sweep removed {len(done)} of {EXPIRY_BATCH} clients")
+        return elapsed
+
+    results = []
+    saved_env = dict(os.environ)
+    try:
+        os.environ.clear()
+        os.environ.update(ws.env)
+        samples = [await sweep(i) for i in range(iterations)]
+        spawn_log = os.path.join(ws.root, "spawns-expiry.log")
+        os.environ.update(counting_env(ws, spawn_log))
+        await sweep(iterations)
+        result = summarize("expiry", "sweep", ws.clients, samples, read_spawns(spawn_log))
+        result["batch"] = EXPIRY_BATCH
+        results.append(result)
+        log(result)
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_env)
+        app.bot_data["file_ids"].close()
+    return results
+
+
+# --- update delivery ---
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def bench_transport(ws: Workspace, iterations: int, log) -> List[dict]:
+    """Time from Telegram sending /list to the bot's reply, over long polling and over the webhook.
+
+    A real Application talks to FakeBotApi instead of api.telegram.org.
+    """
+    import telegram_bot as tb
+    from webhook import WebhookServer, new_secret
+
+    api = FakeBotApi()
+    await api.start()
+    results = []
+    try:
+        for mode in ("polling", "webhook"):
+            # Rounds come faster than one a second; the flow target covers the rate limits
+            app = tb.build_app(bot_settings(ws, api_url=api.url, send_rate=1000, chat_rate=1000))
+            await app.initialize()
+            await app.start()
+            server: Optional[WebhookServer] = None
+            session: Optional[aiohttp.ClientSession] = None
+            if mode == "polling":
+                await app.updater.start_polling(poll_interval=0.0, timeout=10)
+
+                async def deliver(update: dict) -> None:
+                    api.push_update(update)
+            else:
+                secret = new_secret()
+                port = free_port()
+                url = f"http://127.0.0.1:{port}/telegram"
+                server = WebhookServer(app, "127.0.0.1", port, "/telegram", secret)
+                await server.start()
+                session = aiohttp.ClientSession()
+                # Requests without the registered secret must never reach a handler
+                status = await api.post_webhook(session, url, "not-the-secret", api.command_update("/list", ADMIN_ID))
+                if status != 403:
+                    raise RuntimeError(f"webhook accepted a request with a wrong secret (HTTP {status})")
+
+                async def deliver(update: dict) -> None:
+                    status = await api.post_webhook(session, url, secret, update)
+                    if status != 200:
+                        raise RuntimeError(f"webhook rejected an update (HTTP {status})")
+            try:
+                samples = []
+                for i in range(iterations + 1):
+                    start = time.perf_counter()
+                    await deliver(api.command_update("/list", ADMIN_ID))
+                    await asyncio.wait_for(api.replies.get(), timeout=10)
+                    if i:  # the first round trip warms up connections and the registry
+                        samples.append(time.perf_counter() - start)
+            finally:
+                if mode == "polling":
+                    await app.updater.stop()
+                if server is not None:
+                    await server.stop()
+                if session is not None:
+                    await session.close()
+                await app.stop()
+                await app.shutdown()
+                app.bot_data["file_ids"].close()
+            results.append(summarize("transport", mode, ws.clients, samples, Counter()))
+            log(results[-1])
+    finally:
+        await api.stop()
+    return results
+
+
+# --- regressions ---
+
+def compare(results: List[dict], baseline: List[dict], threshold: float) -> List[str]:
+    """Ops whose p50 grew by more than ``threshold`` times or that spawn more processes."""
+    before = {(r["target"], r["op"], r["clients"]): r for r in baseline}
+    problems = []
+    for r in results:
+        old = before.get((r["target"], r["op"], r["clients"]))
+        if old is None:
+            continue
+        name = f"{r['target']} {r['op']} @{r['clients']}"
+        if old["p50_ms"] > 0 and r["p50_ms"] > old["p50_ms"] * threshold:
+            problems.append(f"{name}: p50 {old['p50_ms']} -> {r['p50_ms']} ms")
+        if r["spawns"] > old["spawns"]:
+            problems.append(f"{name}: spawns {old['spawns']} -> {r['spawns']}")
+    return problems
+
+
+FLOW_BURST = 30
+
+
+async def bench_flow(ws: Workspace, iterations: int, log) -> List[dict]:
+    """FLOW_BURST short replies to one chat at once, through FlowControl to FakeBotApi.
+
+    The first sendMessage of every burst is refused with a RetryAfter of one
+    second. Each run checks that every text arrived and records how many
+    sendMessage requests carried them (``requests``).
+    """
+    import telegram_bot as tb
+
+    api = FakeBotApi()
+    await api.start()
+    app = tb.build_app(bot_settings(ws, api_url=api.url))
+    await app.initialize()
+    samples = []
+    requests = []
+    try:
+        for i in range(iterations):
+            while not api.replies.empty():
+                api.replies.get_nowait()
+            sent_before = api.calls["sendMessage"]
+            api.flood_next = 1
+            start = time.perf_counter()
+            await asyncio.gather(*(
+                app.bot.send_message(ADMIN_ID, f"<i>note {i}.{k}</i>", parse_mode="HTML") for k in range(FLOW_BURST)
+            ))
+            samples.append(time.perf_counter() - start)
+            requests.append(api.calls["sendMessage"] - sent_before - 1)
+            texts = []
+            while not api.replies.empty():
+                texts.append(api.replies.get_nowait()[1])
+            delivered = sum(f"note {i}.{k}<" in "".join(texts) for k in range(FLOW_BURST))
+            if delivered != FLOW_BURST:
+                raise RuntimeError(f"flow control delivered {delivered} of {FLOW_BURST} texts")
+            # Let the chat's bucket refill so every run starts alike
+            await asyncio.sleep(3)
+    finally:
+        await app.shutdown()
+        app.bot_data["file_ids"].close()
+        await api.stop()
+    result = summarize("flow", "burst", ws.clients, samples, Counter())
+    result["texts"] = FLOW_BURST
+    result["requests"] = max(requests)
+    log(result)
+    return [result]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Latency and process-spawn benchmarks for the vless CLI and the bot handlers.")
+    parser.add_argument("--sizes", default="10,1000,10000", help="comma-separated client counts (default: 10,1000,10000)")
+    parser.add_argument("--iterations", type=int, default=20, help="timed runs per operation (default: 20)")
+    parser.add_argument("--targets", default="cli,apply,bot,transport,flow,fleet,access,stats,expiry", help="any of cli, apply, bot, transport, flow, fleet, access, stats, expiry (default: all)")
+    parser.add_argument("--nodes", type=int, default=4, help="fake remote nodes for the fleet target (default: 4)")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the synthetic client UUIDs")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="earlier JSON report; exit with status 1 on regressions against it")
+    parser.add_argument("--threshold", type=float, default=1.25, help="p50 slowdown factor counted as a regression (default: 1.25)")
+    parser.add_argument("--keep", action="store_true", help="keep the generated workspaces")
+    opts = parser.parse_args()
+
+    sizes = [int(s) for s in opts.sizes.split(",") if s.strip()]
+    targets = {t.strip() for t in opts.targets.split(",") if t.strip()}
+    if os.geteuid() != 0:
+        # add/del go through require_root in the CLI
+        print("bench: run as root (or in a container): vless add/del refuse to run otherwise", file=sys.stderr)
+        return 2
+
+    def log(result: dict) -> None:
+        print(
+            f"{result['target']:>9} {result['op']:<9} {result['clients']:>6} clients  "
+            f"p50 {result['p50_ms']:>9.2f} ms  p90 {result['p90_ms']:>9.2f} ms  spawns {result['spawns']}",
+            file=sys.stderr,
+        )
+
+    workdir = tempfile.mkdtemp(prefix="vless-bench-")
+    results: List[dict] = []
+    try:
+        for size in sizes:
+            ws = make_workspace(workdir, size, opts.seed)
+            # The first show writes the params snapshot; later runs read it like a live server
+            run_cli(ws, ["show", client_name(0)])
+            if "cli" in targets:
+                results += bench_cli(ws, opts.iterations, log)
+            if "apply" in targets:
+                results += bench_apply(ws, opts.iterations, log)
+            if "bot" in targets:
+                results += asyncio.run(bench_bot(ws, opts.iterations, log))
+            if "transport" in targets:
+                results += asyncio.run(bench_transport(ws, opts.iterations, log))
+            if "flow" in targets:
+                results += asyncio.run(bench_flow(ws, opts.iterations, log))
+            if "fleet" in targets:
+                results += asyncio.run(bench_fleet(ws, opts.iterations, opts.nodes, opts.seed, log))
+            if "access" in targets:
+                results += asyncio.run(bench_access(ws, opts.iterations, opts.seed, log))
+            if "stats" in targets:
+                results += asyncio.run(bench_stats(ws, opts.iterations, log))
+            if "expiry" in targets:
+                results += asyncio.run(bench_expiry(ws, opts.iterations, log))
+    finally:
+        if opts.keep:
+            print(f"bench: workspaces kept in {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "sizes": sizes,
+            "iterations": opts.iterations,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if opts.output:
+        with open(opts.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if opts.baseline:
+        with open(opts.baseline, "r", encoding="utf-8") as f:
+            problems = compare(results, json.load(f)["results"], opts.threshold)
+        for problem in problems:
+            print(f"REGRESSION {problem}", file=sys.stderr)
+        if problems:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
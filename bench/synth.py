@@ -0,0 +1,62 @@
+import json
+import random
+import uuid
+from typing import List
+
+
+def client_name(i: int) -> str:
+    return f"bench_{i:05d}"
+
+
+def make_clients(count: int, seed: int = 0) -> List[dict]:
+    """``count`` named clients with reproducible UUIDs, as `vless add` writes them."""
+    rng = random.Random(seed)
+    return [
+        {"id": str(uuid.UUID(int=rng.getrandbits(128), version=4)), "email": client_name(i), "flow": "xtls-rprx-vision"}
+        for i in range(count)
+    ]
+
+
+def _vless_inbound(port: int, clients: List[dict]) -> dict:
+    return {
+        "tag": f"vless-{port}",
+        "port": port,
+        "protocol": "vless",
+        "settings": {"clients": clients, "decryption": "none"},
+        "streamSettings": {
+            "network": "tcp",
+            "security": "reality",
+            "realitySettings": {
+                "dest": "apple.com:443",
+                "serverNames": ["apple.com", "www.apple.com"],
+                "privateKey": "ePkN6cvVtzMlpX8V1xAmlI9l8VT7ayX9nYeUqp4h4GY",
+                "publicKey": "zJyxQb4l0n0G3V3vJtFW8AAqMh7O1yAYFOhcYj2_UwE",
+                "shortIds": ["6ba85179e30d4fc2", "a1b2c3d4", "0123abcd"],
+            },
+        },
+        "sniffing": {"enabled": True, "destOverride": ["http", "tls"]},
+    }
+
+
+def make_config(count: int, seed: int = 0) -> dict:
+    """An install_vless_reality.sh config (API and stats enabled) holding ``count`` clients."""
+    clients = make_clients(count, seed)
+    return {
+        "log": {"loglevel": "warning"},
+        "api": {"tag": "api", "services": ["HandlerService", "StatsService"]},
+        "stats": {},
+        "policy": {"levels": {"0": {"statsUserUplink": True, "statsUserDownlink": True}}},
+        "inbounds": [
+            _vless_inbound(443, clients),
+            _vless_inbound(80, clients),
+            {"tag": "api", "listen": "127.0.0.1", "port": 10085, "protocol": "dokodemo-door", "settings": {"address": "127.0.0.1"}},
+        ],
+        "outbounds": [{"protocol": "freedom", "tag": "direct"}],
+        "routing": {"rules": [{"type": "field", "inboundTag": ["api"], "outboundTag": "api"}]},
+    }
+
+
+def write_config(path: str, count: int, seed: int = 0) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(make_config(count, seed), f, indent=2)
+        f.write("\n")
@@ -0,0 +1,607 @@
+import asyncio
+import heapq
+import json
+import os
+import re
+import subprocess
+import time
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from diagnostics import PASS, WARN, Check, CheckOutcome
+from xray_config import config_files, load_config
+
+
+FILE = "file"
+JOURNAL = "journal"
+OFF = "off"
+
+# Detectors look at the last WINDOW_SECONDS of events
+WINDOW_SECONDS = 600.0
+# Recent source addresses remembered per client
+RECENT_SOURCES = 16
+# Distinct rejected sources tracked per window bucket
+REJECTED_CAPACITY = 32
+
+# `<date> <time>[.us] [from ][tcp:]<ip>:<port> accepted|rejected <rest>`, across Xray versions
+ACCESS_RE = re.compile(
+    r"^(?P<date>\d{4}/\d\d/\d\d \d\d:\d\d:\d\d)(?:\.\d+)? "
+    r"(?:from )?(?:(?:tcp|udp):)?(?P<source>\[[0-9A-Fa-f:.]+\]|[^\s:\[]+):\d+ "
+    r"(?P<status>accepted|rejected)\s+(?P<rest>.*)$"
+)
+ROUTE_RE = re.compile(r"\[([^\]]+)\]")
+EMAIL_RE = re.compile(r"\bemail: (\S+)")
+
+
+@dataclass(frozen=True)
+class AccessEvent:
+    at: float
+    source: str
+    accepted: bool
+    target: str = ""
+    route: str = ""
+    email: str = ""
+    reason: str = ""
+
+
+class TimestampParser:
+    """Log timestamps (local time, one-second resolution) to Unix time, one conversion per second."""
+
+    def __init__(self) -> None:
+        self._text = ""
+        self._value = 0.0
+
+    def __call__(self, text: str) -> float:
+        if text != self._text:
+            self._value = time.mktime(time.strptime(text, "%Y/%m/%d %H:%M:%S"))
+            self._text = text
+        return self._value
+
+
+def parse_line(line: str, timestamp: Callable[[str], float]) -> Optional[AccessEvent]:
+    """One Xray access log line as an event; None for error log lines and anything else."""
+    match = ACCESS_RE.match(line.strip())
+    if not match:
+        return None
+    source = match.group("source").strip("[]")
+    rest = match.group("rest")
+    at = timestamp(match.group("date"))
+    if match.group("status") == "rejected":
+        return AccessEvent(at, source, False, reason=rest.strip())
+    route = ROUTE_RE.search(rest)
+    email = EMAIL_RE.search(rest)
+    return AccessEvent(
+        at,
+        source,
+        True,
+        target=rest.split(" ", 1)[0],
+        route=route.group(1) if route else "",
+        email=email.group(1) if email else "",
+    )
+
+
+# --- sliding windows ---
+
+class WindowCounter:
+    """Events over a sliding window, counted in a fixed ring of buckets.
+
+    Moving the window forward clears only the buckets it passes, so adding
+    and reading are O(1) amortized and the memory never grows.
+    """
+
+    def __init__(self, window: float = WINDOW_SECONDS, buckets: int = 20) -> None:
+        self.buckets = max(1, buckets)
+        self.bucket_seconds = window / self.buckets
+        self._counts = array("L", bytes(array("L").itemsize * self.buckets))
+        self._head = -1
+        self._total = 0
+
+    def _advance(self, bucket: int) -> None:
+        if bucket <= self._head:
+            return
+        if self._head < 0 or bucket - self._head >= self.buckets:
+            for slot in range(self.buckets):
+                self._counts[slot] = 0
+            self._total = 0
+        else:
+            for step in range(self._head + 1, bucket + 1):
+                slot = step % self.buckets
+                self._total -= self._counts[slot]
+                self._counts[slot] = 0
+        self._head = bucket
+
+    def add(self, at: float, count: int = 1) -> None:
+        bucket = int(at // self.bucket_seconds)
+        self._advance(bucket)
+        if bucket <= self._head - self.buckets:
+            # Older than the window
+            return
+        self._counts[bucket % self.buckets] += count
+        self._total += count
+
+    def count(self, now: float) -> int:
+        self._advance(int(now // self.bucket_seconds))
+        return self._total
+
+
+class WindowTopK:
+    """Approximate per-key counts over a sliding window for an unbounded set of keys.
+
+    Each bucket keeps at most ``capacity`` keys (Space-Saving: a new key
+    replaces the smallest one and inherits its count as possible error), so
+    heavy hitters such as a source flooding the server with bad UUIDs are
+    never lost, while a scan from thousands of addresses costs a fixed amount
+    of memory. ``top`` reports guaranteed counts, never the inherited part.
+    """
+
+    def __init__(self, window: float = WINDOW_SECONDS, buckets: int = 10, capacity: int = REJECTED_CAPACITY) -> None:
+        self.buckets = max(1, buckets)
+        self.bucket_seconds = window / self.buckets
+        self.capacity = max(1, capacity)
+        # key -> [count, of which possibly inherited]
+        self._slots: List[Dict[str, List[int]]] = [{} for _ in range(self.buckets)]
+        self._head = -1
+
+    def _advance(self, bucket: int) -> None:
+        if bucket <= self._head:
+            return
+        steps = self.buckets if self._head < 0 else min(bucket - self._head, self.buckets)
+        for step in range(bucket - steps + 1, bucket + 1):
+            self._slots[step % self.buckets] = {}
+        self._head = bucket
+
+    def add(self, at: float, key: str) -> None:
+        bucket = int(at // self.bucket_seconds)
+        self._advance(bucket)
+        if bucket <= self._head - self.buckets:
+            return
+        counts = self._slots[bucket % self.buckets]
+        entry = counts.get(key)
+        if entry is not None:
+            entry[0] += 1
+        elif len(counts) < self.capacity:
+            counts[key] = [1, 0]
+        else:
+            smallest = min(counts, key=lambda k: counts[k][0])
+            inherited = counts.pop(smallest)[0]
+            counts[key] = [inherited + 1, inherited]
+
+    def top(self, now: float, n: int = 10) -> List[Tuple[str, int]]:
+        self._advance(int(now // self.bucket_seconds))
+        totals: Dict[str, int] = {}
+        for counts in self._slots:
+            for key, (count, error) in counts.items():
+                totals[key] = totals.get(key, 0) + count - error
+        return heapq.nlargest(n, totals.items(), key=lambda item: item[1])
+
+
+# --- analyzer ---
+
+@dataclass
+class ClientActivity:
+    email: str
+    connections: int = 0
+    last_seen: float = 0.0
+    last_source: str = ""
+    # source address -> last seen, most recent last
+    sources: "OrderedDict[str, float]" = field(default_factory=OrderedDict)
+    window: WindowCounter = field(default_factory=WindowCounter)
+
+    def recent_sources(self, since: float) -> List[Tuple[str, float]]:
+        return [(source, seen) for source, seen in reversed(self.sources.items()) if seen >= since]
+
+
+@dataclass
+class AccessSummary:
+    window: float
+    accepted: int
+    rejected: int
+    active_clients: int
+    top_clients: List[Tuple[str, int]]
+    rejected_sources: List[Tuple[str, int]]
+    lines: int
+    last_event_at: float
+
+
+class AccessAnalyzer:
+    """Per-client counters and sliding-window detectors fed one event at a time.
+
+    Memory depends on the number of clients, never on how much log has been
+    read: per client a few counters, a bucket ring and the last
+    RECENT_SOURCES addresses; rejected connections go to a bounded top-K.
+    """
+
+    def __init__(self, window: float = WINDOW_SECONDS, max_clients: int = 10000) -> None:
+        self.window = window
+        self.max_clients = max_clients
+        self.clients: Dict[str, ClientActivity] = {}
+        self.accepted = WindowCounter(window, 60)
+        self.rejected = WindowCounter(window, 60)
+        self.rejected_sources = WindowTopK(window)
+        self.total_accepted = 0
+        self.total_rejected = 0
+        self.lines = 0
+        self.last_event_at = 0.0
+
+    def feed(self, event: AccessEvent) -> None:
+        self.last_event_at = max(self.last_event_at, event.at)
+        if not event.accepted:
+            self.total_rejected += 1
+            self.rejected.add(event.at)
+            self.rejected_sources.add(event.at, event.source)
+            return
+        self.total_accepted += 1
+        self.accepted.add(event.at)
+        if not event.email:
+            return
+        client = self.clients.get(event.email)
+        if client is None:
+            if len(self.clients) >= self.max_clients:
+                # Forget the client seen longest ago (deleted ones, in practice)
+                del self.clients[min(self.clients.values(), key=lambda c: c.last_seen).email]
+            client = self.clients[event.email] = ClientActivity(event.email, window=WindowCounter(self.window))
+        client.connections += 1
+        client.window.add(event.at)
+        if event.at >= client.last_seen:
+            client.last_seen = event.at
+            client.last_source = event.source
+        client.sources[event.source] = max(event.at, client.sources.get(event.source, 0.0))
+        client.sources.move_to_end(event.source)
+        if len(client.sources) > RECENT_SOURCES:
+            client.sources.popitem(last=False)
+
+    def summary(self, now: Optional[float] = None, top: int = 10) -> AccessSummary:
+        now = time.time() if now is None else now
+        windows = {email: client.window.count(now) for email, client in self.clients.items()}
+        busiest = heapq.nlargest(top, ((email, n) for email, n in windows.items() if n), key=lambda item: item[1])
+        return AccessSummary(
+            window=self.window,
+            accepted=self.accepted.count(now),
+            rejected=self.rejected.count(now),
+            active_clients=sum(1 for n in windows.values() if n),
+            top_clients=busiest,
+            rejected_sources=self.rejected_sources.top(now, top),
+            lines=self.lines,
+            last_event_at=self.last_event_at,
+        )
+
+    def to_state(self) -> dict:
+        """Counters worth keeping across restarts (windows are rebuilt from new events)."""
+        return {
+            "total_accepted": self.total_accepted,
+            "total_rejected": self.total_rejected,
+            "lines": self.lines,
+            "last_event_at": self.last_event_at,
+            "clients": {
+                email: {
+                    "connections": c.connections,
+                    "last_seen": c.last_seen,
+                    "last_source": c.last_source,
+                    "sources": list(c.sources.items()),
+                }
+                for email, c in self.clients.items()
+            },
+        }
+
+    def load_state(self, state: dict) -> None:
+        self.total_accepted = int(state.get("total_accepted") or 0)
+        self.total_rejected = int(state.get("total_rejected") or 0)
+        self.lines = int(state.get("lines") or 0)
+        self.last_event_at = float(state.get("last_event_at") or 0.0)
+        for email, data in (state.get("clients") or {}).items():
+            client = ClientActivity(
+                email,
+                connections=int(data.get("connections") or 0),
+                last_seen=float(data.get("last_seen") or 0.0),
+                last_source=str(data.get("last_source") or ""),
+                window=WindowCounter(self.window),
+            )
+            for source, seen in (data.get("sources") or [])[-RECENT_SOURCES:]:
+                client.sources[str(source)] = float(seen)
+            self.clients[email] = client
+
+
+# --- sources ---
+
+@dataclass(frozen=True)
+class AccessSource:
+    kind: str
+    target: str = ""
+
+    def describe(self) -> str:
+        if self.kind == FILE:
+            return self.target
+        if self.kind == JOURNAL:
+            return f"journal ({self.target})"
+        return "off"
+
+
+def access_source_resolver(setting: str, config_path: str, confdir: str = "", unit: str = "xray") -> Callable[[], AccessSource]:
+    """Where to read from for VLESS_ACCESS_LOG: auto, off, journal or a file path.
+
+    ``auto`` follows the config: "log.access" set to a path is tailed,
+    "none" turns the analyzer off, and no access log at all means Xray
+    writes it to stdout, i.e. to the journal of ``unit``.
+    """
+    setting = setting.strip() or "auto"
+
+    def resolve() -> AccessSource:
+        if setting == OFF:
+            return AccessSource(OFF)
+        if setting == JOURNAL:
+            return AccessSource(JOURNAL, unit)
+        if setting != "auto":
+            return AccessSource(FILE, setting)
+        try:
+            access = str((load_config(config_files(config_path, confdir)).get("log") or {}).get("access") or "")
+        except (OSError, ValueError):
+            access = ""
+        if access == "none":
+            return AccessSource(OFF)
+        return AccessSource(FILE, access) if access else AccessSource(JOURNAL, unit)
+
+    return resolve
+
+
+# A line and the position just past it; None is an idle heartbeat
+Position = Dict[str, object]
+LineItem = Optional[Tuple[str, Position]]
+
+
+def _read_chunk(path: str, offset: int, size: int) -> Tuple[bytes, int, int]:
+    """Up to ``size`` bytes from ``offset`` plus the file's inode and current size."""
+    with open(path, "rb") as f:
+        st = os.fstat(f.fileno())
+        if st.st_size < offset:
+            return b"", st.st_ino, st.st_size
+        f.seek(offset)
+        return f.read(size), st.st_ino, st.st_size
+
+
+async def follow_file(path: str, position: Optional[Position], poll_interval: float = 1.0, chunk_size: int = 256 * 1024) -> AsyncIterator[LineItem]:
+    """Tail ``path`` from a saved (inode, offset), through truncation and rotation.
+
+    Without a saved position it starts at the end: history is never
+    replayed. Reads happen in a worker thread, a chunk at a time.
+    """
+    try:
+        st = os.stat(path)
+    except OSError as exc:
+        raise RuntimeError(f"{path}: {exc.strerror}") from exc
+    if position and position.get("inode") == st.st_ino and int(position.get("offset") or 0) <= st.st_size:
+        inode, offset = st.st_ino, int(position.get("offset") or 0)
+    elif position:
+        # Rotated or truncated while we were away: everything in it is new
+        inode, offset = st.st_ino, 0
+    else:
+        inode, offset = st.st_ino, st.st_size
+    pending = b""
+    while True:
+        try:
+            data, current_inode, size = await asyncio.to_thread(_read_chunk, path, offset, chunk_size)
+        except FileNotFoundError:
+            # Between rotation and the new file appearing
+            data, current_inode, size = b"", inode, offset
+        if current_inode != inode or size < offset:
+            # Replaced (rotation) or truncated (copytruncate): start over from the top
+            inode, offset, pending = current_inode, 0, b""
+            continue
+        if not data:
+            yield None
+            await asyncio.sleep(poll_interval)
+            continue
+        offset += len(data)
+        pending += data
+        *complete, pending = pending.split(b"\n")
+        # Offsets of the complete lines: what follows them is still pending
+        end = offset - len(pending)
+        for raw in complete:
+            yield raw.decode("utf-8", errors="replace"), {"inode": inode, "offset": end}
+        # Let the bot's handlers run between chunks of a long backlog
+        await asyncio.sleep(0)
+
+
+async def follow_journal(unit: str, position: Optional[Position], heartbeat: float = 5.0, journalctl: str = "journalctl") -> AsyncIterator[LineItem]:
+    """Follow ``unit``'s journal after a saved cursor (or from now), one message at a time."""
+    cmd = [journalctl, "-u", unit, "-f", "-o", "json", "--no-pager"]
+    cursor = str((position or {}).get("cursor") or "")
+    cmd += [f"--after-cursor={cursor}"] if cursor else ["-n", "0"]
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        limit=1024 * 1024,
+    )
+    try:
+        while True:
+            try:
+                raw = await asyncio.wait_for(proc.stdout.readline(), timeout=heartbeat)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            if not raw:
+                break
+            try:
+                entry = json.loads(raw)
+            except ValueError:
+                continue
+            message = entry.get("MESSAGE")
+            if isinstance(message, list):
+                # Non-UTF-8 messages come as byte arrays
+                message = bytes(message).decode("utf-8", errors="replace")
+            if isinstance(message, str) and entry.get("__CURSOR"):
+                yield message, {"cursor": entry["__CURSOR"]}
+        err = (await proc.stderr.read()).decode("utf-8", errors="replace").strip()
+        rc = await proc.wait()
+        raise RuntimeError(err.splitlines()[-1] if err else f"journalctl exited with code {rc}")
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await asyncio.shield(proc.wait())
+
+
+async def parse_events(lines: AsyncIterator[LineItem]) -> AsyncIterator[Optional[Tuple[Optional[AccessEvent], Position]]]:
+    """Lines to events; lines that are not access entries still move the position."""
+    timestamp = TimestampParser()
+    async for item in lines:
+        if item is None:
+            yield None
+            continue
+        line, position = item
+        yield parse_line(line, timestamp), position
+
+
+# --- follower ---
+
+class AccessLogFollower:
+    """Background task feeding ``analyzer`` from the access log or the journal.
+
+    The read position is checkpointed to ``state_path`` together with the
+    analyzer's counters, so after a restart reading resumes where it left
+    off: nothing is counted twice and old log is never rescanned.
+    """
+
+    def __init__(
+        self,
+        analyzer: AccessAnalyzer,
+        resolve: Callable[[], AccessSource],
+        state_path: str,
+        checkpoint_interval: float = 30.0,
+        retry_interval: float = 15.0,
+        poll_interval: float = 1.0,
+    ) -> None:
+        self.analyzer = analyzer
+        self.resolve = resolve
+        self.state_path = state_path
+        self.checkpoint_interval = checkpoint_interval
+        self.retry_interval = retry_interval
+        self.poll_interval = poll_interval
+        self.source: Optional[AccessSource] = None
+        self.position: Optional[Position] = None
+        self.last_error = ""
+        self._saved_at = 0.0
+        self._dirty = False
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._dirty:
+            await asyncio.to_thread(self.save)
+
+    def load(self) -> None:
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.analyzer.load_state(state.get("analyzer") or {})
+        source = state.get("source") or {}
+        self.source = AccessSource(str(source.get("kind") or OFF), str(source.get("target") or ""))
+        self.position = state.get("position") or None
+
+    def save(self) -> None:
+        """Write the position and counters atomically (blocking; run in a worker thread)."""
+        state = {
+            "source": {"kind": self.source.kind, "target": self.source.target} if self.source else None,
+            "position": self.position,
+            "analyzer": self.analyzer.to_state(),
+        }
+        tmp = self.state_path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(state, f, separators=(",", ":"))
+            os.replace(tmp, self.state_path)
+        except OSError as exc:
+            self.last_error = f"checkpoint: {exc.strerror}"
+            return
+        self._dirty = False
+
+    def lines(self, source: AccessSource) -> AsyncIterator[LineItem]:
+        if source.kind == FILE:
+            return follow_file(source.target, self.position, self.poll_interval)
+        return follow_journal(source.target, self.position)
+
+    async def _run(self) -> None:
+        await asyncio.to_thread(self.load)
+        self._saved_at = time.monotonic()
+        while True:
+            source = self.resolve()
+            if source != self.source:
+                # A position only means something for the source it was taken from
+                self.source, self.position = source, None
+            if source.kind == OFF:
+                self.last_error = ""
+                await asyncio.sleep(self.retry_interval)
+                continue
+            try:
+                await self._consume(source)
+            except Exception as exc:
+                self.last_error = str(exc) or exc.__class__.__name__
+                if source.kind == JOURNAL:
+                    # The cursor may have been vacuumed away; resume from now
+                    self.position = None
+            if self._dirty:
+                await asyncio.to_thread(self.save)
+            await asyncio.sleep(self.retry_interval)
+
+    async def _consume(self, source: AccessSource) -> None:
+        analyzer = self.analyzer
+        checked_at = time.monotonic()
+        async for item in parse_events(self.lines(source)):
+            if item is not None:
+                event, self.position = item
+                analyzer.lines += 1
+                if event is not None:
+                    analyzer.feed(event)
+                self._dirty = True
+                self.last_error = ""
+            now = time.monotonic()
+            if self._dirty and now - self._saved_at >= self.checkpoint_interval:
+                self._saved_at = now
+                await asyncio.to_thread(self.save)
+            if now - checked_at >= self.checkpoint_interval:
+                checked_at = now
+                if self.resolve() != source:
+                    # `vless access-log` switched between the file and the journal
+                    return
+
+
+def access_check(follower: AccessLogFollower, flood_threshold: int) -> Check:
+    """The /doctor check: connection counts and failed-auth floods over the last window."""
+
+    async def check_access() -> CheckOutcome:
+        source = follower.source
+        if source is None:
+            return WARN, "not started yet", ""
+        if source.kind == OFF:
+            return PASS, "access log off (vless access-log on)", ""
+        summary = follower.analyzer.summary()
+        minutes = int(summary.window // 60)
+        text = f"{summary.accepted} accepted, {summary.rejected} rejected in {minutes} min, {summary.active_clients} active clients"
+        detail = [f"source: {source.describe()}"]
+        detail += [f"{email}: {count} connections" for email, count in summary.top_clients]
+        detail += [f"rejected from {address}: {count}" for address, count in summary.rejected_sources]
+        if follower.last_error:
+            return WARN, f"{source.describe()}: {follower.last_error}", "\n".join(detail)
+        floods = [(address, count) for address, count in summary.rejected_sources if count >= flood_threshold]
+        if floods:
+            address, count = floods[0]
+            more = f" and {len(floods) - 1} more" if len(floods) > 1 else ""
+            return WARN, f"failed-auth flood from {address} ({count} in {minutes} min){more}", "\n".join(detail)
+        return PASS, text, "\n".join(detail)
+
+    return Check("access", check_access, timeout=2.0)
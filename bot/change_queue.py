@@ -0,0 +1,156 @@
+import asyncio
+import json
+import os
+import subprocess
+import tempfile
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, List, Optional, Set, Tuple
+
+
+# Change kinds understood by `vless import` (see import_clients in the CLI)
+ADD = "add"
+DELETE = "del"
+BLOCK_TORRENTS = "block_torrents"
+UNBLOCK_TORRENTS = "unblock_torrents"
+# Block-list edits, as `vless block`/`unblock`
+BLOCK = "block"
+UNBLOCK = "unblock"
+
+
+@dataclass(frozen=True)
+class Change:
+    kind: str
+    # Client name for ADD, name or UUID for DELETE; unused for routing changes
+    key: str = ""
+    # UUID chosen by the caller for ADD so it can find its client in the result
+    client_id: str = ""
+    # Domains and ports for BLOCK and UNBLOCK
+    items: Tuple[str, ...] = ()
+
+
+@dataclass
+class Batch:
+    """Changes committed together by one `vless import` run."""
+
+    changes: List[Change]
+    result: subprocess.CompletedProcess
+
+
+@dataclass
+class _Pending:
+    items: List[Tuple[Change, "asyncio.Future[Batch]"]] = field(default_factory=list)
+    timer: Optional["asyncio.Task[None]"] = None
+
+
+Runner = Callable[[List[str]], Awaitable[subprocess.CompletedProcess]]
+
+
+class ChangeQueue:
+    """Coalesces config mutations that arrive within ``window`` seconds.
+
+    Each flush hands the whole batch to `vless import` as one JSON request,
+    so a burst of adds, deletes and routing changes costs one backup, one
+    config write, one ``xray -test`` and at most one restart.
+    """
+
+    def __init__(self, run: Runner, window: float = 1.5, max_batch: int = 200) -> None:
+        self._run = run
+        self.window = max(0.0, window)
+        self.max_batch = max(1, max_batch)
+        self._pending = _Pending()
+        # The loop keeps only weak references to tasks; these hold timers and commits until they finish
+        self._tasks: Set["asyncio.Task[None]"] = set()
+
+    def _spawn(self, coro: Awaitable[None]) -> "asyncio.Task[None]":
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def submit(self, change: Change) -> Batch:
+        """Queue a change and wait for the batch that commits it."""
+        if self._conflicts(change):
+            # A delete of a client that is still waiting to be added must see it in config.json
+            self._flush_now()
+        loop = asyncio.get_running_loop()
+        future: "asyncio.Future[Batch]" = loop.create_future()
+        pending = self._pending
+        pending.items.append((change, future))
+        if len(pending.items) >= self.max_batch:
+            self._flush_now()
+        elif pending.timer is None:
+            pending.timer = self._spawn(self._flush_later(pending))
+        # The batch is committed even if the waiting handler goes away
+        return await asyncio.shield(future)
+
+    async def submit_all(self, changes: List[Change]) -> Batch:
+        """Commit several changes in one batch, together with whatever is pending, now."""
+        if any(self._conflicts(change) for change in changes):
+            self._flush_now()
+        loop = asyncio.get_running_loop()
+        future: "asyncio.Future[Batch]" = loop.create_future()
+        self._pending.items.extend((change, future) for change in changes)
+        self._flush_now()
+        return await asyncio.shield(future)
+
+    def _conflicts(self, change: Change) -> bool:
+        if change.kind != DELETE:
+            return False
+        return any(
+            queued.kind == ADD and change.key in (queued.key, queued.client_id)
+            for queued, _ in self._pending.items
+        )
+
+    def _flush_now(self) -> None:
+        pending = self._pending
+        if not pending.items:
+            return
+        self._pending = _Pending()
+        if pending.timer is not None:
+            pending.timer.cancel()
+        self._spawn(self._commit(pending.items))
+
+    async def _flush_later(self, pending: _Pending) -> None:
+        await asyncio.sleep(self.window)
+        if self._pending is pending:
+            self._pending = _Pending()
+            await self._commit(pending.items)
+
+    async def _commit(self, items: List[Tuple[Change, "asyncio.Future[Batch]"]]) -> None:
+        changes = [change for change, _ in items]
+        fd, path = tempfile.mkstemp(prefix="vless-batch-", suffix=".json")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(build_request(changes), f)
+            result = await self._run(["import", path])
+        except Exception as exc:
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        finally:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        batch = Batch(changes=changes, result=result)
+        for _, future in items:
+            if not future.done():
+                future.set_result(batch)
+
+
+def build_request(changes: List[Change]) -> dict:
+    """Translate queued changes into the `vless import` JSON format."""
+    request: dict = {"add": [], "del": []}
+    for change in changes:
+        if change.kind == ADD:
+            request["add"].append({"name": change.key, "id": change.client_id})
+        elif change.kind == DELETE:
+            request["del"].append(change.key)
+        elif change.kind in (BLOCK_TORRENTS, UNBLOCK_TORRENTS):
+            # Toggles in one batch collapse to the last one
+            request["torrents"] = "block" if change.kind == BLOCK_TORRENTS else "unblock"
+        elif change.kind in (BLOCK, UNBLOCK):
+            # Applied in order, after the torrent toggle
+            request.setdefault("routing", []).append({"op": change.kind, "items": list(change.items)})
+    return request
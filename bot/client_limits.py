@@ -0,0 +1,358 @@
+import asyncio
+import heapq
+import json
+import logging
+import os
+import re
+import threading
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from client_registry import Client
+
+log = logging.getLogger("vless_bot")
+
+# Why a client was removed
+EXPIRED = "expired"
+QUOTA = "quota"
+
+# Longest sleep between deadline checks, so a changed system clock is noticed
+MAX_SLEEP = 3600.0
+
+DURATION_RE = re.compile(r"^(\d+(?:\.\d+)?)\s*(m|min|h|d|w|мин|ч|д|н)$")
+DURATION_UNITS = {"m": 60, "min": 60, "мин": 60, "h": 3600, "ч": 3600, "d": 86400, "д": 86400, "w": 604800, "н": 604800}
+SIZE_RE = re.compile(r"^(\d+(?:\.\d+)?)\s*([kmgt]i?b?|[кмгт]б|b|б)?$")
+SIZE_UNITS = {"k": 1, "к": 1, "m": 2, "м": 2, "g": 3, "г": 3, "t": 4, "т": 4}
+OFF_WORDS = ("off", "none", "no", "0", "-", "нет")
+
+
+@dataclass
+class ClientLimit:
+    id: str
+    email: str = ""
+    # Unix time after which the client is removed
+    expires_at: Optional[float] = None
+    # Bytes (up + down) the client may use from the moment the quota was set
+    quota: Optional[int] = None
+    # Traffic total of the client when the quota was set
+    quota_base: int = 0
+    # Telegram user id of the admin told about the removal
+    owner: Optional[int] = None
+
+    @property
+    def name(self) -> str:
+        return self.email or self.id
+
+    def is_empty(self) -> bool:
+        return self.expires_at is None and self.quota is None
+
+
+@dataclass(frozen=True)
+class Enforcement:
+    limit: ClientLimit
+    reason: str
+    # Quota traffic used at removal time (0 for expiry)
+    used: int = 0
+
+
+class LimitStore:
+    """Expiry times and quotas per client UUID, kept in a JSON file next to config.json.
+
+    Xray rejects unknown keys in client objects, so the limits live in this
+    sidecar file rather than in the config itself.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._limits: Dict[str, ClientLimit] = {}
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        limits = {}
+        for cid, raw in (data.get("clients") or {}).items():
+            if not isinstance(raw, dict):
+                continue
+            limit = ClientLimit(
+                id=cid,
+                email=str(raw.get("email") or ""),
+                expires_at=float(raw["expires_at"]) if raw.get("expires_at") is not None else None,
+                quota=int(raw["quota"]) if raw.get("quota") is not None else None,
+                quota_base=int(raw.get("quota_base") or 0),
+                owner=int(raw["owner"]) if raw.get("owner") is not None else None,
+            )
+            if not limit.is_empty():
+                limits[cid] = limit
+        with self._lock:
+            self._limits = limits
+
+    def save(self) -> None:
+        """Write all limits atomically (blocking; run in a worker thread)."""
+        with self._lock:
+            clients = {cid: {k: v for k, v in asdict(limit).items() if k != "id"} for cid, limit in self._limits.items()}
+        tmp = self.path + ".tmp"
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"clients": clients}, f, indent=1, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def get(self, client_id: str) -> Optional[ClientLimit]:
+        return self._limits.get(client_id)
+
+    def put(self, limit: ClientLimit) -> None:
+        with self._lock:
+            if limit.is_empty():
+                self._limits.pop(limit.id, None)
+            else:
+                self._limits[limit.id] = limit
+
+    def remove(self, client_ids: List[str]) -> bool:
+        with self._lock:
+            return bool([cid for cid in client_ids if self._limits.pop(cid, None) is not None])
+
+    def limits(self) -> List[ClientLimit]:
+        with self._lock:
+            return list(self._limits.values())
+
+    def __len__(self) -> int:
+        return len(self._limits)
+
+
+# Removes clients from the config in one change and returns the UUIDs that
+# were removed; None or an exception means the change failed and is retried
+Remover = Callable[[List[ClientLimit]], Awaitable[Optional[List[str]]]]
+Notifier = Callable[[List[Enforcement]], Awaitable[None]]
+# Traffic total (up + down) of a client email, None without statistics
+Usage = Callable[[str], Optional[int]]
+
+
+class LimitScheduler:
+    """Removes clients when their expiry passes or their quota runs out.
+
+    Deadlines sit in a min-heap of (time, UUID), so the task sleeps until the
+    earliest one instead of scanning every client. It wakes ``window``
+    seconds after that deadline and takes every entry that is due by then:
+    clients expiring close together leave in one config change and one
+    reload. A changed deadline pushes a new entry; the old one is skipped
+    when popped. Quotas have no deadline: each traffic sample is checked
+    against them and an exhausted quota is pushed as due now.
+    """
+
+    def __init__(
+        self,
+        store: LimitStore,
+        remove: Remover,
+        notify: Notifier,
+        usage: Optional[Usage] = None,
+        window: float = 60.0,
+        retry_interval: float = 300.0,
+    ) -> None:
+        self.store = store
+        self.remove = remove
+        self.notify = notify
+        self.usage = usage
+        self.window = max(0.0, window)
+        self.retry_interval = retry_interval
+        self.last_error = ""
+        self._heap: List[Tuple[float, str]] = []
+        # Email -> UUID of the clients with a quota, for the per-sample check
+        self._quotas: Dict[str, str] = {}
+        self._wake = asyncio.Event()
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def load(self) -> None:
+        """Read the store and build the heap (blocking; call before start)."""
+        self.store.load()
+        self._rebuild()
+
+    def _rebuild(self) -> None:
+        self._heap = [(limit.expires_at, limit.id) for limit in self.store.limits() if limit.expires_at is not None]
+        heapq.heapify(self._heap)
+        self._quotas = {limit.email: limit.id for limit in self.store.limits() if limit.quota is not None and limit.email}
+        now = time.time()
+        for limit in self.store.limits():
+            if self._over_quota(limit):
+                heapq.heappush(self._heap, (now, limit.id))
+
+    def _push(self, deadline: float, client_id: str) -> None:
+        heapq.heappush(self._heap, (deadline, client_id))
+        if len(self._heap) > 2 * len(self.store) + 64:
+            # Mostly superseded entries: start over from the store
+            self._rebuild()
+        self._wake.set()
+
+    def used(self, limit: ClientLimit) -> Optional[int]:
+        """Quota traffic used so far, or None without statistics."""
+        if self.usage is None:
+            return None
+        total = self.usage(limit.email)
+        return None if total is None else max(0, total - limit.quota_base)
+
+    def _over_quota(self, limit: ClientLimit) -> bool:
+        if limit.quota is None:
+            return False
+        used = self.used(limit)
+        return used is not None and used >= limit.quota
+
+    async def set_expiry(self, client: Client, expires_at: Optional[float], owner: Optional[int]) -> ClientLimit:
+        current = self.store.get(client.id)
+        limit = ClientLimit(client.id, client.email, expires_at, owner=owner)
+        if current is not None:
+            limit.quota, limit.quota_base = current.quota, current.quota_base
+        self.store.put(limit)
+        await asyncio.to_thread(self.store.save)
+        if expires_at is not None:
+            self._push(expires_at, client.id)
+        return limit
+
+    async def set_quota(self, client: Client, quota: Optional[int], owner: Optional[int]) -> ClientLimit:
+        current = self.store.get(client.id)
+        total = self.usage(client.email) if self.usage is not None and client.email else None
+        limit = ClientLimit(client.id, client.email, quota=quota, quota_base=total or 0, owner=owner)
+        if current is not None:
+            limit.expires_at = current.expires_at
+        self.store.put(limit)
+        await asyncio.to_thread(self.store.save)
+        self._quotas = {k: v for k, v in self._quotas.items() if v != client.id}
+        if quota is not None and client.email:
+            self._quotas[client.email] = client.id
+            if self._over_quota(limit):
+                self._push(time.time(), client.id)
+        return limit
+
+    async def forget(self, client_ids: List[str]) -> None:
+        """Drop the limits of clients deleted by other means; their heap entries go stale."""
+        if self.store.remove(client_ids):
+            await asyncio.to_thread(self.store.save)
+            gone = set(client_ids)
+            self._quotas = {k: v for k, v in self._quotas.items() if v not in gone}
+
+    def check_sample(self, emails: Iterable[str]) -> None:
+        """Check the quotas of clients that just had traffic (called after each stats poll)."""
+        now = time.time()
+        for email in emails:
+            client_id = self._quotas.get(email)
+            if client_id is None:
+                continue
+            limit = self.store.get(client_id)
+            if limit is not None and self._over_quota(limit):
+                self._push(now, client_id)
+
+    def upcoming(self) -> List[ClientLimit]:
+        """All limits, the nearest expiry first and quota-only limits last."""
+        return sorted(self.store.limits(), key=lambda l: (l.expires_at is None, l.expires_at or 0, l.name))
+
+    def next_deadline(self) -> Optional[float]:
+        return self._heap[0][0] if self._heap else None
+
+    def _due(self, now: float) -> List[Enforcement]:
+        due: Dict[str, Enforcement] = {}
+        while self._heap and self._heap[0][0] <= now:
+            _, client_id = heapq.heappop(self._heap)
+            limit = self.store.get(client_id)
+            if limit is None or client_id in due:
+                continue
+            if limit.expires_at is not None and limit.expires_at <= now:
+                due[client_id] = Enforcement(limit, EXPIRED)
+            elif self._over_quota(limit):
+                due[client_id] = Enforcement(limit, QUOTA, self.used(limit) or 0)
+            # else: superseded by a later expiry or a raised quota
+        return list(due.values())
+
+    async def run_due(self, now: Optional[float] = None) -> List[Enforcement]:
+        """Remove every client that is due by ``now`` in one change and notify their admins."""
+        now = time.time() if now is None else now
+        due = self._due(now)
+        if not due:
+            return []
+        try:
+            removed = await self.remove([e.limit for e in due])
+        except Exception as exc:
+            removed = None
+            self.last_error = str(exc) or exc.__class__.__name__
+        if removed is None:
+            if not self.last_error:
+                self.last_error = "config change failed"
+            log.warning("Removing %d expired clients failed (%s); retrying in %.0f s", len(due), self.last_error, self.retry_interval)
+            for e in due:
+                self._push(now + self.retry_interval, e.limit.id)
+            return []
+        self.last_error = ""
+        # Clients missing from the config were deleted by other means: just drop their limits
+        await self.forget([e.limit.id for e in due])
+        removed_ids = set(removed)
+        done = [e for e in due if e.limit.id in removed_ids]
+        if done:
+            try:
+                await self.notify(done)
+            except Exception as exc:
+                log.warning("Expiry notification failed: %s", exc)
+        return done
+
+    async def _run(self) -> None:
+        while True:
+            self._wake.clear()
+            deadline = self.next_deadline()
+            delay = MAX_SLEEP if deadline is None else min(MAX_SLEEP, deadline + self.window - time.time())
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=delay)
+                    continue
+                except asyncio.TimeoutError:
+                    pass
+            await self.run_due()
+
+
+def parse_expiry(text: str, now: Optional[float] = None) -> Optional[float]:
+    """Parse "30d", "12h", "2w", "2025-12-31" or "2025-12-31 18:00" into Unix time; None for "off"."""
+    text = text.strip().lower()
+    if text in OFF_WORDS:
+        return None
+    now = time.time() if now is None else now
+    match = DURATION_RE.match(text)
+    if match:
+        return now + float(match.group(1)) * DURATION_UNITS[match.group(2)]
+    for fmt in ("%Y-%m-%d %H:%M", "%Y-%m-%d", "%d.%m.%Y %H:%M", "%d.%m.%Y"):
+        try:
+            return datetime.strptime(text, fmt).timestamp()
+        except ValueError:
+            continue
+    raise ValueError(f"not a duration or date: {text}")
+
+
+def parse_quota(text: str) -> Optional[int]:
+    """Parse "50GB", "500M", "1.5TiB" (powers of 1024) into bytes; None for "off".
+
+    The unit is required ("10B" for bytes): a bare "10" is more likely
+    meant as gigabytes than as a quota the next stats sample exhausts.
+    """
+    text = text.strip().lower().replace(" ", "")
+    if text in OFF_WORDS:
+        return None
+    match = SIZE_RE.match(text)
+    if not match or not match.group(2):
+        raise ValueError(f"not a size: {text}")
+    unit = match.group(2)[0]
+    value = int(float(match.group(1)) * 1024 ** SIZE_UNITS.get(unit, 0))
+    if value <= 0:
+        raise ValueError(f"not a size: {text}")
+    return value
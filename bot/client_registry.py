@@ -0,0 +1,126 @@
+import json
+import os
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from xray_config import config_files, merge_config
+
+
+@dataclass(frozen=True)
+class Client:
+    id: str
+    email: str = ""
+    flow: str = ""
+
+    @property
+    def name(self) -> str:
+        return self.email or self.id
+
+
+FileSignature = Tuple[int, int, int]
+
+
+class ClientRegistry:
+    """In-memory view of the VLESS clients in Xray's config.json or confdir.
+
+    Each file is parsed once and re-read only when its mtime, inode or size
+    changes, so lookups by UUID or name are plain dict hits. With a confdir
+    a client change re-parses just the fragments that were rewritten.
+    """
+
+    def __init__(self, config_path: str, confdir: str = "") -> None:
+        self.config_path = config_path
+        self.confdir = confdir
+        self.version = 0
+        self._signature: Optional[Tuple[Tuple[str, FileSignature], ...]] = None
+        # Inbounds of every config file, keyed by path, with the signature they were read at
+        self._inbounds: Dict[str, Tuple[FileSignature, List[dict]]] = {}
+        self._clients: List[Client] = []
+        self._by_id: Dict[str, Client] = {}
+        self._by_email: Dict[str, Client] = {}
+        self._lock = threading.Lock()
+
+    def refresh(self) -> bool:
+        """Reload the config files that changed on disk; return True if reloaded."""
+        stats = []
+        for path in config_files(self.config_path, self.confdir):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            stats.append((path, (st.st_mtime_ns, st.st_ino, st.st_size)))
+        if not stats:
+            with self._lock:
+                if self._signature is None and not self._clients:
+                    return False
+                self._signature = None
+                self._inbounds = {}
+                self._set_clients([])
+            return True
+        signature = tuple(stats)
+        if signature == self._signature:
+            return False
+        with self._lock:
+            if signature == self._signature:
+                return False
+            inbounds: Dict[str, Tuple[FileSignature, List[dict]]] = {}
+            for path, file_signature in stats:
+                cached = self._inbounds.get(path)
+                if cached is not None and cached[0] == file_signature:
+                    inbounds[path] = cached
+                    continue
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        config = json.load(f)
+                except (OSError, ValueError):
+                    # Keep serving the last good snapshot; retry on the next call
+                    return False
+                inbounds[path] = (file_signature, config.get("inbounds") or [])
+            merged = merge_config({"inbounds": entries} for _, entries in inbounds.values())
+            self._set_clients(_extract_clients(merged))
+            self._inbounds = inbounds
+            self._signature = signature
+        return True
+
+    def _set_clients(self, clients: List[Client]) -> None:
+        self._clients = clients
+        self._by_id = {c.id: c for c in clients}
+        by_email: Dict[str, Client] = {}
+        for c in clients:
+            if c.email:
+                by_email.setdefault(c.email, c)
+        self._by_email = by_email
+        self.version += 1
+
+    def clients(self) -> List[Client]:
+        self.refresh()
+        return list(self._clients)
+
+    def get(self, key: str) -> Optional[Client]:
+        """Find a client by exact UUID or name (email field)."""
+        self.refresh()
+        key = (key or "").strip()
+        return self._by_id.get(key) or self._by_email.get(key)
+
+    def has_name(self, name: str) -> bool:
+        self.refresh()
+        return name in self._by_email
+
+    def __len__(self) -> int:
+        self.refresh()
+        return len(self._clients)
+
+
+def _extract_clients(config: dict) -> List[Client]:
+    # Clients are duplicated across the 443 and 80 inbounds; keep the first of each id
+    seen: Dict[str, Client] = {}
+    for inbound in config.get("inbounds") or []:
+        if inbound.get("protocol") != "vless":
+            continue
+        for raw in (inbound.get("settings") or {}).get("clients") or []:
+            cid = str(raw.get("id") or "")
+            if not cid or cid in seen:
+                continue
+            seen[cid] = Client(id=cid, email=str(raw.get("email") or ""), flow=str(raw.get("flow") or ""))
+    return list(seen.values())
@@ -0,0 +1,168 @@
+import bisect
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, List, Set, Tuple
+
+from client_registry import Client, ClientRegistry
+
+# How a match was found, best first
+EXACT = 0
+PREFIX = 1
+SUBSTRING = 2
+FUZZY = 3
+
+# Trigram similarity a fuzzy match needs (as pg_trgm's default)
+FUZZY_THRESHOLD = 0.3
+# Past this share of changed clients a full rebuild is cheaper than patching
+REBUILD_SHARE = 0.25
+
+
+@dataclass(frozen=True)
+class Match:
+    client: Client
+    kind: int
+    score: float = 1.0
+
+
+def fold(text: str) -> str:
+    return " ".join(text.casefold().split())
+
+
+def trigrams(text: str) -> Set[str]:
+    """Trigrams of a folded name, padded so that short names and word starts count."""
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _inner_trigrams(text: str) -> Set[str]:
+    # Every one of these occurs in a name that contains ``text``
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class ClientIndex:
+    """Search over the registry's clients by name, name fragment or UUID prefix.
+
+    Folded names and UUIDs sit in one sorted list, so a prefix is a bisect
+    and a walk over the entries that share it. A trigram index finds names
+    containing the query and names that are merely close to it (typos,
+    a transposed letter). The index follows the registry's version: when
+    the config changes only the clients that were added, removed or renamed
+    are patched in, unless so many changed that rebuilding is cheaper.
+    """
+
+    def __init__(self, registry: ClientRegistry) -> None:
+        self.registry = registry
+        self.version = -1
+        self.rebuilds = 0
+        self._clients: Dict[str, Client] = {}
+        # (folded key, UUID) for every name and UUID, sorted
+        self._keys: List[Tuple[str, str]] = []
+        self._grams: Dict[str, Set[str]] = {}
+        self._gram_counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def refresh(self) -> None:
+        self.registry.refresh()
+        if self.registry.version == self.version:
+            return
+        with self._lock:
+            version = self.registry.version
+            if version == self.version:
+                return
+            current = {c.id: c for c in self.registry.clients()}
+            removed = [c for cid, c in self._clients.items() if current.get(cid) != c]
+            added = [c for cid, c in current.items() if self._clients.get(cid) != c]
+            if self.version < 0 or len(removed) + len(added) > REBUILD_SHARE * max(len(current), 1):
+                self._rebuild(current)
+            else:
+                for client in removed:
+                    self._remove(client)
+                for client in added:
+                    self._add(client)
+            self._clients = current
+            self.version = version
+
+    def _entries(self, client: Client) -> List[Tuple[str, str]]:
+        entries = [(client.id.casefold(), client.id)]
+        if client.email:
+            entries.append((fold(client.email), client.id))
+        return entries
+
+    def _rebuild(self, clients: Dict[str, Client]) -> None:
+        self._keys = sorted(entry for client in clients.values() for entry in self._entries(client))
+        self._grams = {}
+        self._gram_counts = {}
+        for client in clients.values():
+            self._index_grams(client)
+        self.rebuilds += 1
+
+    def _index_grams(self, client: Client) -> None:
+        if not client.email:
+            return
+        grams = trigrams(fold(client.email))
+        self._gram_counts[client.id] = len(grams)
+        for gram in grams:
+            self._grams.setdefault(gram, set()).add(client.id)
+
+    def _add(self, client: Client) -> None:
+        for entry in self._entries(client):
+            bisect.insort(self._keys, entry)
+        self._index_grams(client)
+
+    def _remove(self, client: Client) -> None:
+        for entry in self._entries(client):
+            i = bisect.bisect_left(self._keys, entry)
+            if i < len(self._keys) and self._keys[i] == entry:
+                del self._keys[i]
+        if self._gram_counts.pop(client.id, None) is None:
+            return
+        for gram in trigrams(fold(client.email)):
+            ids = self._grams.get(gram)
+            if ids is not None:
+                ids.discard(client.id)
+                if not ids:
+                    del self._grams[gram]
+
+    def search(self, query: str, limit: int = 10) -> List[Match]:
+        """Clients matching ``query``: exact name or UUID, then prefixes, fragments and look-alikes."""
+        self.refresh()
+        q = fold(query)
+        if not q:
+            return []
+        with self._lock:
+            clients = self._clients
+            found: Dict[str, Match] = {}
+
+            def offer(cid: str, kind: int, score: float = 1.0) -> None:
+                best = found.get(cid)
+                if best is None or (kind, -score) < (best.kind, -best.score):
+                    found[cid] = Match(clients[cid], kind, score)
+
+            i = bisect.bisect_left(self._keys, (q, ""))
+            while i < len(self._keys) and self._keys[i][0].startswith(q):
+                key, cid = self._keys[i]
+                offer(cid, EXACT if key == q else PREFIX)
+                i += 1
+
+            # Later stages only find worse matches; skip them once there are enough
+            inner = _inner_trigrams(q)
+            if inner and len(found) < limit:
+                postings = sorted((self._grams.get(g, set()) for g in inner), key=len)
+                for cid in set.intersection(*postings) if postings[0] else ():
+                    if q in fold(clients[cid].email):
+                        offer(cid, SUBSTRING)
+
+            grams = trigrams(q) if len(found) < limit else set()
+            hits = Counter(cid for gram in grams for cid in self._grams.get(gram, ()))
+            for cid, shared in hits.items():
+                score = shared / (len(grams) + self._gram_counts[cid] - shared)
+                if score >= FUZZY_THRESHOLD:
+                    offer(cid, FUZZY, score)
+
+        ranked = sorted(found.values(), key=lambda m: (m.kind, -m.score, len(m.client.name), m.client.name))
+        return ranked[:limit]
+
+    def __len__(self) -> int:
+        self.refresh()
+        return len(self._clients)
@@ -0,0 +1,256 @@
+import asyncio
+import subprocess
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from reality_params import detect_server_ip
+from xray_config import config_files, load_config
+
+
+PASS = "pass"
+WARN = "warn"
+FAIL = "fail"
+
+_SEVERITY = {PASS: 0, WARN: 1, FAIL: 2}
+
+# A check returns (status, one-line summary, raw detail)
+CheckOutcome = Tuple[str, str, str]
+
+
+@dataclass(frozen=True)
+class Check:
+    name: str
+    run: Callable[[], Awaitable[CheckOutcome]]
+    timeout: float = 10.0
+
+
+@dataclass
+class CheckResult:
+    name: str
+    status: str
+    summary: str
+    detail: str = ""
+    duration: float = 0.0
+
+
+@dataclass
+class Report:
+    results: List[CheckResult]
+    finished_at: float
+    duration: float
+
+    @property
+    def status(self) -> str:
+        return max((r.status for r in self.results), key=_SEVERITY.__getitem__, default=PASS)
+
+
+class Diagnostics:
+    """Runs every check concurrently, each under its own timeout.
+
+    A finished report is reused for ``ttl`` seconds, and callers arriving
+    while a sweep is in progress wait for that sweep instead of starting
+    another one.
+    """
+
+    def __init__(self, checks: List[Check], ttl: float = 30.0) -> None:
+        self.checks = checks
+        self.ttl = ttl
+        self.last: Optional[Report] = None
+        self._inflight: Optional["asyncio.Task[Report]"] = None
+
+    def cached(self) -> Optional[Report]:
+        if self.last is not None and time.time() - self.last.finished_at < self.ttl:
+            return self.last
+        return None
+
+    async def run(self, force: bool = False) -> Report:
+        if not force:
+            report = self.cached()
+            if report is not None:
+                return report
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.create_task(self._sweep())
+        # Shielded: one admin giving up must not cancel the sweep others wait on
+        return await asyncio.shield(self._inflight)
+
+    async def _sweep(self) -> Report:
+        started = time.monotonic()
+        results = await asyncio.gather(*(_run_check(check) for check in self.checks))
+        report = Report(results=list(results), finished_at=time.time(), duration=time.monotonic() - started)
+        self.last = report
+        return report
+
+
+async def _run_check(check: Check) -> CheckResult:
+    started = time.monotonic()
+    try:
+        status, summary, detail = await asyncio.wait_for(check.run(), timeout=check.timeout)
+    except asyncio.TimeoutError:
+        status, summary, detail = FAIL, f"timed out after {check.timeout:g}s", ""
+    except Exception as exc:
+        status, summary, detail = FAIL, f"check failed: {exc}", ""
+    return CheckResult(check.name, status, summary, detail, time.monotonic() - started)
+
+
+async def run_command(*cmd: str) -> Tuple[int, str]:
+    """Run a command and return (exit code, combined output); the caller bounds the time."""
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+    except FileNotFoundError:
+        return 127, f"{cmd[0]}: command not found"
+    try:
+        out, _ = await proc.communicate()
+    except asyncio.CancelledError:
+        if proc.returncode is None:
+            proc.kill()
+            await asyncio.shield(proc.wait())
+        raise
+    return proc.returncode or 0, out.decode("utf-8", errors="replace").strip()
+
+
+async def port_open(host: str, port: int, timeout: float = 2.0) -> bool:
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return True
+
+
+@dataclass
+class RestartHistory:
+    """Restart-to-ready times recorded by `vless restart` in its restart log."""
+
+    count: int
+    failures: int
+    last_ms: int
+    last_status: str
+    last_at: float
+    p50_ms: Optional[int] = None
+    p95_ms: Optional[int] = None
+
+
+def read_restart_history(path: str, limit: int = 100) -> Optional[RestartHistory]:
+    """Summarize the last ``limit`` lines of "<unix time> <ms> <ok|timeout|failed>"."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            lines = f.readlines()[-limit:]
+    except OSError:
+        return None
+    entries = []
+    for line in lines:
+        parts = line.split()
+        if len(parts) == 3 and parts[0].isdigit() and parts[1].isdigit():
+            entries.append((float(parts[0]), int(parts[1]), parts[2]))
+    if not entries:
+        return None
+    ready = sorted(ms for _, ms, status in entries if status == "ok")
+    last_at, last_ms, last_status = entries[-1]
+    history = RestartHistory(
+        count=len(entries),
+        failures=len(entries) - len(ready),
+        last_ms=last_ms,
+        last_status=last_status,
+        last_at=last_at,
+    )
+    if ready:
+        history.p50_ms = ready[int((len(ready) - 1) * 0.50)]
+        history.p95_ms = ready[int((len(ready) - 1) * 0.95)]
+    return history
+
+
+def _inbound_ports(files: List[str]) -> List[int]:
+    try:
+        config = load_config(files)
+    except (OSError, ValueError):
+        return [443, 80]
+    ports = [int(i["port"]) for i in config.get("inbounds") or [] if i.get("protocol") == "vless" and str(i.get("port", "")).isdigit()]
+    return ports or [443, 80]
+
+
+def default_checks(
+    config_path: str,
+    api_server: str = "127.0.0.1:10085",
+    restart_log: str = "",
+    service: str = "xray",
+    confdir: str = "",
+) -> List[Check]:
+    """The checks behind /doctor: service, config, ports, API, logs, public IP and restart times."""
+
+    async def check_service() -> CheckOutcome:
+        (_, state), (_, status) = await asyncio.gather(
+            run_command("systemctl", "is-active", service),
+            run_command("systemctl", "status", service, "--no-pager", "-l", "-n", "0"),
+        )
+        state = state.splitlines()[-1] if state else "unknown"
+        return (PASS if state == "active" else FAIL), state, status
+
+    async def check_config() -> CheckOutcome:
+        files = config_files(config_path, confdir)
+        if files == [config_path]:
+            rc, out = await run_command("xray", "-test", "-config", config_path)
+        else:
+            rc, out = await run_command("xray", "-test", "-confdir", confdir)
+        if rc == 127:
+            return WARN, "xray not found; config not tested", out
+        return (PASS if rc == 0 else FAIL), ("valid" if rc == 0 else "xray -test failed"), out
+
+    async def check_ports() -> CheckOutcome:
+        ports = _inbound_ports(config_files(config_path, confdir))
+        states = await asyncio.gather(*(port_open("127.0.0.1", port) for port in ports))
+        listening = [str(p) for p, ok in zip(ports, states) if ok]
+        closed = [str(p) for p, ok in zip(ports, states) if not ok]
+        status = PASS if not closed else (WARN if listening else FAIL)
+        summary = ", ".join([f"{p} ✓" for p in listening] + [f"{p} ✗" for p in closed])
+        return status, summary, ""
+
+    async def check_api() -> CheckOutcome:
+        host, _, port = api_server.rpartition(":")
+        if await port_open(host or "127.0.0.1", int(port or 10085)):
+            return PASS, f"listening on {api_server}", ""
+        return WARN, f"not reachable on {api_server}; changes fall back to restarts", ""
+
+    async def check_logs() -> CheckOutcome:
+        rc, out = await run_command("journalctl", "-u", service, "-n", "30", "--no-pager")
+        if rc != 0:
+            return WARN, "journal unavailable", out
+        errors = [line for line in out.splitlines() if "error" in line.lower() or "failed" in line.lower()]
+        if errors:
+            return WARN, f"{len(errors)} error lines in the last 30", out
+        return PASS, "no recent errors", out
+
+    async def check_public_ip() -> CheckOutcome:
+        ip = await asyncio.to_thread(detect_server_ip, 4.0)
+        return (PASS, ip, "") if ip else (WARN, "unavailable", "")
+
+    async def check_restarts() -> CheckOutcome:
+        history = read_restart_history(restart_log) if restart_log else None
+        if history is None:
+            return PASS, "no restarts recorded", ""
+        detail = f"{history.count} restarts, {history.failures} timed out or failed"
+        if history.last_status != "ok":
+            return WARN, f"last restart {history.last_status} after {history.last_ms / 1000:.1f}s", detail
+        summary = f"last ready in {history.last_ms / 1000:.1f}s"
+        if history.p95_ms is not None:
+            summary += f", p95 {history.p95_ms / 1000:.1f}s"
+        return PASS, summary, detail
+
+    return [
+        Check("service", check_service, timeout=5.0),
+        Check("config", check_config, timeout=10.0),
+        Check("ports", check_ports, timeout=5.0),
+        Check("api", check_api, timeout=5.0),
+        Check("logs", check_logs, timeout=5.0),
+        Check("public_ip", check_public_ip, timeout=6.0),
+        Check("restarts", check_restarts, timeout=2.0),
+    ]
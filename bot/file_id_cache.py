@@ -0,0 +1,65 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import Optional
+
+
+class FileIdCache:
+    """Persistent map of (client UUID, port) -> Telegram file_id of its QR photo.
+
+    Each entry remembers a hash of the URL it was rendered from, so the
+    cached photo is dropped as soon as the link parameters change.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        except (OSError, sqlite3.Error):
+            # Unwritable state dir: keep the cache for this process only
+            self._db = sqlite3.connect(":memory:", check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS qr_file_ids ("
+                " client_id TEXT NOT NULL,"
+                " port INTEGER NOT NULL,"
+                " url_hash TEXT NOT NULL,"
+                " file_id TEXT NOT NULL,"
+                " PRIMARY KEY (client_id, port))"
+            )
+
+    @staticmethod
+    def url_hash(url: str) -> str:
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def get(self, client_id: str, port: int, url: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT url_hash, file_id FROM qr_file_ids WHERE client_id = ? AND port = ?",
+                (client_id, port),
+            ).fetchone()
+            if row is None:
+                return None
+            if row[0] != self.url_hash(url):
+                self._db.execute("DELETE FROM qr_file_ids WHERE client_id = ? AND port = ?", (client_id, port))
+                return None
+            return row[1]
+
+    def put(self, client_id: str, port: int, url: str, file_id: str) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO qr_file_ids (client_id, port, url_hash, file_id) VALUES (?, ?, ?, ?)",
+                (client_id, port, self.url_hash(url), file_id),
+            )
+
+    def forget(self, client_id: str, port: int) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM qr_file_ids WHERE client_id = ? AND port = ?", (client_id, port))
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
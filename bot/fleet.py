@@ -0,0 +1,373 @@
+import asyncio
+import json
+import os
+import re
+import shlex
+import subprocess
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from single_flight import SingleFlight
+from vless_exec import MUTATING_COMMANDS, TIMEOUT_EXIT_CODE
+
+try:
+    import asyncssh
+except ImportError:  # pragma: no cover - optional dependency
+    asyncssh = None
+
+
+ALL = "all"
+
+NODE_NAME_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]{0,31}$")
+
+# ssh exits with 255 when the connection itself fails
+SSH_ERROR_EXIT_CODE = 255
+
+# Runs the vless CLI on the bot's own server: (args, timeout) -> result
+LocalRunner = Callable[[List[str], Optional[float]], Awaitable[subprocess.CompletedProcess]]
+
+
+@dataclass(frozen=True)
+class Node:
+    name: str
+    host: str
+    port: int = 22
+    user: str = "root"
+    key_file: str = ""
+    vless_path: str = "/usr/local/bin/vless"
+
+    def command(self, args: List[str]) -> str:
+        """Remote shell command line for ``vless <args>``, quoted for the login shell."""
+        argv = [self.vless_path] + list(args)
+        if self.user != "root":
+            # The CLI needs root; -n fails instead of waiting for a password
+            argv = ["sudo", "-n"] + argv
+        return shlex.join(argv)
+
+
+def parse_nodes(data: dict) -> List[Node]:
+    nodes: List[Node] = []
+    seen = set()
+    for entry in data.get("nodes", []):
+        name = str(entry.get("name", "")).strip()
+        host = str(entry.get("host", "")).strip()
+        if not NODE_NAME_RE.match(name) or name == ALL:
+            raise ValueError(f"invalid node name: {name!r}")
+        if not host:
+            raise ValueError(f"node {name}: host is required")
+        if name in seen:
+            raise ValueError(f"duplicate node name: {name}")
+        seen.add(name)
+        nodes.append(Node(
+            name=name,
+            host=host,
+            port=int(entry.get("port", 22)),
+            user=str(entry.get("user", "root")),
+            key_file=str(entry.get("key", "")),
+            vless_path=str(entry.get("vless", "/usr/local/bin/vless")),
+        ))
+    return nodes
+
+
+class NodeRegistry:
+    """Remote servers from a JSON file, re-read whenever the file changes.
+
+    The file looks like ``{"nodes": [{"name": "de1", "host": "203.0.113.5"}]}``
+    with optional ``port``, ``user``, ``key`` and ``vless`` per node. A missing
+    file means no remote nodes; a broken one keeps the last good list.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._stamp: Optional[Tuple[int, int]] = None
+        self._nodes: Dict[str, Node] = {}
+        self.error = ""
+
+    def _reload(self) -> None:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            self._stamp, self._nodes, self.error = None, {}, ""
+            return
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp == self._stamp:
+            return
+        self._stamp = stamp
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                nodes = parse_nodes(json.load(f))
+        except (OSError, ValueError, TypeError, AttributeError) as exc:
+            self.error = f"{self.path}: {exc}"
+            return
+        self._nodes = {node.name: node for node in nodes}
+        self.error = ""
+
+    def nodes(self) -> List[Node]:
+        self._reload()
+        return list(self._nodes.values())
+
+    def get(self, name: str) -> Optional[Node]:
+        self._reload()
+        return self._nodes.get(name)
+
+
+class OpenSshTransport:
+    """Runs commands through ssh(1), one multiplexed master connection per node.
+
+    The first command to a node starts a background master (``ControlPersist``);
+    later commands open a channel on it instead of a new TCP and SSH handshake.
+    """
+
+    def __init__(self, control_dir: str, connect_timeout: float = 10.0, persist: int = 600, ssh_path: str = "ssh") -> None:
+        self.control_dir = control_dir
+        self.connect_timeout = connect_timeout
+        self.persist = persist
+        self.ssh_path = ssh_path
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    def _socket(self, node: Node) -> str:
+        return os.path.join(self.control_dir, node.name)
+
+    def _argv(self, node: Node, *extra: str) -> List[str]:
+        argv = [
+            self.ssh_path,
+            "-o", "BatchMode=yes",
+            "-o", f"ConnectTimeout={int(self.connect_timeout)}",
+            "-o", "ServerAliveInterval=30",
+            "-o", f"ControlPath={self._socket(node)}",
+            "-p", str(node.port),
+        ]
+        if node.key_file:
+            argv += ["-i", node.key_file]
+        return argv + list(extra) + [f"{node.user}@{node.host}"]
+
+    async def _ensure_master(self, node: Node) -> None:
+        lock = self._locks.setdefault(node.name, asyncio.Lock())
+        async with lock:
+            if os.path.exists(self._socket(node)):
+                return
+            os.makedirs(self.control_dir, mode=0o700, exist_ok=True)
+            # -f returns once authenticated; the master keeps no pipe of ours open.
+            # If it fails, the command below connects on its own and reports why.
+            proc = await asyncio.create_subprocess_exec(
+                *self._argv(node, "-M", "-N", "-f", "-o", f"ControlPersist={self.persist}"),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            try:
+                await asyncio.wait_for(proc.wait(), timeout=self.connect_timeout + 5)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+
+    async def run(self, node: Node, args: List[str], timeout: float) -> subprocess.CompletedProcess:
+        await self._ensure_master(node)
+        cmd = self._argv(node, "-o", "ControlMaster=no") + [node.command(args)]
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        try:
+            out, _ = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            return subprocess.CompletedProcess(cmd, TIMEOUT_EXIT_CODE, stdout=f"Command timed out after {timeout:g}s on {node.name}")
+        except asyncio.CancelledError:
+            proc.kill()
+            await asyncio.shield(proc.wait())
+            raise
+        if proc.returncode == SSH_ERROR_EXIT_CODE:
+            # A dead master leaves its socket behind; start a new one next time
+            try:
+                os.unlink(self._socket(node))
+            except OSError:
+                pass
+        return subprocess.CompletedProcess(cmd, proc.returncode, stdout=out.decode("utf-8", errors="replace"))
+
+    def is_connected(self, node: Node) -> bool:
+        return os.path.exists(self._socket(node))
+
+    async def close(self) -> None:
+        if not os.path.isdir(self.control_dir):
+            return
+        for name in os.listdir(self.control_dir):
+            proc = await asyncio.create_subprocess_exec(
+                self.ssh_path, "-o", f"ControlPath={os.path.join(self.control_dir, name)}", "-O", "exit", name,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            await proc.wait()
+
+
+class AsyncSshTransport:
+    """Keeps one asyncssh connection per node open and runs each command on a new channel."""
+
+    def __init__(self, connect_timeout: float = 10.0, known_hosts: Optional[str] = None) -> None:
+        self.connect_timeout = connect_timeout
+        self.known_hosts = known_hosts
+        self._conns: Dict[str, "asyncssh.SSHClientConnection"] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    async def _connection(self, node: Node) -> "asyncssh.SSHClientConnection":
+        lock = self._locks.setdefault(node.name, asyncio.Lock())
+        async with lock:
+            conn = self._conns.get(node.name)
+            if conn is None:
+                options = {}
+                if self.known_hosts:
+                    options["known_hosts"] = self.known_hosts
+                conn = await asyncio.wait_for(asyncssh.connect(
+                    node.host,
+                    port=node.port,
+                    username=node.user,
+                    client_keys=[node.key_file] if node.key_file else None,
+                    keepalive_interval=30,
+                    **options,
+                ), timeout=self.connect_timeout)
+                self._conns[node.name] = conn
+            return conn
+
+    def _drop(self, node: Node) -> None:
+        conn = self._conns.pop(node.name, None)
+        if conn is not None:
+            conn.close()
+
+    async def run(self, node: Node, args: List[str], timeout: float) -> subprocess.CompletedProcess:
+        command = node.command(args)
+        deadline = time.monotonic() + timeout
+        for attempt in (1, 2):
+            try:
+                conn = await self._connection(node)
+                res = await asyncio.wait_for(
+                    conn.run(command, check=False, stderr=asyncssh.STDOUT),
+                    timeout=max(0.1, deadline - time.monotonic()),
+                )
+            except asyncio.TimeoutError:
+                return subprocess.CompletedProcess(command, TIMEOUT_EXIT_CODE, stdout=f"Command timed out after {timeout:g}s on {node.name}")
+            except (OSError, asyncssh.Error) as exc:
+                self._drop(node)
+                # A pooled connection may have died since its last use: retry once on a fresh one
+                if attempt == 1 and not isinstance(exc, asyncssh.PermissionDenied):
+                    continue
+                return subprocess.CompletedProcess(command, SSH_ERROR_EXIT_CODE, stdout=f"ssh {node.host}: {exc}")
+            code = res.exit_status if res.exit_status is not None else SSH_ERROR_EXIT_CODE
+            return subprocess.CompletedProcess(command, code, stdout=str(res.stdout or ""))
+        raise AssertionError("unreachable")
+
+    def is_connected(self, node: Node) -> bool:
+        return node.name in self._conns
+
+    async def close(self) -> None:
+        conns = list(self._conns.values())
+        self._conns.clear()
+        for conn in conns:
+            conn.close()
+        for conn in conns:
+            await conn.wait_closed()
+
+
+def default_transport(control_dir: str, connect_timeout: float = 10.0):
+    """asyncssh when installed, otherwise the system ssh client with connection sharing."""
+    if asyncssh is not None:
+        return AsyncSshTransport(connect_timeout=connect_timeout)
+    return OpenSshTransport(control_dir, connect_timeout=connect_timeout)
+
+
+@dataclass
+class NodeResult:
+    node: str
+    result: subprocess.CompletedProcess
+    elapsed: float
+
+    @property
+    def ok(self) -> bool:
+        return self.result.returncode == 0
+
+
+class Fleet:
+    """The bot's own server plus the remote nodes, addressed by name.
+
+    ``fan_out`` runs one vless command on several nodes at once, with the
+    usual per-command timeout on each, and yields results in the order
+    the nodes finish. A read-only command already running on a node (two
+    admins asking for `/doctor all`) is joined rather than sent again.
+    """
+
+    def __init__(
+        self,
+        nodes: NodeRegistry,
+        transport,
+        local_run: LocalRunner,
+        timeout_for: Callable[[List[str]], float],
+        local_name: str = "local",
+        max_parallel: int = 16,
+    ) -> None:
+        self.nodes = nodes
+        self.transport = transport
+        self.local_run = local_run
+        self.timeout_for = timeout_for
+        self.local_name = local_name
+        self._parallel = asyncio.Semaphore(max(1, max_parallel))
+        self.reads = SingleFlight("fleet")
+
+    def names(self) -> List[str]:
+        return [self.local_name] + [n.name for n in self.nodes.nodes() if n.name != self.local_name]
+
+    def resolve(self, target: str) -> List[str]:
+        """Node names for "all", one name or a comma-separated list; KeyError for unknown ones."""
+        known = self.names()
+        if target.strip().lower() == ALL:
+            return known
+        names = []
+        for part in target.split(","):
+            name = part.strip()
+            if not name:
+                continue
+            if name not in known:
+                raise KeyError(name)
+            if name not in names:
+                names.append(name)
+        if not names:
+            raise KeyError(target)
+        return names
+
+    async def run(self, name: str, args: List[str]) -> NodeResult:
+        timeout = self.timeout_for(args)
+        start = time.monotonic()
+        if name == self.local_name:
+            res = await self.local_run(args, timeout)
+        else:
+            node = self.nodes.get(name)
+            if node is None:
+                res = subprocess.CompletedProcess(args, 1, stdout=f"Unknown node: {name}")
+            elif args and args[0] in MUTATING_COMMANDS:
+                res = await self._run_remote(node, args, timeout)
+            else:
+                res = await self.reads.do((name, tuple(args)), lambda: self._run_remote(node, args, timeout))
+        return NodeResult(name, res, time.monotonic() - start)
+
+    async def _run_remote(self, node: Node, args: List[str], timeout: float) -> subprocess.CompletedProcess:
+        async with self._parallel:
+            try:
+                return await self.transport.run(node, args, timeout)
+            except OSError as exc:
+                # e.g. no ssh client installed
+                return subprocess.CompletedProcess(args, SSH_ERROR_EXIT_CODE, stdout=f"{node.name}: {exc}")
+
+    async def fan_out(self, names: List[str], args: List[str]) -> AsyncIterator[NodeResult]:
+        tasks = [asyncio.ensure_future(self.run(name, args)) for name in names]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def close(self) -> None:
+        await self.transport.close()
@@ -0,0 +1,228 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+# Telegram allows about 30 messages a second overall, one a second in a chat
+# (short bursts are tolerated) and 20 a minute in a group
+GLOBAL_RATE = 25.0
+CHAT_RATE = 1.0
+CHAT_BURST = 3.0
+GROUP_RATE = 20 / 60
+
+# Requests that post nothing into a chat: only the global bucket applies
+UNTHROTTLED = {
+    "answerCallbackQuery", "sendChatAction", "getMe", "getFile", "setWebhook",
+    "deleteWebhook", "getWebhookInfo", "setMyCommands", "close", "logOut",
+}
+
+# A queued sendMessage with only these parameters may absorb later texts to the same chat
+MERGEABLE_KEYS = {"chat_id", "text", "parse_mode", "disable_notification", "protect_content"}
+# Texts longer than this are sent on their own; Telegram's limit for a merged one
+MERGE_SMALL = 1024
+MERGE_LIMIT = 4096
+MERGE_SEPARATOR = "\n\n"
+
+# Prune idle per-chat buckets once there are this many
+MAX_LANES = 1024
+
+# Called with (event, Bot API method, seconds): "wait" before a request goes
+# out, "retry" after a RetryAfter, "merge" when a text joined a queued one
+SendObserver = Callable[[str, str, float], None]
+
+
+class TokenBucket:
+    """``rate`` tokens a second, up to ``capacity`` saved up; waiters are served in arrival order."""
+
+    def __init__(self, rate: float, capacity: float = 1.0) -> None:
+        self.rate = max(rate, 1e-6)
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.blocked_until = 0.0
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, n: float = 1.0) -> float:
+        """Take ``n`` tokens, sleeping until they are there; return the seconds waited."""
+        n = min(n, self.capacity)
+        start = time.monotonic()
+        # Holding the lock while sleeping keeps the queue first come, first served
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                elif self.tokens >= n:
+                    self.tokens -= n
+                    break
+                else:
+                    await asyncio.sleep((n - self.tokens) / self.rate)
+        return time.monotonic() - start
+
+    def pause(self, seconds: float) -> None:
+        """Hold every request for ``seconds`` (Telegram asked to retry later)."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+    def idle(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity and not self._lock.locked()
+
+
+@dataclass
+class _Queued:
+    """A sendMessage waiting for its token that later texts may join."""
+
+    data: Dict[str, Any]
+    future: "asyncio.Future[Any]"
+    parts: int = 1
+
+
+class _Lane:
+    def __init__(self, bucket: TokenBucket) -> None:
+        self.bucket = bucket
+        self.open: Optional[_Queued] = None
+
+
+class FlowControl(BaseRateLimiter[Dict[str, Any]]):
+    """Outbound flow control for the bot's Bot API requests.
+
+    Every request to a chat takes a token from that chat's bucket and then
+    from a global one, so replies to one busy admin cannot starve the
+    others and bursts stay under Telegram's flood limits instead of
+    failing. A RetryAfter pauses the bucket it hit and the request is sent
+    again, up to ``max_retries`` times. A short text that has to wait for its
+    token is kept open: further short texts to the same chat, with the same
+    formatting and no buttons, are appended to it and go out as one
+    message. Anything else sent to the chat closes it, so order is kept.
+    Pass ``rate_limit_args={"merge": False}`` for a message that is edited
+    later.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = GLOBAL_RATE,
+        chat_rate: float = CHAT_RATE,
+        max_retries: int = 3,
+        observer: Optional[SendObserver] = None,
+    ) -> None:
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.max_retries = max(0, max_retries)
+        self.observer = observer
+        self._global = TokenBucket(global_rate, global_rate)
+        self._lanes: Dict[Union[int, str], _Lane] = {}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self._lanes.clear()
+
+    def _lane(self, chat_id: Union[int, str]) -> _Lane:
+        lane = self._lanes.get(chat_id)
+        if lane is None:
+            if len(self._lanes) >= MAX_LANES:
+                self._lanes = {k: v for k, v in self._lanes.items() if v.open is not None or not v.bucket.idle()}
+            # Groups and channels have negative ids (or an @username)
+            group = not isinstance(chat_id, int) or chat_id < 0
+            lane = _Lane(TokenBucket(GROUP_RATE if group else self.chat_rate, CHAT_BURST))
+            self._lanes[chat_id] = lane
+        return lane
+
+    @staticmethod
+    def _mergeable(endpoint: str, data: Dict[str, Any], rate_limit_args: Optional[Dict[str, Any]]) -> bool:
+        if endpoint != "sendMessage" or (rate_limit_args or {}).get("merge") is False:
+            return False
+        text = data.get("text")
+        return isinstance(text, str) and len(text) <= MERGE_SMALL and set(data) <= MERGEABLE_KEYS
+
+    @staticmethod
+    def _joins(queued: Dict[str, Any], data: Dict[str, Any]) -> bool:
+        if any(queued.get(key) != data.get(key) for key in MERGEABLE_KEYS - {"text"}):
+            return False
+        return len(queued["text"]) + len(MERGE_SEPARATOR) + len(data["text"]) <= MERGE_LIMIT
+
+    def _observe(self, event: str, endpoint: str, seconds: float) -> None:
+        if self.observer is not None:
+            self.observer(event, endpoint, seconds)
+
+    async def process_request(
+        self,
+        callback: Callable[..., Awaitable[Any]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Dict[str, Any]],
+    ) -> Any:
+        chat_id = data.get("chat_id")
+        if endpoint in UNTHROTTLED or chat_id is None:
+            self._observe("wait", endpoint, await self._global.acquire())
+            return await self._call(callback, args, kwargs, endpoint, self._global)
+
+        lane = self._lane(chat_id)
+        queued: Optional[_Queued] = None
+        if self._mergeable(endpoint, data, rate_limit_args):
+            target = lane.open
+            if target is not None and self._joins(target.data, data):
+                # args holds the same dict, so the queued request sends the joined text
+                target.data["text"] += MERGE_SEPARATOR + data["text"]
+                target.parts += 1
+                self._observe("merge", endpoint, 0.0)
+                return await asyncio.shield(target.future)
+            queued = _Queued(data, asyncio.get_running_loop().create_future())
+        # Nothing sent after this request may be merged into an earlier one
+        lane.open = queued
+
+        try:
+            cost = len(data.get("media") or ()) or 1
+            waited = await lane.bucket.acquire(cost)
+            waited += await self._global.acquire()
+            if lane.open is queued:
+                lane.open = None
+            self._observe("wait", endpoint, waited)
+            result = await self._call(callback, args, kwargs, endpoint, lane.bucket)
+        except BaseException as exc:
+            if lane.open is queued:
+                lane.open = None
+            if queued is not None and queued.parts > 1 and not queued.future.done():
+                if isinstance(exc, asyncio.CancelledError):
+                    queued.future.cancel()
+                else:
+                    queued.future.set_exception(exc)
+            raise
+        if queued is not None and not queued.future.done():
+            queued.future.set_result(result)
+        return result
+
+    async def _call(
+        self,
+        callback: Callable[..., Awaitable[Any]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        bucket: TokenBucket,
+    ) -> Any:
+        attempt = 0
+        while True:
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as exc:
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                retry_after = exc.retry_after
+                delay = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+                self._observe("retry", endpoint, delay)
+                bucket.pause(delay)
+                await bucket.acquire()
+
@@ -0,0 +1,310 @@
+import contextvars
+import json
+import logging
+import secrets
+import time
+from bisect import bisect_left
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+from telegram.ext import Application, BaseHandler, CallbackQueryHandler, CommandHandler
+from telegram.request import HTTPXRequest
+
+
+# Seconds; covers a cached /list page up to a slow `vless import`
+DEFAULT_BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+log = logging.getLogger("vless_bot")
+trace_log = logging.getLogger("vless_bot.trace")
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *values: str, amount: float = 1.0) -> None:
+        self._values[values] = self._values.get(values, 0.0) + amount
+
+    def value(self, *values: str) -> float:
+        return self._values.get(values, 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for values, total in sorted(self._values.items()):
+            lines.append(f"{self.name}{_labels(self.labels, values)} {_number(total)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> (per-bucket counts with a trailing +Inf slot, sum)
+        self._series: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *values: str) -> None:
+        series = self._series.get(values)
+        if series is None:
+            series = self._series[values] = ([0] * (len(self.buckets) + 1), [0.0])
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1][0] += value
+
+    def count(self, *values: str) -> int:
+        series = self._series.get(values)
+        return sum(series[0]) if series else 0
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for values, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="' + _number(bound) + '"'
+                lines.append(f"{self.name}_bucket{_labels(self.labels, values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, values)} {_number(total[0])}")
+            lines.append(f"{self.name}_count{_labels(self.labels, values)} {cumulative}")
+        return lines
+
+
+@dataclass
+class Trace:
+    """Spans collected while one update is handled; logged as a single JSON line."""
+
+    trace_id: str
+    handler: str
+    user_id: Optional[int]
+    started: float
+    spans: List[Dict[str, Any]] = field(default_factory=list)
+
+
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("vless_trace", default=None)
+
+
+def _add_span(kind: str, **fields: Any) -> None:
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.spans.append({"kind": kind, "at_ms": round((time.monotonic() - trace.started) * 1000, 1), **fields})
+
+
+class Metrics:
+    """In-process metrics of the bot, rendered in the Prometheus text format.
+
+    Everything runs on the event loop, so plain dicts need no locking.
+    """
+
+    def __init__(self) -> None:
+        self.started_at = time.time()
+        self.handler_seconds = Histogram("vless_bot_handler_duration_seconds", "Time spent handling one update.", ("handler",))
+        self.handler_errors = Counter("vless_bot_handler_errors_total", "Exceptions that escaped a handler.", ("handler", "error"))
+        self.suppressed_errors = Counter("vless_bot_suppressed_errors_total", "Exceptions a handler caught and recovered from.", ("where", "error"))
+        self.vless_seconds = Histogram("vless_cli_duration_seconds", "Run time of vless CLI processes.", ("command",))
+        self.vless_wait_seconds = Histogram("vless_cli_queue_wait_seconds", "Time vless commands waited for the executor pool or write lane.", ("command",))
+        self.vless_exits = Counter("vless_cli_exit_total", "vless CLI runs by exit code (124 is a timeout).", ("command", "code"))
+        self.telegram_seconds = Histogram("vless_telegram_api_duration_seconds", "Bot API request latency.", ("method",))
+        self.telegram_errors = Counter("vless_telegram_api_errors_total", "Bot API requests that failed or returned an HTTP error.", ("method", "error"))
+        self.qr_seconds = Histogram("vless_bot_qr_seconds", "Time to get a QR PNG from memory or render it (spill dir included).", ("source",))
+        self.send_wait_seconds = Histogram("vless_telegram_send_wait_seconds", "Time Bot API requests waited for the outbound rate limits.", ("method",))
+        self.send_events = Counter("vless_telegram_flow_total", "Outbound flow control: retry after a RetryAfter, merge of a text into a queued message.", ("event", "method"))
+        self.shared_results = Counter("vless_bot_shared_results_total", "Calls answered by an identical call already in flight.", ("what",))
+        self._gauges: List[Tuple[str, str, Callable[[], float]]] = []
+
+    def gauge(self, name: str, help_text: str, read: Callable[[], float]) -> None:
+        """Register a gauge whose value is read at scrape time."""
+        self._gauges.append((name, help_text, read))
+
+    def render(self) -> str:
+        lines = [
+            "# HELP process_start_time_seconds Start time of the bot since the Unix epoch.",
+            "# TYPE process_start_time_seconds gauge",
+            f"process_start_time_seconds {_number(self.started_at)}",
+        ]
+        for name, help_text, read in self._gauges:
+            try:
+                value = read()
+            except Exception:
+                continue
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {_number(value)}"]
+        for metric in (
+            self.handler_seconds,
+            self.handler_errors,
+            self.suppressed_errors,
+            self.vless_seconds,
+            self.vless_wait_seconds,
+            self.vless_exits,
+            self.telegram_seconds,
+            self.telegram_errors,
+            self.qr_seconds,
+            self.send_wait_seconds,
+            self.send_events,
+            self.shared_results,
+        ):
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+    # --- hooks ---
+
+    def observe_vless(self, command: str, waited: float, elapsed: float, returncode: int) -> None:
+        """VlessExecutor observer: one finished CLI process."""
+        self.vless_wait_seconds.observe(waited, command)
+        self.vless_seconds.observe(elapsed, command)
+        self.vless_exits.inc(command, str(returncode))
+        _add_span("vless", command=command, wait_ms=round(waited * 1000, 1), ms=round(elapsed * 1000, 1), code=returncode)
+
+    def observe_telegram(self, method: str, elapsed: float, error: str = "") -> None:
+        self.telegram_seconds.observe(elapsed, method)
+        if error:
+            self.telegram_errors.inc(method, error)
+        _add_span("telegram", method=method, ms=round(elapsed * 1000, 1), **({"error": error} if error else {}))
+
+    def observe_qr(self, source: str, elapsed: float) -> None:
+        self.qr_seconds.observe(elapsed, source)
+        _add_span("qr", source=source, ms=round(elapsed * 1000, 1))
+
+    def observe_send(self, event: str, method: str, seconds: float) -> None:
+        """FlowControl observer: time waited for a token, a RetryAfter or a merged text."""
+        if event == "wait":
+            self.send_wait_seconds.observe(seconds, method)
+            if seconds >= 0.001:
+                _add_span("throttled", method=method, ms=round(seconds * 1000, 1))
+        else:
+            self.send_events.inc(event, method)
+            _add_span(event, method=method, **({"s": round(seconds, 1)} if seconds else {}))
+
+    def shared(self, what: str) -> None:
+        """SingleFlight observer: a caller joined a call already in flight."""
+        self.shared_results.inc(what)
+        _add_span("shared", what=what)
+
+    def suppressed(self, where: str, exc: BaseException) -> None:
+        """Record an exception a handler deliberately recovers from."""
+        self.suppressed_errors.inc(where, type(exc).__name__)
+        log.warning("%s: %s: %s", where, type(exc).__name__, exc)
+        _add_span("suppressed", where=where, error=type(exc).__name__)
+
+    def traced(self, name: str, callback: Callable[[Any, Any], Awaitable[Any]]) -> Callable[[Any, Any], Awaitable[Any]]:
+        """Wrap a handler callback with timing, error counting and a trace."""
+
+        async def wrapper(update: Any, context: Any) -> Any:
+            user = getattr(update, "effective_user", None)
+            trace = Trace(secrets.token_hex(8), name, getattr(user, "id", None), time.monotonic())
+            token = _current_trace.set(trace)
+            error = ""
+            try:
+                return await callback(update, context)
+            except Exception as exc:
+                error = type(exc).__name__
+                self.handler_errors.inc(name, error)
+                raise
+            finally:
+                elapsed = time.monotonic() - trace.started
+                _current_trace.reset(token)
+                self.handler_seconds.observe(elapsed, name)
+                if trace_log.isEnabledFor(logging.INFO):
+                    trace_log.info(json.dumps({
+                        "ts": round(time.time(), 3),
+                        "trace_id": trace.trace_id,
+                        "handler": name,
+                        "user_id": trace.user_id,
+                        "ms": round(elapsed * 1000, 1),
+                        "status": "error" if error else "ok",
+                        **({"error": error} if error else {}),
+                        "spans": trace.spans,
+                    }, ensure_ascii=False))
+
+        return wrapper
+
+
+def handler_name(handler: BaseHandler) -> str:
+    """Stable metric label for a handler: "/add", "callback:list", "message"."""
+    if isinstance(handler, CommandHandler):
+        return "/" + min(handler.commands)
+    if isinstance(handler, CallbackQueryHandler):
+        pattern = getattr(handler.pattern, "pattern", handler.pattern) or ""
+        return "callback:" + "".join(ch for ch in str(pattern) if ch.isalnum() or ch == "_").rstrip("_")
+    return type(handler).__name__.replace("Handler", "").lower() or "handler"
+
+
+def instrument_handlers(app: Application, metrics: Metrics) -> None:
+    """Wrap the callback of every handler registered on ``app``."""
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            handler.callback = metrics.traced(handler_name(handler), handler.callback)
+
+
+class TimedRequest(HTTPXRequest):
+    """HTTPXRequest reporting the latency of every Bot API call to Metrics."""
+
+    def __init__(self, metrics: Metrics, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.metrics = metrics
+
+    async def do_request(self, url: str, method: str, *args: Any, **kwargs: Any) -> Tuple[int, bytes]:
+        api_method = url.rsplit("/", 1)[-1]
+        start = time.monotonic()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception as exc:
+            self.metrics.observe_telegram(api_method, time.monotonic() - start, type(exc).__name__)
+            raise
+        self.metrics.observe_telegram(api_method, time.monotonic() - start, f"http_{code}" if code >= 400 else "")
+        return code, payload
+
+
+def enable_trace_log() -> None:
+    """Send one JSON line per handled update to stderr (journald under systemd)."""
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    trace_log.addHandler(handler)
+    trace_log.setLevel(logging.INFO)
+    trace_log.propagate = False
+
+
+class MetricsServer:
+    """Serves GET /metrics on the bot's own event loop."""
+
+    def __init__(self, metrics: Metrics, host: str = "127.0.0.1", port: int = 9101) -> None:
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        # Prometheus text exposition format 0.0.4
+        return web.Response(body=self.metrics.render().encode("utf-8"), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
@@ -0,0 +1,101 @@
+import hashlib
+import io
+import os
+import subprocess
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+try:
+    import qrcode
+    from qrcode.image.pure import PyPNGImage
+except ImportError:  # pragma: no cover - optional dependency
+    qrcode = None
+
+
+def render_qr_png(data: str) -> bytes:
+    """Render ``data`` as a PNG QR code entirely in memory."""
+    if qrcode is not None:
+        buf = io.BytesIO()
+        qrcode.make(data, image_factory=PyPNGImage).save(buf)
+        return buf.getvalue()
+    # Fall back to qrencode writing the PNG to stdout; still nothing touches the disk
+    res = subprocess.run(["qrencode", "-o", "-", data], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    return res.stdout
+
+
+class QrCache:
+    """Size-bounded LRU of rendered QR PNGs keyed by the encoded URL.
+
+    When ``spill_dir`` is set, evicted images are written there and read
+    back on a later miss instead of being re-rendered.
+    """
+
+    def __init__(self, max_bytes: int = 8 * 1024 * 1024, spill_dir: Optional[str] = None) -> None:
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir or None
+        self._items: "OrderedDict[str, bytes]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key_for(url: str) -> str:
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def peek(self, url: str) -> Optional[bytes]:
+        """Return a cached image without rendering (cheap enough for the event loop)."""
+        key = self.key_for(url)
+        with self._lock:
+            png = self._items.get(key)
+            if png is not None:
+                self._items.move_to_end(key)
+            return png
+
+    def get(self, url: str) -> bytes:
+        png = self.peek(url)
+        if png is not None:
+            return png
+        key = self.key_for(url)
+        png = self._read_spill(key)
+        if png is None:
+            png = render_qr_png(url)
+        self._put(key, png)
+        return png
+
+    def _put(self, key: str, png: bytes) -> None:
+        evicted = []
+        with self._lock:
+            if key in self._items:
+                return
+            self._items[key] = png
+            self._size += len(png)
+            while self._size > self.max_bytes and len(self._items) > 1:
+                old_key, old_png = self._items.popitem(last=False)
+                self._size -= len(old_png)
+                evicted.append((old_key, old_png))
+        for old_key, old_png in evicted:
+            self._write_spill(old_key, old_png)
+
+    def _spill_path(self, key: str) -> Optional[str]:
+        return os.path.join(self.spill_dir, f"{key}.png") if self.spill_dir else None
+
+    def _read_spill(self, key: str) -> Optional[bytes]:
+        path = self._spill_path(key)
+        if not path:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write_spill(self, key: str, png: bytes) -> None:
+        path = self._spill_path(key)
+        if not path or os.path.exists(path):
+            return
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)  # type: ignore[arg-type]
+            with open(path, "wb") as f:
+                f.write(png)
+        except OSError:
+            pass
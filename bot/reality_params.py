@@ -0,0 +1,221 @@
+import base64
+import json
+import os
+import re
+import socket
+import threading
+import time
+import urllib.request
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional, Tuple
+
+from client_registry import Client
+from xray_config import config_files, config_signature, load_config
+
+
+# (port, uTLS fingerprint) pairs, same as `vless show`
+LINK_PORTS: Tuple[Tuple[int, str], ...] = ((443, "chrome"), (80, "safari"))
+
+PUBLIC_IP_URL = "https://api.ipify.org"
+
+_P = 2 ** 255 - 19
+_A24 = 121665
+
+
+def x25519_public_key(private_key: str) -> str:
+    """Derive a Reality public key from its private key (both base64url, no padding)."""
+    raw = _b64decode(private_key)
+    if len(raw) != 32:
+        raise ValueError("X25519 private key must be 32 bytes")
+    return _b64encode(_x25519_base(raw))
+
+
+def _x25519_base(scalar_bytes: bytes) -> bytes:
+    # RFC 7748 Montgomery ladder with u = 9 (the curve25519 base point)
+    k = bytearray(scalar_bytes)
+    k[0] &= 248
+    k[31] &= 127
+    k[31] |= 64
+    scalar = int.from_bytes(k, "little")
+    x1 = 9
+    x2, z2, x3, z3 = 1, 0, x1, 1
+    swap = 0
+    for t in reversed(range(255)):
+        bit = (scalar >> t) & 1
+        swap ^= bit
+        if swap:
+            x2, x3, z2, z3 = x3, x2, z3, z2
+        swap = bit
+        a = (x2 + z2) % _P
+        aa = a * a % _P
+        b = (x2 - z2) % _P
+        bb = b * b % _P
+        e = (aa - bb) % _P
+        c = (x3 + z3) % _P
+        d = (x3 - z3) % _P
+        da = d * a % _P
+        cb = c * b % _P
+        x3 = (da + cb) ** 2 % _P
+        z3 = x1 * (da - cb) ** 2 % _P
+        x2 = aa * bb % _P
+        z2 = e * (aa + _A24 * e) % _P
+    if swap:
+        x2, z2 = x3, z3
+    return (x2 * pow(z2, _P - 2, _P) % _P).to_bytes(32, "little")
+
+
+def _b64decode(value: str) -> bytes:
+    value = value.strip().replace("+", "-").replace("/", "_").rstrip("=")
+    return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+@dataclass
+class RealityParams:
+    public_key: str
+    short_id: str
+    sni: str
+    server_ip: str
+    config_signature: str = ""
+    ip_checked_at: float = 0.0
+
+
+class ParamsSnapshot:
+    """Reality link parameters derived once and persisted next to the CLI state.
+
+    The snapshot is rebuilt when the Xray config changes and the public IP
+    is re-checked once ``ip_ttl`` seconds have passed, so building a link
+    normally needs neither jq nor the network.
+    """
+
+    def __init__(self, config_path: str, state_path: str, ip_ttl: float = 21600.0, confdir: str = "") -> None:
+        self.config_path = config_path
+        self.confdir = confdir
+        self.state_path = state_path
+        self.ip_ttl = ip_ttl
+        self._params: Optional[RealityParams] = None
+        self._lock = threading.Lock()
+
+    def is_fresh(self) -> bool:
+        p = self._params
+        return (
+            p is not None
+            and p.config_signature == config_signature(self.config_path, self.confdir)
+            and time.time() - p.ip_checked_at < self.ip_ttl
+        )
+
+    def get(self) -> RealityParams:
+        """Return current parameters; may block on config parsing or the IP lookup."""
+        if self.is_fresh():
+            return self._params  # type: ignore[return-value]
+        with self._lock:
+            if self.is_fresh():
+                return self._params  # type: ignore[return-value]
+            self._params = self._rebuild()
+            return self._params
+
+    def invalidate(self) -> None:
+        self._params = None
+
+    def _rebuild(self) -> RealityParams:
+        signature = config_signature(self.config_path, self.confdir)
+        params = self._params
+        if params is None or params.config_signature != signature:
+            params = self._load_state()
+        if params is None or params.config_signature != signature:
+            previous = params
+            params = _read_config_params(config_files(self.config_path, self.confdir))
+            params.config_signature = signature
+            # A config change does not move the server; keep the IP until its TTL runs out
+            if previous is not None:
+                params.server_ip = previous.server_ip
+                params.ip_checked_at = previous.ip_checked_at
+        if not params.server_ip or time.time() - params.ip_checked_at >= self.ip_ttl:
+            params.server_ip = detect_server_ip() or params.server_ip or "127.0.0.1"
+            params.ip_checked_at = time.time()
+        self._save_state(params)
+        return params
+
+    def _load_state(self) -> Optional[RealityParams]:
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return RealityParams(
+                public_key=str(data["public_key"]),
+                short_id=str(data.get("short_id") or ""),
+                sni=str(data["sni"]),
+                server_ip=str(data.get("server_ip") or ""),
+                config_signature=str(data.get("config_signature") or ""),
+                ip_checked_at=float(data.get("ip_checked_at") or 0),
+            )
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _save_state(self, params: RealityParams) -> None:
+        try:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            tmp = f"{self.state_path}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(asdict(params), f)
+            os.replace(tmp, self.state_path)
+        except OSError:
+            # The snapshot is only a cache; an unwritable state dir just means no persistence
+            pass
+
+
+def _read_config_params(files: List[str]) -> RealityParams:
+    config = load_config(files)
+    reality: Optional[dict] = None
+    for inbound in config.get("inbounds") or []:
+        if inbound.get("protocol") == "vless":
+            reality = (inbound.get("streamSettings") or {}).get("realitySettings") or {}
+            break
+    if not reality or not reality.get("privateKey"):
+        raise ValueError(f"Could not read Reality privateKey from {', '.join(files)}")
+    public_key = reality.get("publicKey") or x25519_public_key(reality["privateKey"])
+    short_ids = reality.get("shortIds") or []
+    server_names = reality.get("serverNames") or []
+    sni = (server_names[0] if server_names else reality.get("dest")) or "apple.com"
+    return RealityParams(
+        public_key=public_key,
+        short_id=short_ids[0] if short_ids else "",
+        sni=sni.split(":", 1)[0],
+        server_ip="",
+    )
+
+
+def detect_server_ip(timeout: float = 3.0) -> str:
+    try:
+        with urllib.request.urlopen(PUBLIC_IP_URL, timeout=timeout) as resp:
+            ip = resp.read(64).decode("ascii", errors="ignore").strip()
+        if re.fullmatch(r"[0-9.]+", ip):
+            return ip
+    except Exception:
+        pass
+    # Same fallback as `hostname -I`: the address of the default route interface
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(("192.0.2.1", 9))
+            return s.getsockname()[0]
+    except OSError:
+        return ""
+
+
+def sanitize_name(value: str) -> str:
+    value = re.sub(r"[^A-Za-z0-9._-]+", "_", value or "")[:50]
+    return value or "vpn_profile"
+
+
+def build_vless_url(uuid: str, name: str, port: int, fingerprint: str, params: RealityParams) -> str:
+    sid_q = f"&sid={params.short_id}" if params.short_id else ""
+    return (
+        f"vless://{uuid}@{params.server_ip}:{port}?type=tcp&security=reality&pbk={params.public_key}"
+        f"&fp={fingerprint}&sni={params.sni}{sid_q}&flow=xtls-rprx-vision#{sanitize_name(name)}"
+    )
+
+
+def client_urls(client: Client, params: RealityParams) -> Dict[int, str]:
+    return {port: build_vless_url(client.id, client.name, port, fp, params) for port, fp in LINK_PORTS}
@@ -23,6 +23,8 @@ VLESS_SRC="$REPO_ROOT/scripts/vless"
 BOT_SRC_DIR="$REPO_ROOT"
 BOT_DST_DIR="/opt/vless-bot"
 ENV_DST="/etc/vless-bot.env"
+# Python modules that make up the bot (installed next to telegram_bot.py)
+BOT_MODULES=(telegram_bot.py vless_exec.py client_registry.py reality_params.py qr_cache.py file_id_cache.py change_queue.py traffic_stats.py diagnostics.py xray_config.py subscription.py metrics.py webhook.py fleet.py access_log.py client_limits.py single_flight.py flow_control.py client_search.py)
 SERVICE_DST="/etc/systemd/system/vless-bot.service"
 NON_INTERACTIVE=false
 
@@ -56,7 +58,9 @@ install -m 755 "$VLESS_SRC" /usr/local/bin/vless
 info "Preparing bot directory at $BOT_DST_DIR"
 mkdir -p "$BOT_DST_DIR"
 install -m 644 "$BOT_SRC_DIR/requirements.txt" "$BOT_DST_DIR/requirements.txt"
-install -m 644 "$BOT_SRC_DIR/telegram_bot.py" "$BOT_DST_DIR/telegram_bot.py"
+for module in "${BOT_MODULES[@]}"; do
+  install -m 644 "$BOT_SRC_DIR/$module" "$BOT_DST_DIR/$module"
+done
 chown -R root:root "$BOT_DST_DIR"
 
 info "Creating Python venv and installing requirements"
@@ -0,0 +1,37 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Callers asking for the same key while a call is running share its result.
+
+    The call runs to completion even if the caller that started it goes
+    away, as the others may still be waiting for it.
+    """
+
+    def __init__(self, name: str, observer: Optional[Callable[[str], None]] = None) -> None:
+        self.name = name
+        self.observer = observer
+        self._calls: Dict[Hashable, "asyncio.Future[Any]"] = {}
+
+    async def do(self, key: Hashable, call: Callable[[], Awaitable[T]]) -> T:
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(call())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        elif self.observer is not None:
+            self.observer(self.name)
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: "asyncio.Future[Any]") -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # Mark the exception retrieved when every caller was gone
+            task.exception()
+
+    def __len__(self) -> int:
+        return len(self._calls)
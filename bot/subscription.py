@@ -0,0 +1,197 @@
+import asyncio
+import base64
+import gzip
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+from client_registry import Client, ClientRegistry
+from reality_params import LINK_PORTS, ParamsSnapshot, RealityParams, client_urls
+
+
+log = logging.getLogger("vless_bot")
+
+SUBSCRIPTION_PATH = "/sub/"
+
+# Hours between automatic updates, honoured by v2rayN, Hiddify, Streisand and others
+UPDATE_INTERVAL_HOURS = 12
+
+
+def load_secret(path: str, value: str = "") -> bytes:
+    """HMAC key for subscription tokens: ``value`` if given, else a key kept in ``path``.
+
+    The key is created on first use; replacing it revokes every issued URL.
+    """
+    if value:
+        return value.encode("utf-8")
+    try:
+        with open(path, "r", encoding="ascii") as f:
+            key = f.read().strip()
+        if key:
+            return key.encode("ascii")
+    except OSError:
+        pass
+    key = secrets.token_hex(32)
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="ascii") as f:
+            f.write(key + "\n")
+    except OSError:
+        # Unwritable state dir: URLs stay valid until the bot restarts
+        pass
+    return key.encode("ascii")
+
+
+def client_token(secret: bytes, client_id: str) -> str:
+    """URL token of a client: an HMAC of its UUID, so nothing is stored and it dies with the client."""
+    digest = hmac.new(secret, client_id.encode("utf-8"), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:18]).decode("ascii")
+
+
+@dataclass(frozen=True)
+class Bundle:
+    """A ready-to-send subscription body in both encodings."""
+
+    body: bytes
+    gzipped: bytes
+    etag: str
+
+
+def build_bundle(urls: List[str]) -> Bundle:
+    body = base64.b64encode("\n".join(urls).encode("utf-8") + b"\n")
+    etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+    return Bundle(body=body, gzipped=gzip.compress(body, compresslevel=9, mtime=0), etag=etag)
+
+
+class SubscriptionStore:
+    """Subscription bodies for every client, precomputed and looked up by token.
+
+    Bodies are rebuilt only when the client list (registry version) or the
+    link parameters change, at most once per ``check_interval`` seconds of
+    polling; clients whose links did not change keep their bundle.
+    """
+
+    def __init__(self, registry: ClientRegistry, params: ParamsSnapshot, secret: bytes, check_interval: float = 1.0) -> None:
+        self.registry = registry
+        self.params = params
+        self.secret = secret
+        self.check_interval = check_interval
+        self._bundles: Dict[str, Bundle] = {}
+        # client id -> (links the bundle was built from, token, bundle)
+        self._by_client: Dict[str, Tuple[Tuple[str, ...], str, Bundle]] = {}
+        self._built_for: Optional[Tuple[int, RealityParams]] = None
+        self._checked_at = 0.0
+        self.last_error = ""
+        self._lock = asyncio.Lock()
+
+    def token(self, client_id: str) -> str:
+        return client_token(self.secret, client_id)
+
+    async def lookup(self, token: str) -> Optional[Bundle]:
+        if time.monotonic() - self._checked_at >= self.check_interval:
+            await self.refresh()
+        return self._bundles.get(token)
+
+    async def refresh(self) -> None:
+        async with self._lock:
+            self._checked_at = time.monotonic()
+            # A stale snapshot may parse the config or look up the public IP
+            params = self.params.get() if self.params.is_fresh() else await asyncio.to_thread(self.params.get)
+            clients = await asyncio.to_thread(self.registry.clients)
+            key = (self.registry.version, params)
+            if key == self._built_for:
+                return
+            self._bundles, self._by_client = await asyncio.to_thread(self._rebuild, clients, params)
+            self._built_for = key
+            self.last_error = ""
+
+    def _rebuild(self, clients: List[Client], params: RealityParams) -> Tuple[Dict[str, Bundle], Dict[str, Tuple[Tuple[str, ...], str, Bundle]]]:
+        bundles: Dict[str, Bundle] = {}
+        by_client: Dict[str, Tuple[Tuple[str, ...], str, Bundle]] = {}
+        for client in clients:
+            urls = client_urls(client, params)
+            links = tuple(urls[port] for port, _ in LINK_PORTS)
+            previous = self._by_client.get(client.id)
+            if previous is not None and previous[0] == links:
+                entry = previous
+            else:
+                entry = (links, self.token(client.id), build_bundle(list(links)))
+            by_client[client.id] = entry
+            bundles[entry[1]] = entry[2]
+        return bundles, by_client
+
+    def __len__(self) -> int:
+        return len(self._bundles)
+
+
+def _accepts_gzip(header: str) -> bool:
+    for part in header.split(","):
+        coding, _, params = part.strip().partition(";")
+        if coding.strip().lower() in ("gzip", "*"):
+            return params.replace(" ", "").lower() not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+class SubscriptionServer:
+    """Serves GET /sub/<token> from the store on the bot's own event loop."""
+
+    def __init__(self, store: SubscriptionStore, host: str = "0.0.0.0", port: int = 8080) -> None:
+        self.store = store
+        self.host = host
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get(SUBSCRIPTION_PATH + "{token}", self.handle)
+        # No access log: every poll would write a line containing a secret token
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        # Build the bodies now rather than on the first poll; a broken config
+        # must not keep the bot (and /doctor, /fix) from starting
+        try:
+            await self.store.refresh()
+        except (OSError, ValueError) as exc:
+            self.store.last_error = str(exc) or exc.__class__.__name__
+            log.warning("Subscription links not built, will retry on the first request: %s", exc)
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        try:
+            bundle = await self.store.lookup(request.match_info["token"])
+        except (OSError, ValueError) as exc:
+            self.store.last_error = str(exc) or exc.__class__.__name__
+            log.warning("Subscription links not built: %s", exc)
+            raise web.HTTPServiceUnavailable()
+        if bundle is None:
+            raise web.HTTPNotFound()
+        headers = {
+            "ETag": bundle.etag,
+            "Cache-Control": "no-cache",
+            "Vary": "Accept-Encoding",
+            "Profile-Update-Interval": str(UPDATE_INTERVAL_HOURS),
+        }
+        if _etag_matches(request.headers.get("If-None-Match", ""), bundle.etag):
+            return web.Response(status=304, headers=headers)
+        if _accepts_gzip(request.headers.get("Accept-Encoding", "")):
+            headers["Content-Encoding"] = "gzip"
+            return web.Response(body=bundle.gzipped, headers=headers, content_type="text/plain", charset="utf-8")
+        return web.Response(body=bundle.body, headers=headers, content_type="text/plain", charset="utf-8")
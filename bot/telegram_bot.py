@@ -1,30 +1,138 @@
+import asyncio
+import csv
+import io
+import logging
 import os
 import re
+import secrets
 import shlex
 import subprocess
+import tempfile
+import time
+import uuid as uuidlib
+import zipfile
 from dataclasses import dataclass
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 from html import escape as html_escape
+from urllib.parse import urlsplit
 
 from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, Message
+from telegram.error import BadRequest, TelegramError
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+
+from access_log import OFF, AccessAnalyzer, AccessLogFollower, access_check, access_source_resolver
+from client_limits import EXPIRED, ClientLimit, Enforcement, LimitScheduler, LimitStore, parse_expiry, parse_quota
+from change_queue import ADD, BLOCK, BLOCK_TORRENTS, DELETE, UNBLOCK, UNBLOCK_TORRENTS, Batch, Change, ChangeQueue
+from client_registry import Client, ClientRegistry
+from client_search import FUZZY, ClientIndex, Match
+from diagnostics import FAIL, PASS, WARN, Diagnostics, Report, default_checks, read_restart_history
+from file_id_cache import FileIdCache
+from flow_control import FlowControl
+from fleet import SSH_ERROR_EXIT_CODE, Fleet, NodeRegistry, NodeResult, default_transport
+from metrics import Metrics, MetricsServer, TimedRequest, enable_trace_log, instrument_handlers
+from qr_cache import QrCache
+from reality_params import ParamsSnapshot, RealityParams, client_urls, sanitize_name
+from single_flight import SingleFlight
+from subscription import SUBSCRIPTION_PATH, SubscriptionServer, SubscriptionStore, load_secret
+from traffic_stats import StatsPoller, TrafficStats, XrayStatsSource
+from vless_exec import TIMEOUT_EXIT_CODE, VlessExecutor
+from webhook import WEBHOOK_PORTS, run_webhook
 
 
 @dataclass
 class Settings:
     token: str
     admins: List[int]
+    mode: str = "polling"
+    webhook_url: str = ""
+    webhook_listen: str = "127.0.0.1"
+    webhook_port: int = 8081
+    webhook_secret: str = ""
+    webhook_max_connections: int = 40
+    concurrent_updates: int = 256
+    send_rate: float = 25.0
+    chat_rate: float = 1.0
+    api_url: str = ""
     vless_path: str = "/usr/local/bin/vless"
     output_dir: str = "/root/vless-configs"
+    config_path: str = "/usr/local/etc/xray/config.json"
+    confdir: str = "/usr/local/etc/xray/conf.d"
+    state_dir: str = "/var/lib/vless"
+    qr_cache_bytes: int = 8 * 1024 * 1024
+    qr_spill_dir: str = ""
+    list_page_size: int = 10
+    params_ttl: float = 21600.0
+    exec_concurrency: int = 4
+    exec_timeout: float = 60.0
+    batch_window: float = 1.5
+    api_server: str = "127.0.0.1:10085"
+    stats_interval: float = 60.0
+    stats_rollup: float = 300.0
+    doctor_ttl: float = 30.0
+    sub_port: int = 0
+    sub_host: str = "0.0.0.0"
+    sub_url: str = ""
+    sub_secret: str = ""
+    metrics_port: int = 0
+    metrics_host: str = "127.0.0.1"
+    trace_log: bool = False
+    fleet_file: str = "/etc/vless-bot-nodes.json"
+    node_name: str = "local"
+    fleet_parallel: int = 16
+    ssh_connect_timeout: float = 10.0
+    access_log: str = "auto"
+    auth_flood: int = 20
+    limits_file: str = "/usr/local/etc/xray/vless-limits.json"
+    expiry_window: float = 60.0
 
 
 def load_settings() -> Settings:
     load_dotenv()
     token = os.getenv("TELEGRAM_BOT_TOKEN", "").strip()
     admins_raw = os.getenv("TELEGRAM_ADMINS", "").strip()
+    mode = os.getenv("TELEGRAM_MODE", "polling").strip().lower() or "polling"
+    webhook_url = os.getenv("TELEGRAM_WEBHOOK_URL", "").strip()
+    webhook_listen = os.getenv("TELEGRAM_WEBHOOK_LISTEN", "127.0.0.1").strip()
+    webhook_port = int(os.getenv("TELEGRAM_WEBHOOK_PORT", "8081").strip() or 8081)
+    webhook_secret = os.getenv("TELEGRAM_WEBHOOK_SECRET", "").strip()
+    webhook_max_connections = int(os.getenv("TELEGRAM_WEBHOOK_MAX_CONNECTIONS", "40").strip() or 40)
+    concurrent_updates = int(os.getenv("TELEGRAM_CONCURRENT_UPDATES", "256").strip() or 256)
+    send_rate = float(os.getenv("TELEGRAM_SEND_RATE", "25").strip() or 25)
+    chat_rate = float(os.getenv("TELEGRAM_CHAT_RATE", "1").strip() or 1)
+    api_url = os.getenv("TELEGRAM_API_URL", "").strip()
     vless_path = os.getenv("VLESS_BIN", "/usr/local/bin/vless").strip()
     output_dir = os.getenv("VLESS_OUTPUT_DIR", "/root/vless-configs").strip()
+    config_path = os.getenv("VLESS_CONFIG", "/usr/local/etc/xray/config.json").strip()
+    confdir = os.getenv("VLESS_CONFDIR", "/usr/local/etc/xray/conf.d").strip()
+    state_dir = os.getenv("VLESS_STATE_DIR", "/var/lib/vless").strip()
+    params_ttl = float(os.getenv("VLESS_PARAMS_TTL", "21600").strip() or 21600)
+    qr_cache_bytes = int(os.getenv("VLESS_QR_CACHE_BYTES", str(8 * 1024 * 1024)).strip() or 0)
+    qr_spill_dir = os.getenv("VLESS_QR_SPILL_DIR", "").strip()
+    list_page_size = int(os.getenv("VLESS_LIST_PAGE_SIZE", "10").strip() or 10)
+    exec_concurrency = int(os.getenv("VLESS_EXEC_CONCURRENCY", "4").strip() or 4)
+    exec_timeout = float(os.getenv("VLESS_EXEC_TIMEOUT", "60").strip() or 60)
+    batch_window = float(os.getenv("VLESS_BATCH_WINDOW", "1.5").strip() or 0)
+    api_server = os.getenv("VLESS_API_SERVER", "127.0.0.1:10085").strip()
+    stats_interval = float(os.getenv("VLESS_STATS_INTERVAL", "60").strip() or 0)
+    stats_rollup = float(os.getenv("VLESS_STATS_ROLLUP", "300").strip() or 300)
+    doctor_ttl = float(os.getenv("VLESS_DOCTOR_TTL", "30").strip() or 0)
+    sub_port = int(os.getenv("VLESS_SUB_PORT", "0").strip() or 0)
+    sub_host = os.getenv("VLESS_SUB_HOST", "0.0.0.0").strip()
+    sub_url = os.getenv("VLESS_SUB_URL", "").strip()
+    sub_secret = os.getenv("VLESS_SUB_SECRET", "").strip()
+    metrics_port = int(os.getenv("VLESS_METRICS_PORT", "0").strip() or 0)
+    metrics_host = os.getenv("VLESS_METRICS_HOST", "127.0.0.1").strip()
+    trace_log = os.getenv("VLESS_TRACE_LOG", "").strip().lower() in ("1", "true", "yes", "on")
+    fleet_file = os.getenv("VLESS_FLEET_FILE", "/etc/vless-bot-nodes.json").strip()
+    node_name = os.getenv("VLESS_NODE_NAME", "local").strip() or "local"
+    fleet_parallel = int(os.getenv("VLESS_FLEET_PARALLEL", "16").strip() or 16)
+    ssh_connect_timeout = float(os.getenv("VLESS_SSH_CONNECT_TIMEOUT", "10").strip() or 10)
+    access_log = os.getenv("VLESS_ACCESS_LOG", "auto").strip() or "auto"
+    auth_flood = int(os.getenv("VLESS_AUTH_FLOOD", "20").strip() or 20)
+    # Next to config.json, outside the confdir so Xray never loads it
+    limits_file = os.getenv("VLESS_LIMITS_FILE", "").strip() or os.path.join(os.path.dirname(config_path), "vless-limits.json")
+    expiry_window = float(os.getenv("VLESS_EXPIRY_WINDOW", "60").strip() or 0)
     if not token:
         raise RuntimeError("TELEGRAM_BOT_TOKEN is not set")
     admins: List[int] = []
@@ -38,17 +146,466 @@ def load_settings() -> Settings:
                 pass
     if not admins:
         raise RuntimeError("TELEGRAM_ADMINS is empty; specify at least one admin user id")
-    return Settings(token=token, admins=admins, vless_path=vless_path, output_dir=output_dir)
+    if mode not in ("polling", "webhook"):
+        raise RuntimeError(f"TELEGRAM_MODE must be polling or webhook, got {mode!r}")
+    if mode == "webhook":
+        url = urlsplit(webhook_url)
+        if url.scheme != "https" or not url.hostname:
+            raise RuntimeError("TELEGRAM_WEBHOOK_URL must be an https:// URL in webhook mode")
+        if (url.port or 443) not in WEBHOOK_PORTS:
+            raise RuntimeError(f"TELEGRAM_WEBHOOK_URL port must be one of {', '.join(map(str, WEBHOOK_PORTS))}")
+    if webhook_secret and not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", webhook_secret):
+        raise RuntimeError("TELEGRAM_WEBHOOK_SECRET may only contain A-Z, a-z, 0-9, _ and - (up to 256 characters)")
+    return Settings(
+        token=token,
+        admins=admins,
+        mode=mode,
+        webhook_url=webhook_url,
+        webhook_listen=webhook_listen,
+        webhook_port=webhook_port,
+        webhook_secret=webhook_secret,
+        webhook_max_connections=min(max(webhook_max_connections, 1), 100),
+        concurrent_updates=max(1, concurrent_updates),
+        send_rate=max(1.0, send_rate),
+        chat_rate=max(0.1, chat_rate),
+        api_url=api_url,
+        vless_path=vless_path,
+        output_dir=output_dir,
+        config_path=config_path,
+        confdir=confdir,
+        state_dir=state_dir,
+        params_ttl=params_ttl,
+        qr_cache_bytes=qr_cache_bytes,
+        qr_spill_dir=qr_spill_dir,
+        list_page_size=list_page_size,
+        exec_concurrency=exec_concurrency,
+        exec_timeout=exec_timeout,
+        batch_window=batch_window,
+        api_server=api_server,
+        stats_interval=stats_interval,
+        stats_rollup=stats_rollup,
+        doctor_ttl=doctor_ttl,
+        sub_port=sub_port,
+        sub_host=sub_host,
+        sub_url=sub_url,
+        sub_secret=sub_secret,
+        metrics_port=metrics_port,
+        metrics_host=metrics_host,
+        trace_log=trace_log,
+        fleet_file=fleet_file,
+        node_name=node_name,
+        fleet_parallel=max(1, fleet_parallel),
+        ssh_connect_timeout=ssh_connect_timeout,
+        access_log=access_log,
+        auth_flood=max(1, auth_flood),
+        limits_file=limits_file,
+        expiry_window=expiry_window,
+    )
 
 
 def is_admin(user_id: Optional[int], settings: Settings) -> bool:
     return user_id is not None and user_id in settings.admins
 
 
-def run_vless(settings: Settings, args: List[str]) -> subprocess.CompletedProcess:
-    # Use a strict command invocation; no shell injection
-    cmd = [settings.vless_path] + args
-    return subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, check=False)
+async def run_vless(context: ContextTypes.DEFAULT_TYPE, args: List[str]) -> subprocess.CompletedProcess:
+    executor: VlessExecutor = context.bot_data["executor"]
+    return await executor.run(args)
+
+
+def apply_note(res: subprocess.CompletedProcess) -> str:
+    """Describe how vless add/del reached the running Xray (see apply_client_change in the CLI)."""
+    out = res.stdout or ""
+    if "Applied: live" in out:
+        return "⚡ <i>Изменение применено без перезапуска Xray</i>"
+    if "Applied: restart" in out:
+        ready_ms = ready_time_ms(res)
+        if ready_ms is not None:
+            return f"🔄 <i>Xray перезапущен для применения изменений (готов через {ready_ms / 1000:.1f} с)</i>"
+        return "🔄 <i>Xray перезапущен для применения изменений</i>"
+    return "🔄 <b>Не забудьте перезапустить сервис:</b> /restart"
+
+
+def ready_time_ms(res: subprocess.CompletedProcess) -> Optional[int]:
+    """Restart-to-ready time from the "Ready in <ms> ms" marker printed by restart_xray."""
+    match = re.search(r"^Ready in (\d+) ms$", res.stdout or "", re.MULTILINE)
+    return int(match.group(1)) if match else None
+
+
+def registry(context: ContextTypes.DEFAULT_TYPE) -> ClientRegistry:
+    return context.bot_data["registry"]
+
+
+def client_index(context: ContextTypes.DEFAULT_TYPE) -> ClientIndex:
+    return context.bot_data["search"]
+
+
+def note_error(context: ContextTypes.DEFAULT_TYPE, where: str, exc: Exception) -> None:
+    """Count and log an exception that a handler recovers from instead of failing."""
+    metrics: Metrics = context.bot_data["metrics"]
+    metrics.suppressed(where, exc)
+
+
+async def queue_change(context: ContextTypes.DEFAULT_TYPE, change: Change) -> Batch:
+    queue: ChangeQueue = context.bot_data["changes"]
+    return await queue.submit(change)
+
+
+def describe_change(change: Change) -> str:
+    if change.kind == ADD:
+        return f"➕ {html_escape(change.key)}"
+    if change.kind == DELETE:
+        return f"➖ {html_escape(change.key)}"
+    if change.kind == BLOCK_TORRENTS:
+        return "🚫 блокировка торрентов"
+    if change.kind == BLOCK:
+        return f"🚫 {html_escape(' '.join(change.items))}"
+    if change.kind == UNBLOCK:
+        return f"🌐 {html_escape(' '.join(change.items))}"
+    return "🌐 разблокировка торрентов"
+
+
+def batch_note(batch: Batch, own: Change) -> str:
+    """List the other changes committed in the same config write, if any."""
+    others = [describe_change(c) for c in batch.changes if c is not own]
+    if not others:
+        return ""
+    shown = others[:10]
+    if len(others) > 10:
+        shown.append(f"… и ещё {len(others) - 10}")
+    return "📦 <i>Применено одним пакетом вместе с:</i> " + ", ".join(shown)
+
+
+def flights(context: ContextTypes.DEFAULT_TYPE) -> SingleFlight:
+    return context.bot_data["flights"]
+
+
+async def reality_params(context: ContextTypes.DEFAULT_TYPE) -> RealityParams:
+    """The params snapshot; a stale one is refreshed once, off the event loop, for all waiting handlers."""
+    snapshot: ParamsSnapshot = context.bot_data["params"]
+    if snapshot.is_fresh():
+        return snapshot.get()
+    # Only a stale snapshot touches the disk or the network
+    return await flights(context).do("params", lambda: asyncio.to_thread(snapshot.get))
+
+
+async def client_links(context: ContextTypes.DEFAULT_TYPE, client: Client) -> Tuple[Optional[str], Optional[str]]:
+    """Return the (443, 80) vless:// URLs for a client, or (None, None) if params are unavailable."""
+    try:
+        params = await reality_params(context)
+    except (OSError, ValueError):
+        return None, None
+    urls = client_urls(client, params)
+    return urls.get(443), urls.get(80)
+
+
+async def subscription_link(context: ContextTypes.DEFAULT_TYPE, client: Client) -> Optional[str]:
+    """Subscription URL of a client, or None when the endpoint is disabled."""
+    store: Optional[SubscriptionStore] = context.bot_data.get("subscriptions")
+    base_url: str = context.bot_data.get("sub_url", "")
+    if store is None:
+        return None
+    if not base_url:
+        try:
+            params = await reality_params(context)
+        except (OSError, ValueError):
+            return None
+        base_url = f"http://{params.server_ip}:{context.bot_data['sub_server'].port}"
+    return base_url.rstrip("/") + SUBSCRIPTION_PATH + store.token(client.id)
+
+
+async def send_qr_codes(message: Message, context: ContextTypes.DEFAULT_TYPE, client: Client, caption_name: str, urls: Dict[int, Optional[str]]) -> int:
+    """Send the QR photos for a client as one album; return how many were sent.
+
+    A photo already uploaded for the same client, port and URL is re-sent by
+    its Telegram file_id; otherwise the PNG is streamed from memory once.
+    """
+    cache: QrCache = context.bot_data["qr_cache"]
+    file_ids: FileIdCache = context.bot_data["file_ids"]
+    metrics: Metrics = context.bot_data["metrics"]
+    photos = []  # (port, url, file_id or PNG bytes, came from file_id cache)
+    for port, url in urls.items():
+        if not url:
+            continue
+        file_id = file_ids.get(client.id, port, url) if client.id else None
+        if file_id:
+            photos.append((port, url, file_id, True))
+            continue
+        start = time.monotonic()
+        try:
+            png = cache.peek(url)
+            source = "memory"
+            if png is None:
+                # Admins opening the same client at once share one render
+                png = await flights(context).do(("qr", url), lambda url=url: asyncio.to_thread(cache.get, url))
+                source = "render"
+        except Exception as exc:
+            note_error(context, "qr_render", exc)
+            continue
+        metrics.observe_qr(source, time.monotonic() - start)
+        photos.append((port, url, png, False))
+    if not photos:
+        return 0
+
+    captions = [f"📱 QR-код для порта {port}\n🔗 {html_escape(caption_name)}" for port, _, _, _ in photos]
+    try:
+        if len(photos) == 1:
+            replies = [await message.reply_photo(photos[0][2], caption=captions[0], parse_mode="HTML")]
+        else:
+            replies = list(await message.reply_media_group(
+                [InputMediaPhoto(photo, caption=caption, parse_mode="HTML") for (_, _, photo, _), caption in zip(photos, captions)]
+            ))
+    except BadRequest:
+        stale = [port for port, _, _, cached in photos if cached]
+        if not stale:
+            return 0
+        # Telegram no longer knows one of the file_ids; forget them and upload again
+        for port in stale:
+            file_ids.forget(client.id, port)
+        return await send_qr_codes(message, context, client, caption_name, urls)
+    except Exception as exc:
+        note_error(context, "qr_upload", exc)
+        return 0
+
+    if client.id:
+        for (port, url, _, cached), reply in zip(photos, replies):
+            if not cached and reply.photo:
+                file_ids.put(client.id, port, url, reply.photo[-1].file_id)
+    return len(replies)
+
+
+async def send_client_details(
+    message: Message,
+    context: ContextTypes.DEFAULT_TYPE,
+    client: Client,
+    caption_name: str,
+    urls: Optional[Tuple[Optional[str], Optional[str]]] = None,
+) -> None:
+    """Reply with a client's links followed by both QR codes in a single album.
+
+    ``urls`` are (443, 80) links printed by another node; without them the
+    links are built from this server's parameters.
+    """
+    url443, url80 = urls if urls is not None else await client_links(context, client)
+    if not (url443 or url80):
+        await message.reply_text(f"⚠️ <b>Клиент найден, но не удалось сгенерировать ссылки</b>\n\n🔄 <i>Попробуйте перезапустить сервис:</i> /restart", parse_mode="HTML")
+        return
+
+    await message.chat.send_action("upload_photo")
+
+    # Format rich response
+    title = f"🔍 <b>Конфигурация клиента:</b> {html_escape(caption_name)}"
+    uuid_line = f"UUID: <code>{html_escape(client.id)}</code>"
+    # Expiry and quota are kept per server; links from another node skip them
+    limit = limits(context).store.get(client.id) if urls is None else None
+    if limit is not None:
+        uuid_line += "\n" + describe_limit(limits(context), limit, time.time())
+    body = ["📱 <b>Ссылки для подключения:</b>"]
+    if url443:
+        body.append(f"🔒 <b>443:</b> <code>{html_escape(url443)}</code>")
+    if url80:
+        body.append(f"🌐 <b>80:</b> <code>{html_escape(url80)}</code>")
+    # The subscription endpoint serves this server's links only
+    sub_url = await subscription_link(context, client) if urls is None else None
+    if sub_url:
+        body.append(f"🔄 <b>Подписка:</b> <code>{html_escape(sub_url)}</code>")
+    body.append("\n📋 <i>Нажмите на ссылку для копирования</i>")
+    text = "\n".join([title, uuid_line, ""] + body)
+
+    try:
+        await message.reply_text(text, parse_mode="HTML")
+    except Exception as exc:
+        note_error(context, "html_reply", exc)
+        await message.reply_text(f"🔍 Конфигурация: {caption_name}\n443: {url443 or ''}\n80: {url80 or ''}")
+
+    qr_sent = await send_qr_codes(message, context, client, caption_name, {443: url443, 80: url80})
+    if qr_sent == 0:
+        await message.reply_text("⚠️ <i>QR-коды не созданы (проверьте установку qrcode или qrencode)</i>", parse_mode="HTML")
+
+
+FLEET_EDIT_INTERVAL = 1.0
+
+ANSI_RE = re.compile(r"\x1b\[[0-9;]*m")
+
+
+def fleet(context: ContextTypes.DEFAULT_TYPE) -> Fleet:
+    return context.bot_data["fleet"]
+
+
+def split_target(context: ContextTypes.DEFAULT_TYPE, text: str) -> Tuple[str, Optional[List[str]]]:
+    """Split "name@node" into the client key and the nodes it is meant for.
+
+    Without remote nodes "@" is just part of the name; None means this
+    server only. Raises KeyError for an unknown node.
+    """
+    key, sep, target = text.rpartition("@")
+    if not sep or not key.strip() or not fleet(context).nodes.nodes():
+        return text, None
+    return key.strip(), fleet(context).resolve(target)
+
+
+def is_local_only(context: ContextTypes.DEFAULT_TYPE, names: Optional[List[str]]) -> bool:
+    return names is None or names == [fleet(context).local_name]
+
+
+async def reply_unknown_node(message: Message, context: ContextTypes.DEFAULT_TYPE, name: str) -> None:
+    known = ", ".join(fleet(context).names() + ["all"])
+    await message.reply_text(
+        f"❌ <b>Неизвестный узел:</b> {html_escape(name)}\n\n🖧 <i>Доступны:</i> {html_escape(known)}",
+        parse_mode="HTML",
+    )
+
+
+class LiveMessage:
+    """A status message edited in place as results arrive.
+
+    Telegram throttles edits of one message, so updates are coalesced into
+    at most one edit per ``interval`` seconds; ``finish`` always shows the
+    final text.
+    """
+
+    def __init__(self, message: Message, interval: float = FLEET_EDIT_INTERVAL) -> None:
+        self.message = message
+        self.interval = interval
+        self._text = ""
+        self._shown: Optional[str] = None
+        self._last = 0.0
+        self._pending: Optional[asyncio.Task] = None
+
+    def update(self, text: str) -> None:
+        self._text = text
+        if self._pending is None:
+            delay = max(0.0, self._last + self.interval - time.monotonic())
+            self._pending = asyncio.create_task(self._flush(delay))
+
+    async def finish(self, text: str) -> None:
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
+        self._text = text
+        await self._edit()
+
+    async def _flush(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        self._pending = None
+        try:
+            await self._edit()
+        except TelegramError:
+            # The final edit in finish() shows everything anyway
+            pass
+
+    async def _edit(self) -> None:
+        if self._text == self._shown:
+            return
+        self._last = time.monotonic()
+        try:
+            await self.message.edit_text(self._text, parse_mode="HTML")
+        except BadRequest:
+            # "message is not modified"
+            pass
+        self._shown = self._text
+
+
+def output_tail(res: subprocess.CompletedProcess) -> str:
+    """Last non-empty line of a command's output, for one-line node summaries."""
+    lines = [ANSI_RE.sub("", line).strip() for line in (res.stdout or "").splitlines()]
+    lines = [line for line in lines if line]
+    return html_escape(lines[-1][:200]) if lines else "нет вывода"
+
+
+def describe_failure(res: subprocess.CompletedProcess) -> Tuple[str, str]:
+    if res.returncode == TIMEOUT_EXIT_CODE:
+        return "⌛", "нет ответа за отведённое время"
+    if res.returncode == SSH_ERROR_EXIT_CODE:
+        return "🔌", f"нет связи: {output_tail(res)}"
+    return "❌", output_tail(res)
+
+
+def describe_client_change(done: str):
+    def describe(r: NodeResult) -> Tuple[str, str]:
+        if not r.ok:
+            return describe_failure(r.result)
+        out = r.result.stdout or ""
+        if "Applied: live" in out:
+            return "✅", f"{done} без перезапуска"
+        if "Applied: restart" in out:
+            return "✅", f"{done}, Xray перезапущен"
+        return "⚠️", f"{done}, нужен /restart"
+    return describe
+
+
+def describe_restart(r: NodeResult) -> Tuple[str, str]:
+    if not r.ok:
+        return describe_failure(r.result)
+    ready_ms = ready_time_ms(r.result)
+    if ready_ms is not None:
+        return "✅", f"готов через {ready_ms / 1000:.1f} с"
+    return "✅", "перезапущен"
+
+
+def describe_doctor(r: NodeResult) -> Tuple[str, str]:
+    """One line from the raw output of ``vless doctor``."""
+    if not r.ok:
+        return describe_failure(r.result)
+    out = r.result.stdout or ""
+    if "Active: active (running)" not in out:
+        return "❌", "Xray не запущен"
+    if "No services listening on ports 443/80" in out or "Config test failed" in out:
+        return "⚠️", "Xray запущен, но есть проблемы"
+    return "✅", "Xray работает"
+
+
+def render_fan_out(title: str, names: List[str], results: Dict[str, NodeResult], describe) -> str:
+    lines = []
+    for name in names:
+        r = results.get(name)
+        if r is None:
+            lines.append(("⏳", f"⏳ <b>{html_escape(name)}</b> — выполняется…"))
+            continue
+        icon, summary = describe(r)
+        lines.append((icon, f"{icon} <b>{html_escape(name)}</b> — {summary} <i>({r.elapsed:.1f} с)</i>"))
+    ok = sum(1 for r in results.values() if describe(r)[0] == "✅")
+    if len(results) < len(names):
+        footer = f"📊 <i>Ответили {len(results)} из {len(names)}</i>"
+    else:
+        footer = f"📊 <i>Успешно на {ok} из {len(names)}</i>"
+    text = "\n".join([title, ""] + [line for _, line in lines] + ["", footer])
+    if len(text) > 3900:
+        # Too many nodes for one message: keep the ones that need attention
+        rest = [line for icon, line in lines if icon != "✅"]
+        text = "\n".join([title, ""] + rest[:40] + [f"✅ <i>… и ещё {ok} без ошибок</i>", "", footer])
+    return text
+
+
+async def fan_out_reply(
+    message: Message,
+    context: ContextTypes.DEFAULT_TYPE,
+    names: List[str],
+    args: List[str],
+    title: str,
+    describe,
+    edit: bool = False,
+) -> Dict[str, NodeResult]:
+    """Run ``vless <args>`` on all ``names`` at once, updating one message as nodes answer.
+
+    With ``edit`` the progress goes into ``message`` itself instead of a reply.
+    """
+    results: Dict[str, NodeResult] = {}
+    text = render_fan_out(title, names, results, describe)
+    if edit:
+        live = LiveMessage(message)
+        await live.finish(text)
+    else:
+        # Edited as nodes answer, so never merged with other texts by FlowControl
+        live = LiveMessage(await message.reply_text(text, parse_mode="HTML", rate_limit_args={"merge": False}))
+    async for r in fleet(context).fan_out(names, args):
+        results[r.node] = r
+        live.update(render_fan_out(title, names, results, describe))
+    await live.finish(render_fan_out(title, names, results, describe))
+    return results
+
+
+def node_list(names: List[str]) -> str:
+    return ", ".join(html_escape(n) for n in names)
 
 
 async def _guard_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, settings: Settings) -> bool:
@@ -65,21 +622,31 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE, settings
     text = (
         "🔒 <b>VLESS Admin Bot</b>\n\n"
         "🌟 <b>Доступные команды:</b>\n"
-        "• /add &lt;name&gt; — создать клиента\n"
+        "• /add &lt;name&gt;[@узел|@all] — создать клиента\n"
         "• /list — список всех клиентов\n"
-        "• /show &lt;name|uuid&gt; — показать конфигурацию\n"
-        "• /del &lt;name|uuid&gt; — удалить клиента (с подтверждением)\n"
-        "• /restart — перезапустить Xray\n"
+        "• /show &lt;name|uuid&gt;[@узел] — показать конфигурацию\n"
+        "• /find &lt;часть имени|uuid&gt; — найти клиентов\n"
+        "• /del &lt;name|uuid&gt;[@узел|@all] — удалить клиента (с подтверждением)\n"
+        "• /import — массовое добавление/удаление из CSV/JSON файла\n"
+        "• /restart [узел|all] — перезапустить Xray\n"
         "• /fix — исправить права и перезапустить\n"
         "• /block_torrents — заблокировать торренты\n"
         "• /unblock_torrents — разблокировать торренты\n"
-        "• /doctor — диагностика сервера\n\n"
+        "• /block [домен|порт] — заблокировать домены или порты, без аргументов — текущая политика\n"
+        "• /unblock &lt;домен|порт&gt; — снять блокировку\n"
+        "• /stats [name] — трафик клиентов\n"
+        "• /connections [name] — подключения и отклонённые попытки\n"
+        "• /expire [name срок|off] — срок действия клиента, без аргументов — все сроки и квоты\n"
+        "• /quota &lt;name&gt; &lt;объём|off&gt; — квота трафика клиента (с единицей: 500MB, 50GB)\n"
+        "• /doctor [узел|all] — диагностика сервера\n"
+        "• /nodes — серверы под управлением бота\n\n"
         "💡 <i>Используйте /help для повторного вызова этого меню</i>"
     )
     try:
         await update.message.reply_text(text, parse_mode="HTML")
-    except Exception:
-        await update.message.reply_text("🔒 VLESS Admin Bot\n\nКоманды: /add, /list, /show, /del, /restart, /doctor")
+    except Exception as exc:
+        note_error(context, "html_reply", exc)
+        await update.message.reply_text("🔒 VLESS Admin Bot\n\nКоманды: /add, /list, /show, /del, /restart, /doctor, /nodes")
 
 
 async def cmd_add(update: Update, context: ContextTypes.DEFAULT_TYPE, settings: Settings) -> None:
@@ -92,40 +659,40 @@ async def cmd_add(update: Update, context: ContextTypes.DEFAULT_TYPE, settings:
     # Show "typing" indicator
     await update.message.chat.send_action("typing")
     name = " ".join(context.args).strip()
+    try:
+        name, nodes = split_target(context, name)
+    except KeyError as exc:
+        await reply_unknown_node(update.message, context, exc.args[0])
+        return
     if len(name) > 50:
         await update.message.reply_text("❌ <b>Ошибка:</b> Имя слишком длинное (макс. 50 символов)", parse_mode="HTML")
         return
+    if not is_local_only(context, nodes):
+        await add_on_nodes(update.message, context, name, nodes)
+        return
     
     # Check if client with this name already exists
-    list_res = run_vless(settings, ["list"])
-    if list_res.returncode == 0:
-        lines = (list_res.stdout or "").splitlines()
-        for ln in lines:
-            ln = ln.strip()
-            # Skip header and separator lines
-            if ln.startswith("UUID") or ln.startswith("-"):
-                continue
-            # Match UUID | NAME
-            m = re.match(r"^([0-9a-fA-F-]{36})\s*\|\s*(.*)$", ln)
-            if m:
-                existing_name = (m.group(2) or "").strip()
-                if existing_name == name:
-                    await update.message.reply_text(
-                        f"❌ <b>Клиент с именем '{html_escape(name)}' уже существует</b>\n\n"
-                        f"💡 <b>Попробуйте:</b>\n"
-                        f"• Другое имя: <code>/add {html_escape(name)}_new</code>\n"
-                        f"• Удалить старый: <code>/del {html_escape(name)}</code>\n"
-                        f"• Посмотреть список: <code>/list</code>",
-                        parse_mode="HTML"
-                    )
-                    return
-        
-    add_res = run_vless(settings, ["add", name])
-    if add_res.returncode != 0:
-        error_output = add_res.stdout or 'Unknown error'
+    if registry(context).has_name(name):
+        await update.message.reply_text(
+            f"❌ <b>Клиент с именем '{html_escape(name)}' уже существует</b>\n\n"
+            f"💡 <b>Попробуйте:</b>\n"
+            f"• Другое имя: <code>/add {html_escape(name)}_new</code>\n"
+            f"• Удалить старый: <code>/del {html_escape(name)}</code>\n"
+            f"• Посмотреть список: <code>/list</code>",
+            parse_mode="HTML"
+        )
+        return
+
+    # Queued: adds, deletes and torrent toggles arriving close together share one config write
+    change = Change(ADD, key=name, client_id=str(uuidlib.uuid4()))
+    batch = await queue_change(context, change)
+    added, _, skipped = parse_import_output(batch.result.stdout or "")
+    uuid = change.client_id
+    if batch.result.returncode != 0 or not any(c.id == uuid for c in added):
+        error_output = batch.result.stdout or 'Unknown error'
         
         # Check if it's a duplicate name error
-        if "already exists" in error_output:
+        if any(entry.startswith(f"{name} (already exists)") for entry in skipped):
             await update.message.reply_text(
                 f"❌ <b>Клиент с именем '{html_escape(name)}' уже существует</b>\n\n"
                 f"💡 <b>Попробуйте:</b>\n"
@@ -138,20 +705,8 @@ async def cmd_add(update: Update, context: ContextTypes.DEFAULT_TYPE, settings:
             await update.message.reply_text(f"❌ <b>Ошибка создания клиента:</b>\n<code>{html_escape(error_output)}</code>", parse_mode="HTML")
         return
 
-    # Extract UUID from add output
-    uuid_match = re.search(r"\b[0-9a-fA-F-]{36}\b", add_res.stdout or "")
-    uuid = uuid_match.group(0) if uuid_match else ""
-
-    # Generate URLs and QR by invoking show on UUID (preferred) or name
-    key = uuid or name
-    show_res = run_vless(settings, ["show", key])
-    url443, url80 = None, None
-    for s in (show_res.stdout or "").splitlines():
-        s = s.strip()
-        if s.startswith("443:"):
-            url443 = s.split(':', 1)[1].strip()
-        elif s.startswith("80:"):
-            url80 = s.split(':', 1)[1].strip()
+    client = registry(context).get(uuid) or Client(id=uuid, email=name)
+    url443, url80 = await client_links(context, client)
 
     if not (url443 or url80):
         await update.message.reply_text(f"⚠️ <b>Клиент создан, но не удалось сгенерировать ссылки</b>\n\nИмя: {html_escape(name)}\nUUID: <code>{html_escape(uuid)}</code>\n\n💡 Попробуйте: <code>/show {html_escape(name)}</code>", parse_mode="HTML")
@@ -167,115 +722,134 @@ async def cmd_add(update: Update, context: ContextTypes.DEFAULT_TYPE, settings:
         body.append(f"🔒 <b>443:</b> <code>{html_escape(url443)}</code>")
     if url80:
         body.append(f"🌐 <b>80:</b> <code>{html_escape(url80)}</code>")
+    sub_url = await subscription_link(context, client)
+    if sub_url:
+        body.append(f"🔄 <b>Подписка:</b> <code>{html_escape(sub_url)}</code>")
     body.append("\n📋 <i>Нажмите на ссылку для копирования</i>")
     text = "\n".join([t for t in (title, uuid_line, "") if t] + body)
     try:
         await update.message.reply_text(text, parse_mode="HTML")
-    except Exception:
+    except Exception as exc:
+        note_error(context, "html_reply", exc)
         await update.message.reply_text(f"✅ Клиент создан: {name}\nUUID: {uuid}\n443: {url443 or ''}\n80: {url80 or ''}")
 
     # Send QR images
-    safe = sanitize_name(name or uuid)
-    qr_sent = 0
-    for suffix in ("443", "80"):
-        path = os.path.join(settings.output_dir, f"{safe}_{suffix}.png")
-        if os.path.exists(path):
-            try:
-                with open(path, "rb") as f:
-                    caption = f"📱 QR-код для порта {suffix}\n🔗 {html_escape(name)}"
-                    await update.message.reply_photo(f, caption=caption, parse_mode="HTML")
-                    qr_sent += 1
-            except Exception:
-                pass
-    
+    qr_sent = await send_qr_codes(update.message, context, client, name, {443: url443, 80: url80})
     if qr_sent == 0:
-        await update.message.reply_text("⚠️ <i>QR-коды не созданы (проверьте установку qrencode)</i>", parse_mode="HTML")
-    
-    # Add restart reminder after client creation
-    await update.message.reply_text(
-        "🔄 <b>Не забудьте перезапустить сервис:</b> /restart",
-        parse_mode="HTML"
-    )
+        await update.message.reply_text("⚠️ <i>QR-коды не созданы (проверьте установку qrcode или qrencode)</i>", parse_mode="HTML")
+
+    notes = [apply_note(batch.result), batch_note(batch, change)]
+    await update.message.reply_text("\n".join(n for n in notes if n), parse_mode="HTML")
+
+
+def render_list_page(context: ContextTypes.DEFAULT_TYPE, settings: Settings, page: int) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    """Render one page of the client list; only names from the registry, no links or QR."""
+    clients = registry(context).clients()
+    if not clients:
+        return "📋 <b>Список клиентов пуст</b>\n\n💡 <i>Создайте первого клиента:</i> <code>/add MyPhone</code>", None
+
+    size = max(1, settings.list_page_size)
+    pages = (len(clients) + size - 1) // size
+    page = min(max(page, 0), pages - 1)
+    start = page * size
+    chunk = clients[start:start + size]
+
+    lines = [f"📋 <b>Список клиентов ({len(clients)})</b> — стр. {page + 1}/{pages}", ""]
+    for idx, client in enumerate(chunk, start=start + 1):
+        lines.append(f"{idx}. {html_escape(client.name)}")
+    lines.append("")
+    lines.append("👇 <i>Нажмите на клиента, чтобы получить ссылки и QR-коды</i>")
+
+    # callback_data carries the exact UUID (36 chars), well within Telegram's 64-byte limit
+    keyboard = [[InlineKeyboardButton(f"👤 {client.name[:40]}", callback_data=f"client:{client.id}")] for client in chunk]
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("◀️", callback_data=f"list:{page - 1}"))
+        nav.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"list:{page}"))
+        if page < pages - 1:
+            nav.append(InlineKeyboardButton("▶️", callback_data=f"list:{page + 1}"))
+        keyboard.append(nav)
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
 
 
 async def cmd_list(update: Update, context: ContextTypes.DEFAULT_TYPE, settings: Settings) -> None:
     if not await _guard_admin(update, context, settings):
         return
-    # Parse list output: header lines + entries "UUID | NAME"
-    res = run_vless(settings, ["list"]) 
-    lines = (res.stdout or "").splitlines()
-    entries: List[Tuple[str, str]] = []  # (uuid, name)
-    for ln in lines:
-        ln = ln.strip()
-        # Skip header and separator lines
-        if ln.startswith("UUID") or ln.startswith("-"):
-            continue
-        # Match UUID | NAME (UUID must contain alphanumeric chars, not just dashes)
-        m = re.match(r"^([0-9a-fA-F-]{36})\s*\|\s*(.*)$", ln)
-        if m:
-            uuid = m.group(1).strip()
-            name = (m.group(2) or "").strip()
-            if name in ("-", ""):
-                name = uuid
-            entries.append((uuid, name))
+    text, markup = render_list_page(context, settings, 0)
+    await update.message.reply_text(text, parse_mode="HTML", reply_markup=markup)
 
-    if not entries:
-        await update.message.reply_text("📋 <b>Список клиентов пуст</b>\n\n💡 <i>Создайте первого клиента:</i> <code>/add MyPhone</code>", parse_mode="HTML")
+
+async def handle_list_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, settings: Settings) -> None:
+    query = update.callback_query
+    if not query or not query.data:
+        return
+    uid = update.effective_user.id if update.effective_user else None
+    if not is_admin(uid, settings):
+        await query.answer("❌ Доступ запрещен", show_alert=True)
         return
+    await query.answer()
 
-    await update.message.chat.send_action("typing")
-    await update.message.reply_text(f"📋 <b>Список клиентов ({len(entries)}):</b>", parse_mode="HTML")
-
-    # Limit to first 5 to avoid flooding; user can use /show for details
-    limit = 5
-    total = len(entries)
-    for idx, (uuid, name) in enumerate(entries[:limit], start=1):
-        # Use vless show to generate URLs and QR
-        show = run_vless(settings, ["show", uuid])
-        url443, url80 = None, None
-        for s in (show.stdout or "").splitlines():
-            s = s.strip()
-            if s.startswith("443:"):
-                url443 = s.split(':', 1)[1].strip()
-            elif s.startswith("80:"):
-                url80 = s.split(':', 1)[1].strip()
-
-        # Format like /show command but more compact
-        title = f"👤 <b>Клиент {idx}: {html_escape(name)}</b>"
-        uuid_line = f"UUID: <code>{html_escape(uuid)}</code>"
-        body = ["📱 <b>Ссылки для подключения:</b>"]
-        if url443:
-            body.append(f"🔒 <b>443:</b> <code>{html_escape(url443)}</code>")
-        if url80:
-            body.append(f"🌐 <b>80:</b> <code>{html_escape(url80)}</code>")
-        body.append("\n📋 <i>Нажмите на ссылку для копирования</i>")
-        text = "\n".join([title, uuid_line, ""] + body)
-        
-        try:
-            await update.message.reply_text(text, parse_mode="HTML")
-        except Exception:
-            # Fallback without formatting
-            await update.message.reply_text(f"👤 Клиент {idx}: {name}\nUUID: {uuid}\n443: {url443 or ''}\n80: {url80 or ''}")
-
-        # Send QR images if available
-        safe = sanitize_name(name or uuid)
-        qr_sent = 0
-        for suffix in ("443", "80"):
-            path = os.path.join(settings.output_dir, f"{safe}_{suffix}.png")
-            if os.path.exists(path):
-                try:
-                    with open(path, "rb") as f:
-                        caption = f"📱 QR-код для порта {suffix}\n🔗 {html_escape(name)}"
-                        await update.message.reply_photo(f, caption=caption, parse_mode="HTML")
-                        qr_sent += 1
-                except Exception:
-                    pass
-        
-        if qr_sent == 0:
-            await update.message.reply_text(f"⚠️ <i>QR-коды для {html_escape(name)} не найдены</i>", parse_mode="HTML")
+    try:
+        page = int(query.data.split(":", 1)[1])
+    except ValueError:
+        page = 0
+    text, markup = render_list_page(context, settings, page)
+    try:
+        await query.edit_message_text(text, parse_mode="HTML", reply_markup=markup)
+    except BadRequest:
+        # "Message is not modified" when the current page button is pressed
+        pass
 
-    if total > limit:
-        await update.message.reply_text(f"📄 <i>Показано первые {limit} из {total} клиентов</i>\n\n🔍 <i>Для конкретного клиента:</i> <code>/show &lt;name|uuid&gt;</code>", parse_mode="HTML")
+
+async def handle_client_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, settings: Settings) -> None:
+    query = update.callback_query
+    if not query or not query.data:
+        return
+    uid = update.effective_user.id if update.effective_user else None
+    if not is_admin(uid, settings):
+        await query.answer("❌ Доступ запрещен", show_alert=True)
+        return
+
+    client = registry(context).get(query.data.split(":", 1)[1])
+    if client is None:
+        await query.answer("❌ Клиент не найден", show_alert=True)
+        return
+    await query.answer()
+    await send_client_details(query.message, context, client, client.name)
+
+
+async def add_on_nodes(message: Message, context: ContextTypes.DEFAULT_TYPE, name: str, nodes: List[str]) -> None:
+    """Add one client with the same UUID on several nodes at once."""
+    if fleet(context).local_name in nodes and registry(context).has_name(name):
+        await message.reply_text(
+            f"❌ <b>Клиент с именем '{html_escape(name)}' уже существует</b> на узле {html_escape(fleet(context).local_name)}",
+            parse_mode="HTML",
+        )
+        return
+    uuid = str(uuidlib.uuid4())
+    title = f"➕ <b>Клиент {html_escape(name)}</b> → {node_list(nodes)}"
+    results = await fan_out_reply(message, context, nodes, ["add", name, uuid], title, describe_client_change("добавлен"))
+    added = [n for n in nodes if results[n].ok]
+    if added:
+        await message.reply_text(
+            f"UUID: <code>{html_escape(uuid)}</code>\n\n"
+            f"🔍 <i>Ссылки и QR-коды узла:</i> <code>/show {html_escape(name)}@{html_escape(added[0])}</code>",
+            parse_mode="HTML",
+        )
+
+
+async def show_on_node(message: Message, context: ContextTypes.DEFAULT_TYPE, key: str, node: str) -> None:
+    """Links of a client on another node, as printed by its ``vless show``."""
+    result = await fleet(context).run(node, ["show", key])
+    if not result.ok:
+        icon, summary = describe_failure(result.result)
+        await message.reply_text(f"{icon} <b>{html_escape(key)}@{html_escape(node)}:</b> {summary}", parse_mode="HTML")
+        return
+    urls = dict(re.findall(r"^(443|80):\s+(vless://\S+)$", result.result.stdout or "", re.MULTILINE))
+    match = re.match(r"vless://([^@]+)@", urls.get("443") or urls.get("80") or "")
+    client = Client(id=match.group(1) if match else "", email=key)
+    await send_client_details(message, context, client, f"{key}@{node}", urls=(urls.get("443"), urls.get("80")))
 
 
 async def cmd_show(update: Update, context: ContextTypes.DEFAULT_TYPE, settings: Settings) -> None:
@@ -285,60 +859,115 @@ async def cmd_show(update: Update, context: ContextTypes.DEFAULT_TYPE, settings:
         await update.message.reply_text("❌ <b>Ошибка:</b> Укажите имя или UUID клиента\n\n💡 <i>Пример:</i> <code>/show iPhone_John</code>", parse_mode="HTML")
         return
         
-    await update.message.chat.send_action("typing")
     key = " ".join(context.args).strip()
-    res = run_vless(settings, ["show", key])
-    
-    if res.returncode != 0:
-        await update.message.reply_text(f"❌ <b>Клиент не найден:</b> {html_escape(key)}\n\n📋 <i>Посмотрите список:</i> /list", parse_mode="HTML")
+    try:
+        key, nodes = split_target(context, key)
+    except KeyError as exc:
+        await reply_unknown_node(update.message, context, exc.args[0])
         return
-        
-    # Parse URLs from output
-    url443, url80 = None, None
-    for line in (res.stdout or "").splitlines():
-        line = line.strip()
-        if line.startswith("443:"):
-            url443 = line.split(":", 1)[1].strip()
-        elif line.startswith("80:"):
-            url80 = line.split(":", 1)[1].strip()
-    
-    if not (url443 or url80):
-        await update.message.reply_text(f"⚠️ <b>Клиент найден, но не удалось сгенерировать ссылки</b>\n\n🔄 <i>Попробуйте перезапустить сервис:</i> /restart", parse_mode="HTML")
+    if not is_local_only(context, nodes):
+        if len(nodes) != 1:
+            await update.message.reply_text("❌ <b>Укажите один узел:</b> <code>/show name@узел</code>", parse_mode="HTML")
+            return
+        await update.message.chat.send_action("typing")
+        await show_on_node(update.message, context, key, nodes[0])
         return
-        
-    await update.message.chat.send_action("upload_photo")
-    
-    # Format rich response
-    title = f"🔍 <b>Конфигурация клиента:</b> {html_escape(key)}"
-    body = ["📱 <b>Ссылки для подключения:</b>"]
-    if url443:
-        body.append(f"🔒 <b>443:</b> <code>{html_escape(url443)}</code>")
-    if url80:
-        body.append(f"🌐 <b>80:</b> <code>{html_escape(url80)}</code>")
-    body.append("\n📋 <i>Нажмите на ссылку для копирования</i>")
-    text = "\n".join([title, ""] + body)
-    
-    try:
-        await update.message.reply_text(text, parse_mode="HTML")
-    except Exception:
-        await update.message.reply_text(f"🔍 Конфигурация: {key}\n443: {url443 or ''}\n80: {url80 or ''}")
-    
-    # Try to send QR images if present
-    safe = sanitize_name(key)
-    qr_sent = 0
-    for suffix in ("443", "80"):
-        path = os.path.join(settings.output_dir, f"{safe}_{suffix}.png")
-        if os.path.exists(path):
-            try:
-                with open(path, "rb") as f:
-                    caption = f"📱 QR-код для порта {suffix}\n🔗 {html_escape(key)}"
-                    await update.message.reply_photo(f, caption=caption, parse_mode="HTML")
-                    qr_sent += 1
-            except Exception:
-                pass
-                
-    if qr_sent == 0:
-        await update.message.reply_text("⚠️ <i>QR-коды не найдены (проверьте установку qrencode)</i>", parse_mode="HTML")
+    client = registry(context).get(key)
+    if client is None:
+        await reply_not_found(update.message, context, key)
+        return
+
+    await update.message.chat.send_action("typing")
+    await send_client_details(update.message, context, client, key)
+
+
+FIND_LIMIT = 10
+FIND_SUGGESTIONS = 5
+
+
+def match_keyboard(matches: List[Match]) -> InlineKeyboardMarkup:
+    """Show and delete buttons per match; both carry the exact UUID, so they cannot hit a namesake."""
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton(f"👤 {m.client.name[:40]}", callback_data=f"client:{m.client.id}"),
+            InlineKeyboardButton("🗑️", callback_data=f"delete_ask:{m.client.id}"),
+        ]
+        for m in matches
+    ])
+
+
+def describe_match(match: Match) -> str:
+    line = f"{html_escape(match.client.name)} — <code>{html_escape(match.client.id[:8])}</code>"
+    if match.kind == FUZZY:
+        line += " <i>(похоже)</i>"
+    return line
+
+
+async def reply_not_found(message: Message, context: ContextTypes.DEFAULT_TYPE, key: str) -> None:
+    matches = client_index(context).search(key, FIND_SUGGESTIONS)
+    if not matches:
+        await message.reply_text(f"❌ <b>Клиент не найден:</b> {html_escape(key)}\n\n📋 <i>Посмотрите список:</i> /list", parse_mode="HTML")
+        return
+    await message.reply_text(
+        f"❌ <b>Клиент не найден:</b> {html_escape(key)}\n\n🔎 <i>Возможно, вы имели в виду:</i>",
+        parse_mode="HTML",
+        reply_markup=match_keyboard(matches),
+    )
+
+
+async def cmd_find(update: Update, context: ContextTypes.DEFAULT_TYPE, settings: Settings) -> None:
+    if not await _guard_admin(update, context, settings):
+        return
+    query = " ".join(context.args or []).strip()
+    if not query:
+        await update.message.reply_text("❌ <b>Ошибка:</b> Укажите часть имени или UUID\n\n💡 <i>Пример:</i> <code>/find john</code>", parse_mode="HTML")
+        return
+
+    matches = client_index(context).search(query, FIND_LIMIT + 1)
+    if not matches:
+        await update.message.reply_text(f"🔎 <b>Ничего не найдено:</b> {html_escape(query)}\n\n📋 <i>Посмотрите список:</i> /list", parse_mode="HTML")
+        return
+    shown = matches[:FIND_LIMIT]
+    lines = [f"🔎 <b>Поиск:</b> {html_escape(query)}", ""]
+    lines += [f"{i}. {describe_match(m)}" for i, m in enumerate(shown, start=1)]
+    if len(matches) > FIND_LIMIT:
+        lines += ["", f"<i>Показаны первые {FIND_LIMIT}; уточните запрос</i>"]
+    lines += ["", "👇 <i>👤 — ссылки и QR-коды, 🗑️ — удалить</i>"]
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML", reply_markup=match_keyboard(shown))
+
+
+# Remote deletes waiting for confirmation: short token -> "name@node" as typed
+DELETE_KEYS_LIMIT = 256
+
+
+def remember_delete_key(context: ContextTypes.DEFAULT_TYPE, key: str) -> str:
+    """Keep ``key`` in the bot and return a token for the button.
+
+    A typed "name@node" can exceed Telegram's 64 bytes of callback_data,
+    and the bot cannot resolve it to a UUID without asking the node.
+    """
+    keys: Dict[str, str] = context.bot_data["delete_keys"]
+    while len(keys) >= DELETE_KEYS_LIMIT:
+        del keys[next(iter(keys))]
+    token = secrets.token_hex(8)
+    keys[token] = key
+    return token
+
+
+def delete_prompt(data: str, label: str) -> Tuple[str, InlineKeyboardMarkup]:
+    """Confirmation for deleting ``label``; the button sends ``data`` back."""
+    keyboard = [
+        [
+            InlineKeyboardButton("🗑️ Удалить", callback_data=data),
+            InlineKeyboardButton("❌ Отмена", callback_data="delete_cancel")
+        ]
+    ]
+    text = (
+        f"⚠️ <b>Подтвердите удаление</b>\n\n"
+        f"👤 Клиент: <code>{html_escape(label)}</code>\n\n"
+        f"⚡ <i>Нажмите кнопку для подтверждения или отмены</i>"
+    )
+    return text, InlineKeyboardMarkup(keyboard)
 
 
 async def cmd_del(update: Update, context: ContextTypes.DEFAULT_TYPE, settings: Settings) -> None:
@@ -349,41 +978,527 @@ async def cmd_del(update: Update, context: ContextTypes.DEFAULT_TYPE, settings:
         return
         
     key = " ".join(context.args).strip()
-    
-    # Create inline keyboard for confirmation
-    keyboard = [
-        [
-            InlineKeyboardButton("🗑️ Удалить", callback_data=f"delete_confirm:{key}"),
-            InlineKeyboardButton("❌ Отмена", callback_data="delete_cancel")
+    try:
+        name, nodes = split_target(context, key)
+    except KeyError as exc:
+        await reply_unknown_node(update.message, context, exc.args[0])
+        return
+    if is_local_only(context, nodes):
+        # Resolve now so the button carries the exact UUID, not whatever was typed
+        client = registry(context).get(name)
+        if client is None:
+            await reply_not_found(update.message, context, name)
+            return
+        data, label = f"delete_confirm:{client.id}", client.name
+    else:
+        data, label = f"delete_remote:{remember_delete_key(context, key)}", key
+
+    # Confirmation prompt with buttons
+    text, reply_markup = delete_prompt(data, label)
+    await update.message.reply_text(text, parse_mode="HTML", reply_markup=reply_markup)
+
+
+IMPORT_MAX_BYTES = 5 * 1024 * 1024
+
+
+def parse_import_output(output: str) -> Tuple[List[Client], List[Client], List[str]]:
+    """Split `vless import` output into (added, removed, skipped) entries."""
+    added: List[Client] = []
+    removed: List[Client] = []
+    skipped: List[str] = []
+    for line in output.splitlines():
+        kind, _, rest = line.strip().partition(" ")
+        if kind in ("ADDED", "REMOVED"):
+            uuid, _, name = rest.partition(" ")
+            (added if kind == "ADDED" else removed).append(Client(id=uuid, email=name))
+        elif kind == "SKIPPED":
+            skipped.append(rest)
+    return added, removed, skipped
+
+
+def torrents_state(output: str) -> str:
+    """Return the TORRENTS value of `vless import` output ("block", "unblock", "unchanged" or "")."""
+    for line in output.splitlines():
+        kind, _, rest = line.strip().partition(" ")
+        if kind == "TORRENTS":
+            return rest.strip()
+    return ""
+
+
+def routing_state(output: str, change: Change) -> str:
+    """Return the ROUTING state of a block/unblock change in `vless import` output ("changed", "unchanged" or "")."""
+    for line in output.splitlines():
+        kind, _, rest = line.strip().partition(" ")
+        if kind == "ROUTING":
+            state, _, edit = rest.partition(" ")
+            op, _, items = edit.partition(" ")
+            if op == change.kind and items.split() == list(change.items):
+                return state
+    return ""
+
+
+def build_links_zip(clients: List[Client], params: RealityParams, qr_cache: QrCache) -> bytes:
+    """Zip a links.csv plus 443/80 QR PNGs for every client (runs in a worker thread)."""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        rows = io.StringIO()
+        writer = csv.writer(rows)
+        writer.writerow(["name", "uuid", "url_443", "url_80"])
+        for client in clients:
+            urls = client_urls(client, params)
+            writer.writerow([client.email, client.id, urls.get(443, ""), urls.get(80, "")])
+            safe = sanitize_name(client.name)
+            for port, url in urls.items():
+                # PNGs are already compressed
+                zf.writestr(f"qr/{safe}_{client.id[:8]}_{port}.png", qr_cache.get(url), compress_type=zipfile.ZIP_STORED)
+        zf.writestr("links.csv", rows.getvalue())
+    return buf.getvalue()
+
+
+async def cmd_import(update: Update, context: ContextTypes.DEFAULT_TYPE, settings: Settings) -> None:
+    if not await _guard_admin(update, context, settings):
+        return
+    message = update.message
+    document = message.document or (message.reply_to_message.document if message.reply_to_message else None)
+    if document is None:
+        await message.reply_text(
+            "📥 <b>Массовый импорт клиентов</b>\n\n"
+            "Отправьте файл <code>.csv</code> или <code>.json</code> с подписью <code>/import</code> "
+            "(или ответьте <code>/import</code> на сообщение с файлом).\n\n"
+            "CSV: <code>name</code>, <code>add,name</code> или <code>del,name|uuid</code> — по одной строке\n"
+            "JSON: <code>{\"add\": [\"name\", ...], \"del\": [\"name|uuid\", ...]}</code>",
+            parse_mode="HTML"
+        )
+        return
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await message.reply_text("❌ <b>Ошибка:</b> Файл слишком большой (макс. 5 МБ)", parse_mode="HTML")
+        return
+
+    await message.chat.send_action("typing")
+    with tempfile.TemporaryDirectory(prefix="vless-import-") as tmpdir:
+        ext = os.path.splitext(document.file_name or "")[1].lower()
+        path = os.path.join(tmpdir, "import" + (ext if ext in (".csv", ".json", ".txt") else ".csv"))
+        tg_file = await document.get_file()
+        await tg_file.download_to_drive(path)
+        res = await run_vless(context, ["import", path])
+
+    if res.returncode != 0:
+        await message.reply_text(f"❌ <b>Ошибка импорта:</b>\n<pre>{html_escape((res.stdout or 'Неизвестная ошибка')[:3000])}</pre>", parse_mode="HTML")
+        return
+
+    added, removed, skipped = parse_import_output(res.stdout or "")
+    lines = [
+        "📥 <b>Импорт завершён</b>",
+        "",
+        f"✅ Добавлено: {len(added)}",
+        f"🗑️ Удалено: {len(removed)}",
+        f"⏭️ Пропущено: {len(skipped)}",
+    ]
+    for entry in skipped[:10]:
+        lines.append(f"  • {html_escape(entry)}")
+    if len(skipped) > 10:
+        lines.append(f"  … и ещё {len(skipped) - 10}")
+    if added or removed:
+        lines.append("")
+        lines.append(apply_note(res))
+    await message.reply_text("\n".join(lines), parse_mode="HTML")
+    if removed:
+        await limits(context).forget([c.id for c in removed])
+
+    if not added:
+        return
+    try:
+        params = await reality_params(context)
+    except (OSError, ValueError):
+        await message.reply_text("⚠️ <b>Клиенты добавлены, но не удалось сгенерировать ссылки</b>", parse_mode="HTML")
+        return
+    await message.chat.send_action("upload_document")
+    archive = await asyncio.to_thread(build_links_zip, added, params, context.bot_data["qr_cache"])
+    await message.reply_document(
+        archive,
+        filename=f"vless-import-{time.strftime('%Y%m%d_%H%M%S')}.zip",
+        caption=f"📦 Ссылки и QR-коды для {len(added)} новых клиентов",
+    )
+
+
+# Rates are averaged over roughly this many seconds of recent samples
+STATS_RATE_WINDOW = 300.0
+
+
+def format_bytes(value: float) -> str:
+    for unit in ("Б", "КБ", "МБ", "ГБ"):
+        if value < 1024:
+            return f"{value:.0f} {unit}" if unit == "Б" else f"{value:.1f} {unit}"
+        value /= 1024
+    return f"{value:.1f} ТБ"
+
+
+def format_rate(bytes_per_second: float) -> str:
+    bits = bytes_per_second * 8
+    if bits < 1000 * 1000:
+        return f"{bits / 1000:.0f} кбит/с"
+    return f"{bits / 1000 / 1000:.1f} Мбит/с"
+
+
+async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, settings: Settings) -> None:
+    if not await _guard_admin(update, context, settings):
+        return
+    stats: Optional[TrafficStats] = context.bot_data.get("traffic")
+    poller: Optional[StatsPoller] = context.bot_data.get("stats_poller")
+    if stats is None or poller is None:
+        await update.message.reply_text("ℹ️ <b>Сбор статистики выключен</b> (<code>VLESS_STATS_INTERVAL=0</code>)", parse_mode="HTML")
+        return
+    warning = ""
+    if poller.last_error:
+        warning = (
+            f"⚠️ <b>Статистика Xray недоступна:</b> <code>{html_escape(poller.last_error[:300])}</code>\n"
+            "💡 <i>Включите её:</i> <code>sudo vless enable-api</code>\n\n"
+        )
+
+    if context.args:
+        key = " ".join(context.args).strip()
+        client = registry(context).get(key)
+        # Xray counts traffic per email, i.e. per client name
+        email = client.email if client else key
+        traffic = stats.get(email) if email else None
+        if traffic is None:
+            await update.message.reply_text(f"{warning}📊 Нет данных о трафике для <code>{html_escape(key)}</code>", parse_mode="HTML")
+            return
+        since = time.time() - 24 * 3600
+        history = await asyncio.to_thread(stats.history, email, since)
+        day_up = sum(up for _, up, _ in history)
+        day_down = sum(down for _, _, down in history)
+        lines = [
+            f"📊 <b>Трафик:</b> {html_escape(email)}",
+            "",
+            f"⬇️ Загрузка: {format_bytes(traffic.total_down)}",
+            f"⬆️ Отдача: {format_bytes(traffic.total_up)}",
+            f"📅 За 24 ч: ⬇️ {format_bytes(day_down)} ⬆️ {format_bytes(day_up)}",
+            f"⚡ Сейчас: ⬇️ {format_rate(traffic.rate_down)} ⬆️ {format_rate(traffic.rate_up)}",
         ]
+        await update.message.reply_text(warning + "\n".join(lines), parse_mode="HTML")
+        return
+
+    top = stats.top(10)
+    if not top:
+        await update.message.reply_text(f"{warning}📊 <b>Данных о трафике пока нет</b>", parse_mode="HTML")
+        return
+    lines = ["📊 <b>Топ клиентов по трафику</b>", ""]
+    for i, traffic in enumerate(top, 1):
+        lines.append(
+            f"{i}. <code>{html_escape(traffic.email)}</code> — {format_bytes(traffic.total)}"
+            f" (⬇️ {format_rate(traffic.rate_down)} ⬆️ {format_rate(traffic.rate_up)})"
+        )
+    lines.append("")
+    lines.append("💡 <i>Подробно по клиенту:</i> <code>/stats name</code>")
+    await update.message.reply_text(warning + "\n".join(lines), parse_mode="HTML")
+
+
+def format_ago(seconds: float) -> str:
+    if seconds < 60:
+        return f"{max(0, int(seconds))} с назад"
+    if seconds < 3600:
+        return f"{int(seconds // 60)} мин назад"
+    if seconds < 86400:
+        return f"{int(seconds // 3600)} ч назад"
+    return f"{int(seconds // 86400)} дн назад"
+
+
+async def cmd_connections(update: Update, context: ContextTypes.DEFAULT_TYPE, settings: Settings) -> None:
+    if not await _guard_admin(update, context, settings):
+        return
+    follower: Optional[AccessLogFollower] = context.bot_data.get("access")
+    if follower is None:
+        await update.message.reply_text("ℹ️ <b>Анализ подключений выключен</b> (<code>VLESS_ACCESS_LOG=off</code>)", parse_mode="HTML")
+        return
+    source = follower.source
+    if source is None or source.kind == OFF:
+        await update.message.reply_text(
+            "ℹ️ <b>Журнал подключений Xray выключен</b>\n\n"
+            "💡 <i>Включите его:</i> <code>sudo vless access-log on</code>",
+            parse_mode="HTML"
+        )
+        return
+    warning = ""
+    if follower.last_error:
+        warning = f"⚠️ <b>Журнал недоступен:</b> <code>{html_escape(follower.last_error[:300])}</code>\n\n"
+    analyzer = follower.analyzer
+    now = time.time()
+
+    if context.args:
+        key = " ".join(context.args).strip()
+        client = registry(context).get(key)
+        # Xray logs the client's email, i.e. its name
+        email = client.email if client else key
+        activity = analyzer.clients.get(email) if email else None
+        if activity is None:
+            await update.message.reply_text(f"{warning}👣 Нет подключений клиента <code>{html_escape(key)}</code>", parse_mode="HTML")
+            return
+        lines = [
+            f"👣 <b>Подключения:</b> {html_escape(email)}",
+            "",
+            f"🔢 Всего: {activity.connections}",
+            f"⏱️ За {int(analyzer.window // 60)} мин: {activity.window.count(now)}",
+            f"🕒 Последнее: {format_ago(now - activity.last_seen)} с <code>{html_escape(activity.last_source)}</code>",
+        ]
+        recent = activity.recent_sources(now - 86400)
+        if recent:
+            lines += ["", f"🌍 <b>Адреса за 24 ч</b> ({len(recent)}):"]
+            lines += [f"• <code>{html_escape(address)}</code> — {format_ago(now - seen)}" for address, seen in recent]
+        await update.message.reply_text(warning + "\n".join(lines), parse_mode="HTML")
+        return
+
+    summary = analyzer.summary(now)
+    minutes = int(summary.window // 60)
+    lines = [
+        f"👣 <b>Подключения за {minutes} мин</b>",
+        "",
+        f"✅ Принято: {summary.accepted}   ⛔ Отклонено: {summary.rejected}",
+        f"👥 Активных клиентов: {summary.active_clients}",
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    # Confirmation prompt with buttons
+    if summary.top_clients:
+        lines += ["", "🏆 <b>Самые активные:</b>"]
+        for i, (email, count) in enumerate(summary.top_clients, 1):
+            addresses = len(analyzer.clients[email].recent_sources(now - 3600))
+            lines.append(f"{i}. <code>{html_escape(email)}</code> — {count} (IP за час: {addresses})")
+    if summary.rejected_sources:
+        lines += ["", "⛔ <b>Отклонённые подключения</b> (неверный UUID):"]
+        for address, count in summary.rejected_sources[:5]:
+            mark = " ⚠️" if count >= settings.auth_flood else ""
+            lines.append(f"• <code>{html_escape(address)}</code> — {count}{mark}")
+    lines += ["", f"📄 <i>Источник: {html_escape(source.describe())}</i>"]
+    if summary.last_event_at:
+        lines.append(f"🕒 <i>Последняя запись: {format_ago(now - summary.last_event_at)}</i>")
+    lines.append("💡 <i>Подробно по клиенту:</i> <code>/connections name</code>")
+    await update.message.reply_text(warning + "\n".join(lines), parse_mode="HTML")
+
+
+def limits(context: ContextTypes.DEFAULT_TYPE) -> LimitScheduler:
+    return context.bot_data["limits"]
+
+
+def format_date(timestamp: float) -> str:
+    return time.strftime("%d.%m.%Y %H:%M", time.localtime(timestamp))
+
+
+def format_left(seconds: float) -> str:
+    if seconds <= 0:
+        return "срок истёк"
+    if seconds < 3600:
+        return f"через {max(1, int(seconds // 60))} мин"
+    if seconds < 86400:
+        return f"через {int(seconds // 3600)} ч"
+    return f"через {int(seconds // 86400)} дн"
+
+
+def describe_limit(scheduler: LimitScheduler, limit: ClientLimit, now: float) -> str:
+    parts = []
+    if limit.expires_at is not None:
+        parts.append(f"⏳ до {format_date(limit.expires_at)} ({format_left(limit.expires_at - now)})")
+    if limit.quota is not None:
+        parts.append(describe_quota(scheduler, limit))
+    return ", ".join(parts)
+
+
+def describe_quota(scheduler: LimitScheduler, limit: ClientLimit) -> str:
+    used = scheduler.used(limit)
+    return f"📦 {format_bytes(used) if used is not None else '?'} из {format_bytes(limit.quota or 0)}"
+
+
+def traffic_total(stats: TrafficStats, email: str) -> int:
+    traffic = stats.get(email)
+    return traffic.total if traffic is not None else 0
+
+
+LIMITS_LIST_SIZE = 30
+
+
+def render_limits(scheduler: LimitScheduler, settings: Settings) -> str:
+    entries = scheduler.upcoming()
+    if not entries:
+        return (
+            "♾️ <b>Ни у одного клиента нет срока действия или квоты</b>\n\n"
+            "💡 <i>Пример:</i> <code>/expire iPhone_John 30d</code>, <code>/quota iPhone_John 50GB</code>"
+        )
+    now = time.time()
+    lines = [f"⏳ <b>Сроки и квоты клиентов</b> ({len(entries)})", ""]
+    for i, limit in enumerate(entries[:LIMITS_LIST_SIZE], 1):
+        lines.append(f"{i}. <code>{html_escape(limit.name)}</code> — {describe_limit(scheduler, limit, now)}")
+    if len(entries) > LIMITS_LIST_SIZE:
+        lines.append(f"… и ещё {len(entries) - LIMITS_LIST_SIZE}")
+    lines.append("")
+    if scheduler.last_error:
+        lines.append(f"⚠️ <b>Последнее удаление не удалось:</b> <code>{html_escape(scheduler.last_error[:300])}</code>")
+    if settings.expiry_window > 0:
+        lines.append(f"📦 <i>Клиенты, истекающие в пределах {int(settings.expiry_window)} с, удаляются одним изменением конфигурации</i>")
+    lines.append("💡 <i>Снять ограничение:</i> <code>/expire name off</code>, <code>/quota name off</code>")
+    return "\n".join(lines)
+
+
+def split_limit_args(args: List[str], parse):
+    """Split "/expire name with spaces 2025-12-31 18:00" into the client key and the parsed value."""
+    # A date with a time takes the last two words
+    for n in (2, 1):
+        if len(args) > n:
+            try:
+                return " ".join(args[:-n]), parse(" ".join(args[-n:]))
+            except ValueError:
+                continue
+    raise ValueError(" ".join(args[-1:]))
+
+
+async def cmd_expire(update: Update, context: ContextTypes.DEFAULT_TYPE, settings: Settings) -> None:
+    if not await _guard_admin(update, context, settings):
+        return
+    scheduler = limits(context)
+    if not context.args:
+        await update.message.reply_text(render_limits(scheduler, settings), parse_mode="HTML")
+        return
+    try:
+        key, expires_at = split_limit_args(context.args, parse_expiry)
+    except ValueError:
+        await update.message.reply_text(
+            "❌ <b>Ошибка:</b> Укажите клиента и срок\n\n"
+            "💡 <i>Примеры:</i> <code>/expire iPhone_John 30d</code>, <code>/expire iPhone_John 2025-12-31</code>, "
+            "<code>/expire iPhone_John 2025-12-31 18:00</code>, <code>/expire iPhone_John off</code>\n"
+            "<i>Единицы: m (минуты), h (часы), d (дни), w (недели)</i>",
+            parse_mode="HTML"
+        )
+        return
+    client = registry(context).get(key)
+    if client is None:
+        await update.message.reply_text(f"❌ <b>Клиент не найден:</b> {html_escape(key)}\n\n📋 <i>Посмотрите список:</i> /list", parse_mode="HTML")
+        return
+    now = time.time()
+    if expires_at is not None and expires_at <= now:
+        await update.message.reply_text(f"❌ <b>Дата уже прошла:</b> {format_date(expires_at)}", parse_mode="HTML")
+        return
+
+    limit = await scheduler.set_expiry(client, expires_at, update.effective_user.id)
+    if expires_at is None:
+        await update.message.reply_text(f"♾️ <b>Срок действия снят</b>\n\n👤 {html_escape(client.name)}", parse_mode="HTML")
+        return
     await update.message.reply_text(
-        f"⚠️ <b>Подтвердите удаление</b>\n\n"
-        f"👤 Клиент: <code>{html_escape(key)}</code>\n\n"
-        f"⚡ <i>Нажмите кнопку для подтверждения или отмены</i>",
-        parse_mode="HTML",
-        reply_markup=reply_markup
+        f"⏳ <b>Срок действия установлен</b>\n\n"
+        f"👤 {html_escape(client.name)}\n"
+        f"📅 Удаление: {format_date(expires_at)} ({format_left(expires_at - now)})\n"
+        + (f"{describe_quota(scheduler, limit)}\n" if limit.quota is not None else "")
+        + f"\n🔔 <i>Когда клиент будет удалён, придёт уведомление</i>\n"
+        f"💡 <i>Отменить:</i> <code>/expire {html_escape(client.name)} off</code>",
+        parse_mode="HTML"
+    )
+
+
+async def cmd_quota(update: Update, context: ContextTypes.DEFAULT_TYPE, settings: Settings) -> None:
+    if not await _guard_admin(update, context, settings):
+        return
+    scheduler = limits(context)
+    if not context.args:
+        await update.message.reply_text(render_limits(scheduler, settings), parse_mode="HTML")
+        return
+    try:
+        key, quota = split_limit_args(context.args, parse_quota)
+    except ValueError:
+        await update.message.reply_text(
+            "❌ <b>Ошибка:</b> Укажите клиента и объём трафика с единицей (MB, GB, TB)\n\n"
+            "💡 <i>Примеры:</i> <code>/quota iPhone_John 50GB</code>, <code>/quota iPhone_John 500MB</code>, <code>/quota iPhone_John off</code>",
+            parse_mode="HTML"
+        )
+        return
+    client = registry(context).get(key)
+    if client is None:
+        await update.message.reply_text(f"❌ <b>Клиент не найден:</b> {html_escape(key)}\n\n📋 <i>Посмотрите список:</i> /list", parse_mode="HTML")
+        return
+    poller: Optional[StatsPoller] = context.bot_data.get("stats_poller")
+    if quota is not None and poller is None:
+        await update.message.reply_text("ℹ️ <b>Квоты считаются по статистике трафика, а она выключена</b> (<code>VLESS_STATS_INTERVAL=0</code>)", parse_mode="HTML")
+        return
+
+    await scheduler.set_quota(client, quota, update.effective_user.id)
+    if quota is None:
+        await update.message.reply_text(f"♾️ <b>Квота снята</b>\n\n👤 {html_escape(client.name)}", parse_mode="HTML")
+        return
+    warning = ""
+    if poller.last_error:
+        warning = (
+            f"\n\n⚠️ <b>Статистика Xray недоступна:</b> <code>{html_escape(poller.last_error[:300])}</code>\n"
+            "💡 <i>Без неё квота не проверяется. Включите:</i> <code>sudo vless enable-api</code>"
+        )
+    await update.message.reply_text(
+        f"📦 <b>Квота установлена</b>\n\n"
+        f"👤 {html_escape(client.name)}\n"
+        f"📊 {format_bytes(quota)} (загрузка + отдача), считая с этого момента\n\n"
+        f"🔔 <i>Когда квота закончится, клиент будет удалён и придёт уведомление</i>\n"
+        f"💡 <i>Отменить:</i> <code>/quota {html_escape(client.name)} off</code>"
+        + warning,
+        parse_mode="HTML"
     )
 
 
+async def remove_expired_clients(app: Application, due: List[ClientLimit]) -> Optional[List[str]]:
+    """Delete the clients the limit scheduler found due in one `vless import` batch."""
+    present = [limit for limit in due if app.bot_data["registry"].get(limit.id) is not None]
+    if not present:
+        return []
+    queue: ChangeQueue = app.bot_data["changes"]
+    batch = await queue.submit_all([Change(DELETE, key=limit.id) for limit in present])
+    if batch.result.returncode != 0:
+        raise RuntimeError(output_tail(batch.result) or f"vless import exited with code {batch.result.returncode}")
+    _, removed, _ = parse_import_output(batch.result.stdout or "")
+    return [c.id for c in removed]
+
+
+async def notify_expired(app: Application, settings: Settings, done: List[Enforcement]) -> None:
+    """Tell each owning admin which of their clients were removed; unknown owners go to the first admin."""
+    by_owner: Dict[int, List[str]] = {}
+    for enforced in done:
+        limit = enforced.limit
+        owner = limit.owner if limit.owner in settings.admins else settings.admins[0]
+        if enforced.reason == EXPIRED:
+            line = f"• <code>{html_escape(limit.name)}</code> — срок истёк {format_date(limit.expires_at or 0)}"
+        else:
+            line = f"• <code>{html_escape(limit.name)}</code> — квота {format_bytes(limit.quota or 0)} исчерпана ({format_bytes(enforced.used)})"
+        by_owner.setdefault(owner, []).append(line)
+    for owner, lines in by_owner.items():
+        shown = lines[:50]
+        if len(lines) > 50:
+            shown.append(f"… и ещё {len(lines) - 50}")
+        text = f"⌛ <b>Клиенты удалены автоматически</b> ({len(lines)})\n\n" + "\n".join(shown)
+        try:
+            await app.bot.send_message(owner, text, parse_mode="HTML")
+        except TelegramError as exc:
+            app.bot_data["metrics"].suppressed("expiry_notify", exc)
+
+
 async def cmd_restart(update: Update, context: ContextTypes.DEFAULT_TYPE, settings: Settings) -> None:
     if not await _guard_admin(update, context, settings):
         return
-        
+    if context.args:
+        try:
+            nodes = fleet(context).resolve(" ".join(context.args))
+        except KeyError as exc:
+            await reply_unknown_node(update.message, context, exc.args[0])
+            return
+        if not is_local_only(context, nodes):
+            await fan_out_reply(update.message, context, nodes, ["restart"], "🔄 <b>Перезапуск Xray</b>", describe_restart)
+            return
+
     await update.message.reply_text("🔄 <b>Перезапуск Xray...</b>", parse_mode="HTML")
     await update.message.chat.send_action("typing")
     
-    res = run_vless(settings, ["restart"])
+    res = await run_vless(context, ["restart"])
     
     if res.returncode == 0:
-        await update.message.reply_text(
-            "✅ <b>Xray успешно перезапущен</b>\n\n"
-            "🚀 <i>Все клиенты могут подключаться</i>",
-            parse_mode="HTML"
-        )
+        lines = ["✅ <b>Xray успешно перезапущен</b>", ""]
+        ready_ms = ready_time_ms(res)
+        if ready_ms is not None:
+            lines.append(f"⏱️ Порты принимают подключения через {ready_ms / 1000:.1f} с")
+            history = await asyncio.to_thread(read_restart_history, os.path.join(settings.state_dir, "restart.log"))
+            if history and history.p50_ms is not None and history.count > 1:
+                lines.append(f"📈 <i>Обычно: {history.p50_ms / 1000:.1f} с (p95 {history.p95_ms / 1000:.1f} с)</i>")
+            lines.append("")
+        lines.append("🚀 <i>Все клиенты могут подключаться</i>")
+        await update.message.reply_text("\n".join(lines), parse_mode="HTML")
     else:
         await update.message.reply_text(
             f"❌ <b>Ошибка перезапуска:</b>\n"
@@ -400,7 +1515,7 @@ async def cmd_fix(update: Update, context: ContextTypes.DEFAULT_TYPE, settings:
     await update.message.reply_text("🔧 <b>Исправление прав доступа и перезапуск...</b>", parse_mode="HTML")
     await update.message.chat.send_action("typing")
     
-    res = run_vless(settings, ["fix"])
+    res = await run_vless(context, ["fix"])
     
     if res.returncode == 0:
         await update.message.reply_text(
@@ -420,33 +1535,127 @@ async def cmd_fix(update: Update, context: ContextTypes.DEFAULT_TYPE, settings:
         )
 
 
+CHECK_TITLES = {
+    "service": "🚀 Служба Xray",
+    "config": "⚙️ Конфигурация",
+    "ports": "🔌 Порты",
+    "api": "🧩 Xray API",
+    "logs": "📜 Логи",
+    "public_ip": "🌐 Внешний IP",
+    "restarts": "⏱️ Перезапуски",
+    "access": "👣 Подключения",
+}
+
+STATUS_ICONS = {PASS: "✅", WARN: "⚠️", FAIL: "❌"}
+
+
+def render_doctor_summary(report: Report) -> Tuple[str, InlineKeyboardMarkup]:
+    headline = {
+        PASS: "✅ всё в порядке",
+        WARN: "⚠️ есть предупреждения",
+        FAIL: "❌ есть ошибки",
+    }[report.status]
+    lines = [f"🪐 <b>Диагностика сервера:</b> {headline}", ""]
+    for r in report.results:
+        lines.append(
+            f"{STATUS_ICONS[r.status]} <b>{CHECK_TITLES.get(r.name, html_escape(r.name))}</b> — "
+            f"{html_escape(r.summary)} <i>({r.duration:.2f} с)</i>"
+        )
+    age = max(0, int(time.time() - report.finished_at))
+    lines.append("")
+    lines.append(f"⏱️ <i>Проверка заняла {report.duration:.1f} с" + (f", результат {age} с назад</i>" if age else "</i>"))
+    keyboard = InlineKeyboardMarkup([[
+        InlineKeyboardButton("📄 Подробности", callback_data="doctor:details"),
+        InlineKeyboardButton("🔄 Повторить", callback_data="doctor:refresh"),
+    ]])
+    return "\n".join(lines), keyboard
+
+
+def render_doctor_details(report: Report) -> List[str]:
+    """Raw check output split into <pre> messages that fit Telegram's limit."""
+    sections = []
+    for r in report.results:
+        title = CHECK_TITLES.get(r.name, r.name)
+        sections.append(f"== {title}: {r.status} ==\n{r.detail or r.summary}")
+    text = "\n\n".join(sections)
+    max_length = 4000
+    chunks = [text[i:i + max_length] for i in range(0, len(text), max_length)] or [""]
+    return [f"<pre>{html_escape(chunk)}</pre>" for chunk in chunks]
+
+
 async def cmd_doctor(update: Update, context: ContextTypes.DEFAULT_TYPE, settings: Settings) -> None:
     if not await _guard_admin(update, context, settings):
         return
-        
-    await update.message.reply_text("🪐 <b>Запуск диагностики...</b>", parse_mode="HTML")
-    await update.message.chat.send_action("typing")
-    
-    res = run_vless(settings, ["doctor"])
-    output = res.stdout or "Нет вывода"
-    
-    # Format the output with emojis and structure
-    formatted_output = output.replace("== Service Status ==", "🚀 <b>Статус сервиса</b>")
-    formatted_output = formatted_output.replace("== Service List ==", "📋 <b>Список служб</b>")
-    formatted_output = formatted_output.replace("== Last logs ==", "📜 <b>Последние логи</b>")
-    formatted_output = formatted_output.replace("== Configuration ==", "⚙️ <b>Конфигурация</b>")
-    formatted_output = formatted_output.replace("== Ports ==", "🔌 <b>Порты</b>")
-    formatted_output = formatted_output.replace("== Public IP ==", "🌐 <b>Внешний IP</b>")
-    
-    # Split into chunks if too long
+    if context.args:
+        try:
+            nodes = fleet(context).resolve(" ".join(context.args))
+        except KeyError as exc:
+            await reply_unknown_node(update.message, context, exc.args[0])
+            return
+        if not is_local_only(context, nodes):
+            await doctor_on_nodes(update.message, context, nodes)
+            return
+    diagnostics: Diagnostics = context.bot_data["diagnostics"]
+    if diagnostics.cached() is None:
+        await update.message.chat.send_action("typing")
+    report = await diagnostics.run()
+    text, keyboard = render_doctor_summary(report)
+    await update.message.reply_text(text, parse_mode="HTML", reply_markup=keyboard)
+
+
+async def doctor_on_nodes(message: Message, context: ContextTypes.DEFAULT_TYPE, nodes: List[str]) -> None:
+    """``vless doctor`` on each node; the full output follows when only one node was asked."""
+    results = await fan_out_reply(message, context, nodes, ["doctor"], "🪐 <b>Диагностика узлов</b>", describe_doctor)
+    if len(nodes) > 1:
+        await message.reply_text("📄 <i>Подробности по узлу:</i> <code>/doctor узел</code>", parse_mode="HTML")
+        return
+    text = ANSI_RE.sub("", results[nodes[0]].result.stdout or "")
     max_length = 4000
-    if len(formatted_output) > max_length:
-        chunks = [formatted_output[i:i+max_length] for i in range(0, len(formatted_output), max_length)]
-        await update.message.reply_text(f"🪐 <b>Диагностика сервера</b> (1/{len(chunks)}):\n\n<pre>{html_escape(chunks[0])}</pre>", parse_mode="HTML")
-        for i, chunk in enumerate(chunks[1:], 2):
-            await update.message.reply_text(f"<b>Часть {i}/{len(chunks)}:</b>\n\n<pre>{html_escape(chunk)}</pre>", parse_mode="HTML")
+    for i in range(0, len(text), max_length):
+        await message.reply_text(f"<pre>{html_escape(text[i:i + max_length])}</pre>", parse_mode="HTML")
+
+
+async def handle_doctor_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, settings: Settings) -> None:
+    query = update.callback_query
+    if not query or not query.data:
+        return
+    uid = update.effective_user.id if update.effective_user else None
+    if not is_admin(uid, settings):
+        await query.answer("❌ Доступ запрещен", show_alert=True)
+        return
+    diagnostics: Diagnostics = context.bot_data["diagnostics"]
+    if query.data == "doctor:refresh":
+        await query.answer("🔄 Проверяю...")
+        report = await diagnostics.run(force=True)
+        text, keyboard = render_doctor_summary(report)
+        try:
+            await query.edit_message_text(text, parse_mode="HTML", reply_markup=keyboard)
+        except BadRequest:
+            # Identical text (nothing changed within the same second)
+            pass
+        return
+    await query.answer()
+    # Details of the report the summary was built from, even if it is past its TTL
+    report = diagnostics.last or await diagnostics.run()
+    for chunk in render_doctor_details(report):
+        await query.message.reply_text(chunk, parse_mode="HTML")
+
+
+async def cmd_nodes(update: Update, context: ContextTypes.DEFAULT_TYPE, settings: Settings) -> None:
+    if not await _guard_admin(update, context, settings):
+        return
+    nodes = fleet(context).nodes
+    lines = ["🖧 <b>Узлы</b>", "", f"🏠 <b>{html_escape(fleet(context).local_name)}</b> — этот сервер"]
+    for node in nodes.nodes():
+        state = "🔗" if fleet(context).transport.is_connected(node) else "💤"
+        lines.append(f"{state} <b>{html_escape(node.name)}</b> — <code>{html_escape(node.user)}@{html_escape(node.host)}:{node.port}</code>")
+    if nodes.error:
+        lines += ["", f"⚠️ <b>Ошибка в списке узлов:</b> <code>{html_escape(nodes.error)}</code>"]
+    if len(lines) == 3:
+        lines += ["", f"💡 <i>Добавьте удалённые серверы в</i> <code>{html_escape(nodes.path)}</code>"]
     else:
-        await update.message.reply_text(f"🪐 <b>Диагностика сервера:</b>\n\n<pre>{html_escape(formatted_output)}</pre>", parse_mode="HTML")
+        lines += ["", "🔗 <i>есть открытое SSH-соединение</i>  💤 <i>нет</i>"]
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
 
 
 async def cmd_block_torrents(update: Update, context: ContextTypes.DEFAULT_TYPE, settings: Settings) -> None:
@@ -456,8 +1665,16 @@ async def cmd_block_torrents(update: Update, context: ContextTypes.DEFAULT_TYPE,
     await update.message.reply_text("🚫 <b>Блокировка торрент-трафика...</b>", parse_mode="HTML")
     await update.message.chat.send_action("typing")
 
-    res = run_vless(settings, ["block-torrents"])
-    if res.returncode == 0:
+    change = Change(BLOCK_TORRENTS)
+    batch = await queue_change(context, change)
+    res = batch.result
+    if res.returncode == 0 and torrents_state(res.stdout or "") == "unchanged":
+        await update.message.reply_text("ℹ️ <b>Торренты уже заблокированы</b>", parse_mode="HTML")
+    elif res.returncode == 0 and torrents_state(res.stdout or "") == "unblock":
+        # A later toggle in the same batch wins
+        await update.message.reply_text("ℹ️ <b>Блокировка отменена командой /unblock_torrents, пришедшей следом</b>", parse_mode="HTML")
+    elif res.returncode == 0:
+        note = batch_note(batch, change)
         await update.message.reply_text(
             "✅ <b>Торренты заблокированы!</b>\n\n"
             "🚫 <b>Заблокировано:</b>\n"
@@ -465,6 +1682,7 @@ async def cmd_block_torrents(update: Update, context: ContextTypes.DEFAULT_TYPE,
             "• Порты 6881-6889, 51413\n"
             "• UDP порты 1337, 6969, 8080, 2710\n"
             "• Домены: tracker, torrent, популярные торрент-сайты\n\n"
+            + (f"{note}\n\n" if note else "") +
             "💡 <i>Для отмены используйте /unblock_torrents</i>", 
             parse_mode="HTML"
         )
@@ -484,11 +1702,20 @@ async def cmd_unblock_torrents(update: Update, context: ContextTypes.DEFAULT_TYP
     await update.message.reply_text("🌐 <b>Разблокировка торрент-трафика...</b>", parse_mode="HTML")
     await update.message.chat.send_action("typing")
 
-    res = run_vless(settings, ["unblock-torrents"])
-    if res.returncode == 0:
+    change = Change(UNBLOCK_TORRENTS)
+    batch = await queue_change(context, change)
+    res = batch.result
+    if res.returncode == 0 and torrents_state(res.stdout or "") == "unchanged":
+        await update.message.reply_text("ℹ️ <b>Торренты не были заблокированы</b>", parse_mode="HTML")
+    elif res.returncode == 0 and torrents_state(res.stdout or "") == "block":
+        # A later toggle in the same batch wins
+        await update.message.reply_text("ℹ️ <b>Разблокировка отменена командой /block_torrents, пришедшей следом</b>", parse_mode="HTML")
+    elif res.returncode == 0:
+        note = batch_note(batch, change)
         await update.message.reply_text(
             "✅ <b>Торренты разблокированы!</b>\n\n"
             "🌐 <b>Весь трафик теперь проходит через VPN</b>\n\n"
+            + (f"{note}\n\n" if note else "") +
             "💡 <i>Для повторной блокировки используйте /block_torrents</i>", 
             parse_mode="HTML"
         )
@@ -501,6 +1728,165 @@ async def cmd_unblock_torrents(update: Update, context: ContextTypes.DEFAULT_TYP
         )
 
 
+ROUTING_SUMMARY_RE = re.compile(r"Routing rules: (\d+)(?: -> (\d+))? \((\d+) compiled from the policy\)")
+ROUTING_TITLES = {"block": "🚫 <b>Блокировка</b>", "unblock": "🌐 <b>Снятие блокировки</b>"}
+ROUTING_DIFF_LIMIT = 3000
+
+
+def routing_summary(output: str) -> str:
+    """The rule counts from the CLI's "Routing rules: ..." line, in Russian."""
+    match = ROUTING_SUMMARY_RE.search(output)
+    if not match:
+        return ""
+    before, after, compiled = match.groups()
+    if after is None:
+        return f"📋 Правил маршрутизации: {before} (из политики: {compiled}), без изменений"
+    return f"📋 Правил маршрутизации: {before} → {after} (из политики: {compiled})"
+
+
+def routing_diff_lines(output: str) -> List[str]:
+    return [line for line in output.splitlines() if line.startswith(("-{", "+{"))]
+
+
+def routing_diff(output: str) -> str:
+    """The "-old/+new rule" lines of a preview, trimmed to fit a message."""
+    diff = "\n".join(routing_diff_lines(output))
+    if len(diff) > ROUTING_DIFF_LIMIT:
+        diff = diff[:ROUTING_DIFF_LIMIT].rsplit("\n", 1)[0] + "\n…"
+    return diff
+
+
+async def routing_preview(update: Update, context: ContextTypes.DEFAULT_TYPE, op: str) -> None:
+    items = context.args
+    title = f"{ROUTING_TITLES[op]}: {html_escape(', '.join(items))}"
+    data = f"routing:{op}:{' '.join(items)}"
+    if len(data.encode()) > 64:
+        await update.message.reply_text(
+            f"{title}\n\n❌ <b>Слишком длинный список для одной команды</b>\n"
+            "💡 <i>Разбейте его на несколько вызовов</i>",
+            parse_mode="HTML"
+        )
+        return
+    await update.message.chat.send_action("typing")
+
+    res = await run_vless(context, [op, *items, "--dry-run"])
+    output = ANSI_RE.sub("", res.stdout or "")
+    if res.returncode != 0:
+        await update.message.reply_text(f"{title}\n\n❌ <b>Ошибка:</b> {output_tail(res)}", parse_mode="HTML")
+        return
+    if "[WARN]" in output:
+        note = "уже заблокировано" if op == "block" else "нет в списке блокировки (торренты снимаются командой /unblock_torrents)"
+        await update.message.reply_text(f"{title}\n\nℹ️ <b>Ничего не изменится:</b> {note}", parse_mode="HTML")
+        return
+
+    diff = routing_diff(output)
+    text = title + "\n\n"
+    if diff:
+        text += f"<pre>{html_escape(diff)}</pre>\n\n"
+    else:
+        text += "ℹ️ <i>Уже покрыто другими записями, Xray не будет перезапущен</i>\n\n"
+    text += routing_summary(output) + "\n\n❓ <b>Применить?</b>"
+    keyboard = InlineKeyboardMarkup([[
+        InlineKeyboardButton("✅ Применить", callback_data=data),
+        InlineKeyboardButton("❌ Отмена", callback_data="routing:cancel"),
+    ]])
+    await update.message.reply_text(text, parse_mode="HTML", reply_markup=keyboard)
+
+
+async def cmd_block(update: Update, context: ContextTypes.DEFAULT_TYPE, settings: Settings) -> None:
+    if not await _guard_admin(update, context, settings):
+        return
+    if context.args:
+        await routing_preview(update, context, "block")
+        return
+
+    # No arguments: the current policy and whether the config matches it
+    res = await run_vless(context, ["routing"])
+    output = ANSI_RE.sub("", res.stdout or "Нет вывода")
+    await update.message.reply_text(
+        "🛡️ <b>Политика маршрутизации</b>\n\n"
+        f"<pre>{html_escape(output[:3500])}</pre>\n\n"
+        "💡 <i>Использование:</i> <code>/block example.com</code>, <code>/block 25 6000-6010</code>, <code>/unblock example.com</code>",
+        parse_mode="HTML"
+    )
+
+
+async def cmd_unblock(update: Update, context: ContextTypes.DEFAULT_TYPE, settings: Settings) -> None:
+    if not await _guard_admin(update, context, settings):
+        return
+    if not context.args:
+        await update.message.reply_text(
+            "❌ <b>Укажите домен или порт</b>\n\n"
+            "💡 <i>Пример:</i> <code>/unblock example.com</code>\n"
+            "📋 <i>Текущая политика:</i> /block",
+            parse_mode="HTML"
+        )
+        return
+    await routing_preview(update, context, "unblock")
+
+
+async def handle_routing_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, settings: Settings) -> None:
+    query = update.callback_query
+    if not query or not query.data:
+        return
+    uid = update.effective_user.id if update.effective_user else None
+    if not is_admin(uid, settings):
+        await query.answer("❌ Доступ запрещен", show_alert=True)
+        return
+    await query.answer()
+
+    if query.data == "routing:cancel":
+        await query.edit_message_text("❌ <b>Изменение отменено</b>", parse_mode="HTML")
+        return
+    _, op, raw = query.data.split(":", 2)
+    if op not in ROUTING_TITLES:
+        return
+    items = raw.split()
+    title = f"{ROUTING_TITLES[op]}: {html_escape(', '.join(items))}"
+    # The preview is still in the message; the diff lines in it are what the admin confirmed
+    shown = routing_diff_lines(query.message.text or "") if query.message else []
+    await query.edit_message_text(f"{title}\n\n🔄 <i>Применяю...</i>", parse_mode="HTML")
+
+    # Someone may have changed the policy since the preview: apply only what was shown
+    check = await run_vless(context, [op, *items, "--dry-run"])
+    check_output = ANSI_RE.sub("", check.stdout or "")
+    if check.returncode != 0 or "[WARN]" in check_output or routing_diff_lines(routing_diff(check_output)) != shown:
+        await query.edit_message_text(
+            f"⚠️ {title}\n\n<b>Правила изменились после предпросмотра, ничего не применено</b>\n"
+            "💡 <i>Повторите команду, чтобы увидеть новый список</i>",
+            parse_mode="HTML"
+        )
+        return
+
+    # Through the change queue, like /add and /del: one config write and at most one restart per batch
+    change = Change(op, items=tuple(items))
+    batch = await queue_change(context, change)
+    res = batch.result
+    output = ANSI_RE.sub("", res.stdout or "")
+    state = routing_state(output, change) if res.returncode == 0 else ""
+    if state == "unchanged":
+        note = "уже заблокировано" if op == "block" else "нет в списке блокировки"
+        await query.edit_message_text(f"{title}\n\nℹ️ <b>Ничего не изменилось:</b> {note}", parse_mode="HTML")
+    elif state:
+        if "Applied: restart" in output:
+            ready_ms = ready_time_ms(res)
+            note = "🔄 <i>Xray перезапущен" + (f" (готов через {ready_ms / 1000:.1f} с)" if ready_ms is not None else "") + "</i>"
+        else:
+            note = "ℹ️ <i>Политика сохранена, правила Xray не изменились</i>"
+        summary = routing_summary(output)
+        others = batch_note(batch, change)
+        await query.edit_message_text(
+            f"✅ {title}\n\n" + (f"{summary}\n" if summary else "") + note + (f"\n\n{others}" if others else ""),
+            parse_mode="HTML"
+        )
+    else:
+        await query.edit_message_text(
+            f"❌ {title}\n\n<pre>{html_escape(output[-3000:] or 'Неизвестная ошибка')}</pre>\n\n"
+            "💡 <i>Попробуйте /doctor для диагностики</i>",
+            parse_mode="HTML"
+        )
+
+
 async def handle_delete_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, settings: Settings) -> None:
     query = update.callback_query
     if not query or not query.data:
@@ -522,44 +1908,205 @@ async def handle_delete_callback(update: Update, context: ContextTypes.DEFAULT_T
             parse_mode="HTML"
         )
         return
+
+    if query.data.startswith("delete_ask:"):
+        # 🗑️ under /find results: ask in a new message, keeping the results
+        client = registry(context).get(query.data.split(":", 1)[1])
+        if client is None:
+            await query.message.reply_text("❌ <b>Клиент не найден</b>\n\n📋 <i>Посмотрите список:</i> /list", parse_mode="HTML")
+            return
+        text, reply_markup = delete_prompt(f"delete_confirm:{client.id}", client.name)
+        await query.message.reply_text(text, parse_mode="HTML", reply_markup=reply_markup)
+        return
     
-    if query.data.startswith("delete_confirm:"):
+    if query.data.startswith(("delete_confirm:", "delete_remote:")):
         # User confirmed deletion
-        key = query.data.split(":", 1)[1]
+        kind, _, key = query.data.partition(":")
+        if kind == "delete_remote":
+            key = context.bot_data["delete_keys"].pop(key, None)
+            if key is None:
+                # The bot restarted or the prompt is too old
+                await query.edit_message_text("⌛ <b>Подтверждение устарело</b>\n\n💡 <i>Повторите команду /del</i>", parse_mode="HTML")
+                return
+        try:
+            key, nodes = split_target(context, key)
+        except KeyError as exc:
+            await query.edit_message_text(f"❌ <b>Неизвестный узел:</b> {html_escape(exc.args[0])}", parse_mode="HTML")
+            return
+        if not is_local_only(context, nodes):
+            title = f"➖ <b>Удаление клиента {html_escape(key)}</b> → {node_list(nodes)}"
+            await fan_out_reply(query.message, context, nodes, ["del", key], title, describe_client_change("удалён"), edit=True)
+            return
+        client = registry(context).get(key)
+        label = client.name if client is not None else key
         
         # Show processing message
         await query.edit_message_text(
             f"🔄 <b>Удаление клиента...</b>\n\n"
-            f"👤 {html_escape(key)}",
+            f"👤 {html_escape(label)}",
             parse_mode="HTML"
         )
         
-        # Perform actual deletion
-        res = run_vless(settings, ["del", key])
+        # Perform actual deletion (batched with other pending changes)
+        change = Change(DELETE, key=key)
+        batch = await queue_change(context, change)
+        res = batch.result
+        _, removed, skipped = parse_import_output(res.stdout or "")
         
-        if res.returncode == 0:
+        if res.returncode == 0 and any(key in (c.id, c.email) for c in removed):
+            await limits(context).forget([c.id for c in removed if key in (c.id, c.email)])
+            notes = [apply_note(res), batch_note(batch, change)]
             await query.edit_message_text(
                 f"✅ <b>Клиент удалён</b>\n\n"
-                f"👤 {html_escape(key)}\n\n"
-                f"🔄 <i>Не забудьте перезапустить сервис:</i> /restart",
+                f"👤 {html_escape(label)}\n\n"
+                + "\n".join(n for n in notes if n),
                 parse_mode="HTML"
             )
         else:
+            error_msg = "Клиент не найден" if res.returncode == 0 else (res.stdout or "Неизвестная ошибка")
             await query.edit_message_text(
                 f"❌ <b>Ошибка удаления:</b>\n"
-                f"<code>{html_escape(res.stdout or 'Клиент не найден')}</code>\n\n"
+                f"<code>{html_escape(error_msg)}</code>\n\n"
                 f"📋 <i>Посмотрите список:</i> /list",
                 parse_mode="HTML"
             )
 
 
-def sanitize_name(value: str) -> str:
-    value = re.sub(r"[^A-Za-z0-9._-]+", "_", value or "")[:50]
-    return value or "vpn_profile"
+async def start_background_tasks(app: Application) -> None:
+    poller: Optional[StatsPoller] = app.bot_data.get("stats_poller")
+    if poller is not None:
+        poller.start()
+    server: Optional[SubscriptionServer] = app.bot_data.get("sub_server")
+    if server is not None:
+        await server.start()
+    metrics_server: Optional[MetricsServer] = app.bot_data.get("metrics_server")
+    if metrics_server is not None:
+        await metrics_server.start()
+    follower: Optional[AccessLogFollower] = app.bot_data.get("access")
+    if follower is not None:
+        follower.start()
+    app.bot_data["limits"].start()
+
+
+async def stop_background_tasks(app: Application) -> None:
+    poller: Optional[StatsPoller] = app.bot_data.get("stats_poller")
+    if poller is not None:
+        await poller.stop()
+    server: Optional[SubscriptionServer] = app.bot_data.get("sub_server")
+    if server is not None:
+        await server.stop()
+    metrics_server: Optional[MetricsServer] = app.bot_data.get("metrics_server")
+    if metrics_server is not None:
+        await metrics_server.stop()
+    follower: Optional[AccessLogFollower] = app.bot_data.get("access")
+    if follower is not None:
+        await follower.stop()
+    await app.bot_data["limits"].stop()
+    await app.bot_data["fleet"].close()
+    # SQLite files last: the tasks above may still write to them while stopping
+    traffic: Optional[TrafficStats] = app.bot_data.get("traffic")
+    if traffic is not None:
+        traffic.close()
+    app.bot_data["file_ids"].close()
 
 
 def build_app(settings: Settings) -> Application:
-    app = Application.builder().token(settings.token).build()
+    # concurrent_updates lets a slow handler (restart, doctor) run alongside others;
+    # the executor bounds how many vless processes actually run at once
+    metrics = Metrics()
+    builder = (
+        Application.builder()
+        .token(settings.token)
+        # Same pool size as the builder's default request, plus per-method timings
+        .request(TimedRequest(metrics, connection_pool_size=256))
+        .concurrent_updates(settings.concurrent_updates)
+        # Per-chat and global token buckets, RetryAfter handling and merging of queued short texts
+        .rate_limiter(FlowControl(settings.send_rate, settings.chat_rate, observer=metrics.observe_send))
+        .post_init(start_background_tasks)
+        .post_shutdown(stop_background_tasks)
+    )
+    if settings.api_url:
+        # A local Bot API server (or a test double) instead of api.telegram.org
+        builder = builder.base_url(settings.api_url.rstrip("/") + "/bot")
+    app = builder.build()
+    app.bot_data["metrics"] = metrics
+    app.bot_data["executor"] = VlessExecutor(
+        settings.vless_path,
+        max_concurrency=settings.exec_concurrency,
+        default_timeout=settings.exec_timeout,
+        observer=metrics.observe_vless,
+    )
+    app.bot_data["executor"].reads.observer = metrics.shared
+    # Identical reads in flight (a stale params refresh, a QR render) are done once
+    app.bot_data["flights"] = SingleFlight("bot", metrics.shared)
+    app.bot_data["registry"] = ClientRegistry(settings.config_path, settings.confdir)
+    app.bot_data["search"] = ClientIndex(app.bot_data["registry"])
+    app.bot_data["delete_keys"] = {}
+    # Remote servers reached over pooled SSH connections; this one runs through the executor
+    app.bot_data["fleet"] = Fleet(
+        NodeRegistry(settings.fleet_file),
+        default_transport(os.path.join(settings.state_dir, "ssh"), connect_timeout=settings.ssh_connect_timeout),
+        app.bot_data["executor"].run,
+        app.bot_data["executor"].timeout_for,
+        local_name=settings.node_name,
+        max_parallel=settings.fleet_parallel,
+    )
+    app.bot_data["fleet"].reads.observer = metrics.shared
+    app.bot_data["changes"] = ChangeQueue(app.bot_data["executor"].run, window=settings.batch_window)
+    app.bot_data["params"] = ParamsSnapshot(
+        settings.config_path,
+        os.path.join(settings.state_dir, "params.json"),
+        ip_ttl=settings.params_ttl,
+        confdir=settings.confdir,
+    )
+    app.bot_data["qr_cache"] = QrCache(settings.qr_cache_bytes, spill_dir=settings.qr_spill_dir)
+    app.bot_data["file_ids"] = FileIdCache(os.path.join(settings.state_dir, "telegram_file_ids.sqlite3"))
+    checks = default_checks(
+        settings.config_path,
+        settings.api_server,
+        restart_log=os.path.join(settings.state_dir, "restart.log"),
+        confdir=settings.confdir,
+    )
+    if settings.access_log != OFF:
+        # Connection counters from the access log (or the journal), resumed from a checkpoint
+        follower = AccessLogFollower(
+            AccessAnalyzer(),
+            access_source_resolver(settings.access_log, settings.config_path, settings.confdir),
+            os.path.join(settings.state_dir, "access_log.json"),
+        )
+        app.bot_data["access"] = follower
+        checks.append(access_check(follower, settings.auth_flood))
+    app.bot_data["diagnostics"] = Diagnostics(checks, ttl=settings.doctor_ttl)
+    if settings.stats_interval > 0:
+        traffic = TrafficStats(
+            os.path.join(settings.state_dir, "traffic.sqlite3"),
+            ring_slots=max(2, round(STATS_RATE_WINDOW / settings.stats_interval)),
+            rollup_seconds=settings.stats_rollup,
+        )
+        app.bot_data["traffic"] = traffic
+        app.bot_data["stats_poller"] = StatsPoller(XrayStatsSource(settings.api_server), traffic, interval=settings.stats_interval)
+    # Expiry times and traffic quotas: one deadline heap, due clients removed in one batch
+    scheduler = LimitScheduler(
+        LimitStore(settings.limits_file),
+        lambda due: remove_expired_clients(app, due),
+        lambda done: notify_expired(app, settings, done),
+        window=settings.expiry_window,
+    )
+    if "traffic" in app.bot_data:
+        scheduler.usage = lambda email: traffic_total(traffic, email)
+        app.bot_data["stats_poller"].on_sample = lambda sample: scheduler.check_sample(sample.keys())
+    scheduler.load()
+    app.bot_data["limits"] = scheduler
+    if settings.sub_port > 0:
+        # Subscription endpoint on the bot's event loop, answering from precomputed bodies
+        store = SubscriptionStore(
+            app.bot_data["registry"],
+            app.bot_data["params"],
+            load_secret(os.path.join(settings.state_dir, "subscription.key"), settings.sub_secret),
+        )
+        app.bot_data["subscriptions"] = store
+        app.bot_data["sub_server"] = SubscriptionServer(store, settings.sub_host, settings.sub_port)
+        app.bot_data["sub_url"] = settings.sub_url
 
     # Bind partial handlers with settings via lambdas
     app.add_handler(CommandHandler("start", lambda u, c: cmd_start(u, c, settings)))
@@ -567,21 +2114,48 @@ def build_app(settings: Settings) -> Application:
     app.add_handler(CommandHandler("add", lambda u, c: cmd_add(u, c, settings)))
     app.add_handler(CommandHandler("list", lambda u, c: cmd_list(u, c, settings)))
     app.add_handler(CommandHandler("show", lambda u, c: cmd_show(u, c, settings)))
+    app.add_handler(CommandHandler("find", lambda u, c: cmd_find(u, c, settings)))
     app.add_handler(CommandHandler("del", lambda u, c: cmd_del(u, c, settings)))
+    app.add_handler(CommandHandler("import", lambda u, c: cmd_import(u, c, settings)))
+    # Documents uploaded with "/import" as the caption (CommandHandler only looks at message text)
+    app.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/import(@\w+)?(\s|$)"), lambda u, c: cmd_import(u, c, settings)))
     app.add_handler(CommandHandler("restart", lambda u, c: cmd_restart(u, c, settings)))
     app.add_handler(CommandHandler("fix", lambda u, c: cmd_fix(u, c, settings)))
     app.add_handler(CommandHandler("block_torrents", lambda u, c: cmd_block_torrents(u, c, settings)))
     app.add_handler(CommandHandler("unblock_torrents", lambda u, c: cmd_unblock_torrents(u, c, settings)))
+    app.add_handler(CommandHandler("block", lambda u, c: cmd_block(u, c, settings)))
+    app.add_handler(CommandHandler("unblock", lambda u, c: cmd_unblock(u, c, settings)))
     app.add_handler(CommandHandler("doctor", lambda u, c: cmd_doctor(u, c, settings)))
+    app.add_handler(CommandHandler("stats", lambda u, c: cmd_stats(u, c, settings)))
+    app.add_handler(CommandHandler("connections", lambda u, c: cmd_connections(u, c, settings)))
+    app.add_handler(CommandHandler("expire", lambda u, c: cmd_expire(u, c, settings)))
+    app.add_handler(CommandHandler("quota", lambda u, c: cmd_quota(u, c, settings)))
+    app.add_handler(CommandHandler("nodes", lambda u, c: cmd_nodes(u, c, settings)))
     
-    # Add callback query handler for delete confirmation
-    app.add_handler(CallbackQueryHandler(lambda u, c: handle_delete_callback(u, c, settings)))
+    # Callback query handlers: delete confirmation, list pagination, client details (also from /find), doctor
+    app.add_handler(CallbackQueryHandler(lambda u, c: handle_delete_callback(u, c, settings), pattern=r"^delete_"))
+    app.add_handler(CallbackQueryHandler(lambda u, c: handle_list_callback(u, c, settings), pattern=r"^list:"))
+    app.add_handler(CallbackQueryHandler(lambda u, c: handle_client_callback(u, c, settings), pattern=r"^client:"))
+    app.add_handler(CallbackQueryHandler(lambda u, c: handle_doctor_callback(u, c, settings), pattern=r"^doctor:"))
+    app.add_handler(CallbackQueryHandler(lambda u, c: handle_routing_callback(u, c, settings), pattern=r"^routing:"))
+
+    # Time every handler and expose the numbers on /metrics
+    instrument_handlers(app, metrics)
+    metrics.gauge("vless_clients", "Clients in the Xray config.", lambda: len(app.bot_data["registry"].clients()))
+    if settings.metrics_port > 0:
+        app.bot_data["metrics_server"] = MetricsServer(metrics, settings.metrics_host, settings.metrics_port)
 
     return app
 
 
 def main() -> None:
     settings = load_settings()
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s", level=logging.WARNING)
+    # httpx logs every request URL at INFO, and Bot API URLs contain the token
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("vless_bot").setLevel(logging.INFO)
+    if settings.trace_log:
+        enable_trace_log()
     # Ensure vless path exists
     if not os.path.exists(settings.vless_path):
         # Try fallback to repo path scripts/vless
@@ -589,7 +2163,17 @@ def main() -> None:
         if os.path.exists(repo_vless):
             settings.vless_path = repo_vless
     app = build_app(settings)
-    app.run_polling(close_loop=False)
+    if settings.mode == "webhook":
+        asyncio.run(run_webhook(
+            app,
+            settings.webhook_url,
+            settings.webhook_listen,
+            settings.webhook_port,
+            secret_token=settings.webhook_secret,
+            max_connections=settings.webhook_max_connections,
+        ))
+    else:
+        app.run_polling(close_loop=False)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,321 @@
+import asyncio
+import heapq
+import json
+import os
+import sqlite3
+import subprocess
+import threading
+import time
+from array import array
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+# Bytes transferred per client email since the previous poll: {email: (uplink, downlink)}
+Sample = Dict[str, Tuple[int, int]]
+StatsSource = Callable[[], Awaitable[Sample]]
+
+
+def parse_statsquery(output: str) -> Sample:
+    """Parse `xray api statsquery` JSON into per-user (uplink, downlink) bytes."""
+    data = json.loads(output or "{}")
+    totals: Dict[str, List[int]] = {}
+    for stat in data.get("stat") or []:
+        # Counter names look like "user>>>alice>>>traffic>>>downlink"; zero values omit "value"
+        parts = str(stat.get("name") or "").split(">>>")
+        if len(parts) != 4 or parts[0] != "user" or parts[2] != "traffic":
+            continue
+        pair = totals.setdefault(parts[1], [0, 0])
+        value = int(stat.get("value") or 0)
+        if parts[3] == "uplink":
+            pair[0] += value
+        elif parts[3] == "downlink":
+            pair[1] += value
+    return {email: (up, down) for email, (up, down) in totals.items()}
+
+
+class XrayStatsSource:
+    """Reads and resets the per-user traffic counters of the running Xray (StatsService).
+
+    Resetting on every read turns the counters into deltas, so nothing is
+    lost or double counted when either Xray or the bot restarts.
+    """
+
+    def __init__(self, server: str = "127.0.0.1:10085", xray_path: str = "xray", timeout: float = 10.0) -> None:
+        self.server = server
+        self.xray_path = xray_path
+        self.timeout = timeout
+
+    async def __call__(self) -> Sample:
+        proc = await asyncio.create_subprocess_exec(
+            self.xray_path, "api", "statsquery", f"--server={self.server}", "-pattern", "user>>>", "-reset",
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        try:
+            out, err = await asyncio.wait_for(proc.communicate(), timeout=self.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            if proc.returncode is None:
+                proc.kill()
+                await asyncio.shield(proc.wait())
+            raise
+        if proc.returncode != 0:
+            message = err.decode("utf-8", errors="replace").strip()
+            raise RuntimeError(message or f"xray api statsquery exited with code {proc.returncode}")
+        return parse_statsquery(out.decode("utf-8", errors="replace"))
+
+
+class TrafficRing:
+    """Fixed number of recent per-client samples kept in flat arrays.
+
+    Every client owns an uplink and a downlink ``array('Q')`` column indexed
+    by slot. Writing a slot subtracts the value it overwrites from running
+    window sums, so a rate is two lookups and never a scan of the samples.
+    """
+
+    def __init__(self, slots: int) -> None:
+        self.slots = max(2, slots)
+        self._starts = array("d", bytes(8 * self.slots))
+        self._ends = array("d", bytes(8 * self.slots))
+        self._head = -1
+        self._filled = 0
+        self._up: Dict[str, array] = {}
+        self._down: Dict[str, array] = {}
+        self._window: Dict[str, List[int]] = {}
+
+    def append(self, start: float, end: float, sample: Sample) -> None:
+        slot = (self._head + 1) % self.slots
+        self._starts[slot] = start
+        self._ends[slot] = end
+        for email, (up, down) in sample.items():
+            if email not in self._up:
+                self._up[email] = array("Q", bytes(8 * self.slots))
+                self._down[email] = array("Q", bytes(8 * self.slots))
+                self._window[email] = [0, 0]
+        idle = []
+        for email, window in self._window.items():
+            up, down = sample.get(email, (0, 0))
+            up_col, down_col = self._up[email], self._down[email]
+            window[0] += up - up_col[slot]
+            window[1] += down - down_col[slot]
+            up_col[slot] = up
+            down_col[slot] = down
+            if window[0] == 0 and window[1] == 0:
+                idle.append(email)
+        # Clients with no traffic anywhere in the window cost no memory
+        for email in idle:
+            del self._up[email], self._down[email], self._window[email]
+        self._head = slot
+        self._filled = min(self._filled + 1, self.slots)
+
+    def span(self) -> float:
+        """Seconds covered by the samples currently in the ring."""
+        if self._filled == 0:
+            return 0.0
+        oldest = (self._head - self._filled + 1) % self.slots
+        return max(0.0, self._ends[self._head] - self._starts[oldest])
+
+    def rate(self, email: str) -> Tuple[float, float]:
+        """Average (uplink, downlink) bytes per second over the window."""
+        span = self.span()
+        window = self._window.get(email)
+        if not span or window is None:
+            return 0.0, 0.0
+        return window[0] / span, window[1] / span
+
+
+@dataclass
+class ClientTraffic:
+    email: str
+    total_up: int
+    total_down: int
+    rate_up: float = 0.0
+    rate_down: float = 0.0
+
+    @property
+    def total(self) -> int:
+        return self.total_up + self.total_down
+
+
+class TrafficStats:
+    """Per-client traffic: running totals, a recent-sample ring and SQLite rollups.
+
+    Totals are kept in memory and persisted together with the rollups, so
+    top-N queries sort one number per client. Raw samples only live in the
+    ring; the database holds ``rollup_seconds`` buckets for history.
+    """
+
+    def __init__(self, db_path: str, ring_slots: int = 10, rollup_seconds: float = 300.0, retention_days: float = 30.0) -> None:
+        self.rollup_seconds = max(1.0, rollup_seconds)
+        self.retention_days = retention_days
+        self.ring = TrafficRing(ring_slots)
+        self.last_sample_at = 0.0
+        self._totals: Dict[str, List[int]] = {}
+        self._pending: Dict[Tuple[int, str], List[int]] = {}
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        except (OSError, sqlite3.Error):
+            # Unwritable state dir: keep statistics for this process only
+            self._db = sqlite3.connect(":memory:", check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS traffic_rollups ("
+                " bucket INTEGER NOT NULL,"
+                " email TEXT NOT NULL,"
+                " up INTEGER NOT NULL,"
+                " down INTEGER NOT NULL,"
+                " PRIMARY KEY (bucket, email))"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS traffic_totals ("
+                " email TEXT PRIMARY KEY,"
+                " up INTEGER NOT NULL,"
+                " down INTEGER NOT NULL)"
+            )
+            for email, up, down in self._db.execute("SELECT email, up, down FROM traffic_totals"):
+                self._totals[email] = [up, down]
+
+    def record(self, sample: Sample, now: Optional[float] = None) -> None:
+        """Add one poll's deltas; cheap enough to call on the event loop."""
+        now = time.time() if now is None else now
+        if self.last_sample_at:
+            self.ring.append(self.last_sample_at, now, sample)
+        # else: the first read covers everything since Xray last reset its
+        # counters, an unknown period, so it only goes into the totals
+        self.last_sample_at = now
+        bucket = int(now // self.rollup_seconds * self.rollup_seconds)
+        with self._lock:
+            for email, (up, down) in sample.items():
+                if not (up or down):
+                    continue
+                total = self._totals.setdefault(email, [0, 0])
+                total[0] += up
+                total[1] += down
+                pending = self._pending.setdefault((bucket, email), [0, 0])
+                pending[0] += up
+                pending[1] += down
+
+    def flush(self, now: Optional[float] = None) -> None:
+        """Write pending rollups and totals to SQLite (blocking; run in a worker thread)."""
+        now = time.time() if now is None else now
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            totals = {email: list(self._totals[email]) for _, email in pending}
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(
+                    "INSERT INTO traffic_rollups (bucket, email, up, down) VALUES (?, ?, ?, ?)"
+                    " ON CONFLICT (bucket, email) DO UPDATE SET up = up + excluded.up, down = down + excluded.down",
+                    [(bucket, email, up, down) for (bucket, email), (up, down) in pending.items()],
+                )
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO traffic_totals (email, up, down) VALUES (?, ?, ?)",
+                    [(email, up, down) for email, (up, down) in totals.items()],
+                )
+                if self.retention_days > 0:
+                    self._db.execute("DELETE FROM traffic_rollups WHERE bucket < ?", (int(now - self.retention_days * 86400),))
+                self._db.execute("COMMIT")
+            except sqlite3.Error:
+                self._db.execute("ROLLBACK")
+                # Keep the deltas for the next attempt
+                for key, (up, down) in pending.items():
+                    entry = self._pending.setdefault(key, [0, 0])
+                    entry[0] += up
+                    entry[1] += down
+                raise
+
+    def get(self, email: str) -> Optional[ClientTraffic]:
+        with self._lock:
+            total = self._totals.get(email)
+            if total is None:
+                return None
+            up, down = total
+        rate_up, rate_down = self.ring.rate(email)
+        return ClientTraffic(email, up, down, rate_up, rate_down)
+
+    def top(self, n: int = 10) -> List[ClientTraffic]:
+        """The ``n`` clients with the most traffic since statistics began."""
+        with self._lock:
+            best = heapq.nlargest(n, self._totals.items(), key=lambda item: item[1][0] + item[1][1])
+        result = []
+        for email, (up, down) in best:
+            rate_up, rate_down = self.ring.rate(email)
+            result.append(ClientTraffic(email, up, down, rate_up, rate_down))
+        return result
+
+    def history(self, email: str, since: float) -> List[Tuple[int, int, int]]:
+        """(bucket start, uplink, downlink) rollups for one client, oldest first."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT bucket, up, down FROM traffic_rollups WHERE email = ? AND bucket >= ? ORDER BY bucket",
+                (email, int(since)),
+            ).fetchall()
+            # Include the deltas that are not flushed yet
+            merged: Dict[int, List[int]] = {bucket: [up, down] for bucket, up, down in rows}
+            for (bucket, pending_email), (up, down) in self._pending.items():
+                if pending_email == email and bucket >= since:
+                    entry = merged.setdefault(bucket, [0, 0])
+                    entry[0] += up
+                    entry[1] += down
+        return [(bucket, up, down) for bucket, (up, down) in sorted(merged.items())]
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+class StatsPoller:
+    """Background task that samples ``source`` every ``interval`` seconds into ``stats``."""
+
+    def __init__(self, source: StatsSource, stats: TrafficStats, interval: float = 60.0) -> None:
+        self.source = source
+        self.stats = stats
+        self.interval = max(1.0, interval)
+        self.last_error = ""
+        # Called with each recorded sample, e.g. to check traffic quotas
+        self.on_sample: Optional[Callable[[Sample], None]] = None
+        self._last_flush = time.time()
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await asyncio.to_thread(self.stats.flush)
+
+    async def poll_once(self) -> None:
+        try:
+            sample = await self.source()
+        except Exception as exc:
+            self.last_error = str(exc) or exc.__class__.__name__
+            return
+        self.last_error = ""
+        now = time.time()
+        self.stats.record(sample, now)
+        if self.on_sample is not None:
+            self.on_sample(sample)
+        if now - self._last_flush >= self.stats.rollup_seconds:
+            self._last_flush = now
+            try:
+                await asyncio.to_thread(self.stats.flush, now)
+            except sqlite3.Error as exc:
+                self.last_error = f"SQLite: {exc}"
+
+    async def _run(self) -> None:
+        while True:
+            await self.poll_once()
+            await asyncio.sleep(self.interval)
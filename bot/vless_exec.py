@@ -0,0 +1,107 @@
+import asyncio
+import subprocess
+import time
+from typing import Callable, Dict, List, Optional
+
+from single_flight import SingleFlight
+
+# Commands that rewrite config.json or restart Xray; they run one at a time
+MUTATING_COMMANDS = {"add", "del", "import", "restart", "fix", "block-torrents", "unblock-torrents", "block", "unblock", "enable-api", "access-log"}
+
+# Per-command timeouts in seconds; everything else uses the executor default
+COMMAND_TIMEOUTS: Dict[str, float] = {
+    "list": 20.0,
+    "show": 30.0,
+    # add/del fall back to a restart when the Xray API is unavailable
+    "add": 90.0,
+    "del": 90.0,
+    "import": 300.0,
+    "export": 60.0,
+    "restart": 60.0,
+    "fix": 90.0,
+    "block-torrents": 90.0,
+    "unblock-torrents": 90.0,
+    "block": 90.0,
+    "unblock": 90.0,
+    "routing": 20.0,
+    "enable-api": 90.0,
+    "access-log": 90.0,
+    "doctor": 60.0,
+}
+
+TIMEOUT_EXIT_CODE = 124
+
+# Called after every process with (command, seconds queued, seconds running, exit code)
+Observer = Callable[[str, float, float, int], None]
+
+
+class VlessExecutor:
+    """Runs the vless CLI without blocking the event loop.
+
+    At most ``max_concurrency`` processes run at once. Mutating commands
+    additionally go through a single lane so that concurrent admins never
+    interleave writes to config.json; read-only commands stay parallel, and
+    an identical one already running is joined instead of started again.
+    """
+
+    def __init__(self, vless_path: str, max_concurrency: int = 4, default_timeout: float = 60.0, observer: Optional[Observer] = None) -> None:
+        self.vless_path = vless_path
+        self.default_timeout = default_timeout
+        self.observer = observer
+        self._pool = asyncio.Semaphore(max(1, max_concurrency))
+        self._write_lane = asyncio.Lock()
+        self.reads = SingleFlight("vless")
+
+    def timeout_for(self, args: List[str]) -> float:
+        if args and args[0] in COMMAND_TIMEOUTS:
+            return COMMAND_TIMEOUTS[args[0]]
+        return self.default_timeout
+
+    async def run(self, args: List[str], timeout: Optional[float] = None) -> subprocess.CompletedProcess:
+        if timeout is None:
+            timeout = self.timeout_for(args)
+        queued = time.monotonic()
+        if args and args[0] in MUTATING_COMMANDS:
+            async with self._write_lane:
+                return await self._run_pooled(args, timeout, queued)
+        return await self.reads.do((tuple(args), timeout), lambda: self._run_pooled(args, timeout, queued))
+
+    async def _run_pooled(self, args: List[str], timeout: float, queued: float) -> subprocess.CompletedProcess:
+        async with self._pool:
+            started = time.monotonic()
+            res = await self._spawn(args, timeout)
+            if self.observer is not None:
+                self.observer(args[0] if args else "", started - queued, time.monotonic() - started, res.returncode)
+            return res
+
+    async def _spawn(self, args: List[str], timeout: float) -> subprocess.CompletedProcess:
+        # Use a strict command invocation; no shell injection
+        cmd = [self.vless_path] + args
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        try:
+            out, _ = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+        except asyncio.TimeoutError:
+            await _kill(proc)
+            return subprocess.CompletedProcess(
+                cmd, TIMEOUT_EXIT_CODE, stdout=f"Command timed out after {timeout:g}s: vless {' '.join(args)}"
+            )
+        except asyncio.CancelledError:
+            await _kill(proc)
+            raise
+        return subprocess.CompletedProcess(cmd, proc.returncode, stdout=out.decode("utf-8", errors="replace"))
+
+
+async def _kill(proc: asyncio.subprocess.Process) -> None:
+    if proc.returncode is not None:
+        return
+    try:
+        proc.kill()
+    except ProcessLookupError:
+        return
+    # Reap the child so it does not linger as a zombie
+    await asyncio.shield(proc.wait())
@@ -0,0 +1,101 @@
+import asyncio
+import hmac
+import logging
+import secrets
+import signal
+from typing import Optional
+from urllib.parse import urlsplit
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+
+log = logging.getLogger("vless_bot")
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+# Telegram only connects to these ports for webhooks
+WEBHOOK_PORTS = (443, 80, 88, 8443)
+
+
+def new_secret() -> str:
+    # 43 characters from [A-Za-z0-9_-], the alphabet Telegram allows for secret_token
+    return secrets.token_urlsafe(32)
+
+
+class WebhookServer:
+    """Receives updates from Telegram over HTTP and queues them for the application.
+
+    Requests without the secret token header registered with setWebhook are
+    rejected before the body is parsed; accepted updates are acknowledged at
+    once and handled with the application's usual update concurrency.
+    """
+
+    def __init__(self, app: Application, host: str, port: int, path: str, secret_token: str) -> None:
+        self.app = app
+        self.host = host
+        self.port = port
+        self.path = path or "/"
+        self.secret_token = secret_token.encode("ascii")
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self) -> None:
+        server = web.Application()
+        server.router.add_post(self.path, self.handle)
+        self._runner = web.AppRunner(server, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        header = request.headers.get(SECRET_HEADER, "").encode("ascii", errors="replace")
+        if not hmac.compare_digest(header, self.secret_token):
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), self.app.bot)
+        except (ValueError, TypeError, KeyError):
+            return web.Response(status=400)
+        if update is None:
+            return web.Response(status=400)
+        await self.app.update_queue.put(update)
+        return web.Response()
+
+
+async def run_webhook(app: Application, url: str, host: str, port: int, secret_token: str = "", max_connections: int = 40) -> None:
+    """Run ``app`` on a webhook until SIGINT or SIGTERM, in place of ``app.run_polling()``.
+
+    The local server listens on ``host:port`` at the path of ``url``; a TLS
+    reverse proxy is expected to forward ``url`` to it. Without a configured
+    secret a new one is registered on every start.
+    """
+    secret = secret_token or new_secret()
+    server = WebhookServer(app, host, port, urlsplit(url).path, secret)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    # Same lifecycle and hooks as Application.run_polling
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    try:
+        await server.start()
+        # Registered after the server is up so Telegram's first delivery finds it
+        await app.bot.set_webhook(url, secret_token=secret, max_connections=max_connections)
+        log.info("Webhook mode: %s -> http://%s:%d%s", url, host, port, server.path)
+        await stop.wait()
+    finally:
+        await server.stop()
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
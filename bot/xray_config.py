@@ -0,0 +1,75 @@
+import json
+import os
+from typing import Iterable, List
+
+
+def config_files(config_path: str, confdir: str = "") -> List[str]:
+    """Files Xray loads: the *.json fragments of ``confdir`` in name order, or config.json.
+
+    Same rule as load_layout in the vless CLI: a confdir holding at least one
+    fragment replaces the single file.
+    """
+    if confdir:
+        try:
+            names = sorted(
+                entry.name
+                for entry in os.scandir(confdir)
+                if entry.name.endswith(".json") and not entry.name.startswith(".") and entry.is_file()
+            )
+        except OSError:
+            names = []
+        if names:
+            return [os.path.join(confdir, name) for name in names]
+    return [config_path]
+
+
+def file_signature(path: str) -> str:
+    # Same format as `stat -c '%Y:%i:%s'` in the vless CLI
+    try:
+        st = os.stat(path)
+    except OSError:
+        return ""
+    return f"{int(st.st_mtime)}:{st.st_ino}:{st.st_size}"
+
+
+def config_signature(config_path: str, confdir: str = "") -> str:
+    """Comma-separated file signatures of every config file, as the CLI writes them."""
+    return ",".join(filter(None, (file_signature(path) for path in config_files(config_path, confdir))))
+
+
+def merge_config(fragments: Iterable[dict]) -> dict:
+    """Fold config fragments in load order the way `xray run -confdir` does.
+
+    Inbounds and outbounds whose tag was already seen replace the earlier
+    entry, others are appended; any other top-level key comes from the
+    last fragment that sets it.
+    """
+    merged: dict = {}
+    for fragment in fragments:
+        for key, value in fragment.items():
+            if key in ("inbounds", "outbounds"):
+                merged[key] = _merge_tagged(merged.get(key) or [], value or [])
+            else:
+                merged[key] = value
+    return merged
+
+
+def _merge_tagged(current: List[dict], more: List[dict]) -> List[dict]:
+    result = list(current)
+    for item in more:
+        tag = item.get("tag") or ""
+        index = next((i for i, seen in enumerate(result) if tag and seen.get("tag") == tag), None)
+        if index is None:
+            result.append(item)
+        else:
+            result[index] = item
+    return result
+
+
+def load_config(files: List[str]) -> dict:
+    """Read and merge the given config files (raises OSError or ValueError)."""
+    fragments = []
+    for path in files:
+        with open(path, "r", encoding="utf-8") as f:
+            fragments.append(json.load(f))
+    return merge_config(fragments)
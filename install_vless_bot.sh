@@ -57,6 +57,8 @@ require_root
 
 BOT_DST_DIR="/opt/vless-bot"
 ENV_DST="/etc/vless-bot.env"
+# Python modules that make up the bot (installed next to telegram_bot.py)
+BOT_MODULES=(telegram_bot.py vless_exec.py client_registry.py reality_params.py qr_cache.py file_id_cache.py change_queue.py traffic_stats.py diagnostics.py xray_config.py subscription.py metrics.py webhook.py fleet.py access_log.py client_limits.py single_flight.py flow_control.py client_search.py)
 SERVICE_DST="/etc/systemd/system/vless-bot.service"
 
 info "Installing dependencies"
@@ -76,7 +78,9 @@ cleanup(){ rm -rf "$tmpdir"; }
 trap cleanup EXIT
 
 info "Downloading files from $RAW_BASE"
-curl -fsSL "$RAW_BASE/bot/telegram_bot.py" -o "$tmpdir/telegram_bot.py"
+for module in "${BOT_MODULES[@]}"; do
+  curl -fsSL "$RAW_BASE/bot/$module" -o "$tmpdir/$module"
+done
 curl -fsSL "$RAW_BASE/bot/requirements.txt" -o "$tmpdir/requirements.txt"
 curl -fsSL "$RAW_BASE/bot/scripts/vless" -o "$tmpdir/vless"
 
@@ -85,7 +89,9 @@ info "Installed/updated CLI: /usr/local/bin/vless"
 
 mkdir -p "$BOT_DST_DIR"
 install -m 644 "$tmpdir/requirements.txt" "$BOT_DST_DIR/requirements.txt"
-install -m 644 "$tmpdir/telegram_bot.py" "$BOT_DST_DIR/telegram_bot.py"
+for module in "${BOT_MODULES[@]}"; do
+  install -m 644 "$tmpdir/$module" "$BOT_DST_DIR/$module"
+done
 chown -R root:root "$BOT_DST_DIR"
 
 if [[ ! -d "$BOT_DST_DIR/.venv" ]]; then
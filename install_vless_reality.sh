@@ -15,6 +15,8 @@
 # 
 # Использование:
 # bash <(curl -s https://raw.githubusercontent.com/vladkolchik/vless-reality-installer/refs/heads/main/install_vless_reality.sh)
+# С ключом --confdir конфигурация раскладывается на фрагменты в /usr/local/etc/xray/conf.d
+# (xray run -confdir), и добавление клиента переписывает только файлы со списками клиентов
 
 set -e
 
@@ -26,6 +28,11 @@ BLUE='\033[0;34m'
 PURPLE='\033[0;35m'
 NC='\033[0m' # No Color
 
+# Раскладка конфигурации: один config.json или фрагменты для `xray run -confdir` (--confdir)
+USE_CONFDIR=false
+XRAY_CONFDIR="/usr/local/etc/xray/conf.d"
+XRAY_CONFIG_ARGS=(-c /usr/local/etc/xray/config.json)
+
 # Функция для вывода цветного текста
 print_status() {
     echo -e "${GREEN}[INFO]${NC} $1"
@@ -270,8 +277,25 @@ create_xray_config() {
     "log": {
         "loglevel": "warning"
     },
+    "api": {
+        "tag": "api",
+        "services": [
+            "HandlerService",
+            "StatsService"
+        ]
+    },
+    "stats": {},
+    "policy": {
+        "levels": {
+            "0": {
+                "statsUserUplink": true,
+                "statsUserDownlink": true
+            }
+        }
+    },
     "inbounds": [
         {
+            "tag": "vless-443",
             "port": 443, 
             "protocol": "vless",
             "settings": {
@@ -310,6 +334,7 @@ create_xray_config() {
             }
         },
             {
+                "tag": "vless-80",
                 "port": 80,
                 "protocol": "vless",
                 "settings": {
@@ -346,14 +371,34 @@ create_xray_config() {
                         "tls"
                     ]
                 }
+            },
+        {
+            "tag": "api",
+            "listen": "127.0.0.1",
+            "port": 10085,
+            "protocol": "dokodemo-door",
+            "settings": {
+                "address": "127.0.0.1"
             }
+        }
     ],
     "outbounds": [
         {
             "protocol": "freedom",
             "tag": "direct"
         }
-    ]
+    ],
+    "routing": {
+        "rules": [
+            {
+                "type": "field",
+                "inboundTag": [
+                    "api"
+                ],
+                "outboundTag": "api"
+            }
+        ]
+    }
 }
 EOF
     
@@ -410,6 +455,69 @@ fix_xray_systemd_service() {
 
 
 
+# Функция разбиения конфигурации на фрагменты (--confdir).
+# Имена и содержимое фрагментов совпадают с `vless migrate-confdir`.
+split_xray_config() {
+    print_step "Разбиение конфигурации X-ray на фрагменты в $XRAY_CONFDIR..."
+
+    # Сначала проверяем исходный config.json целиком
+    validate_xray_config
+
+    local tmp_dir
+    tmp_dir=$(mktemp -d)
+    python3 - /usr/local/etc/xray/config.json "$tmp_dir" << 'PYEOF'
+import json
+import sys
+
+with open(sys.argv[1], "r", encoding="utf-8") as f:
+    config = json.load(f)
+out = sys.argv[2]
+
+
+def write(name, data):
+    with open(f"{out}/{name}", "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+        f.write("\n")
+
+
+inbounds = config.get("inbounds") or []
+base = {k: v for k, v in config.items() if k not in ("inbounds", "outbounds", "routing")}
+other = [i for i in inbounds if i.get("protocol") != "vless"]
+if other:
+    base["inbounds"] = other
+write("00_base.json", base)
+for inbound in inbounds:
+    if inbound.get("protocol") == "vless":
+        inbound.setdefault("tag", f"vless-{inbound['port']}")
+        write(f"10_vless_{inbound['port']}.json", {"inbounds": [inbound]})
+write("20_routing.json", {k: config[k] for k in ("outbounds", "routing") if k in config})
+PYEOF
+
+    if ! /usr/local/bin/xray -test -confdir "$tmp_dir" > /dev/null 2>&1; then
+        print_error "Фрагменты не прошли проверку xray -test, оставляем единый config.json"
+        rm -rf "$tmp_dir"
+        return 0
+    fi
+
+    mkdir -p "$XRAY_CONFDIR"
+    chmod 755 "$XRAY_CONFDIR"
+    chmod 644 "$tmp_dir"/*.json
+    mv "$tmp_dir"/*.json "$XRAY_CONFDIR/"
+    rm -rf "$tmp_dir"
+    mv /usr/local/etc/xray/config.json /usr/local/etc/xray/config.json.pre-confdir
+
+    # Запускаем X-ray с каталогом фрагментов вместо config.json
+    mkdir -p /etc/systemd/system/xray.service.d
+    cat > /etc/systemd/system/xray.service.d/99-vless-confdir.conf << EOF
+[Service]
+ExecStart=
+ExecStart=/usr/local/bin/xray run -confdir $XRAY_CONFDIR
+EOF
+    systemctl daemon-reload
+    XRAY_CONFIG_ARGS=(-confdir "$XRAY_CONFDIR")
+    print_status "Конфигурация разложена на фрагменты: $(ls "$XRAY_CONFDIR" | tr '\n' ' ')"
+}
+
 # Функция настройки firewall
 setup_firewall() {
     print_step "Настройка firewall..."
@@ -618,7 +726,14 @@ start_xray() {
     print_step "Запуск X-ray сервиса..."
     
     # Сначала валидируем конфигурацию
-    validate_xray_config
+    if [[ "$USE_CONFDIR" == true && -d "$XRAY_CONFDIR" ]]; then
+        if ! /usr/local/bin/xray -test -confdir "$XRAY_CONFDIR"; then
+            print_error "Ошибка в конфигурации X-ray ($XRAY_CONFDIR)!"
+            exit 1
+        fi
+    else
+        validate_xray_config
+    fi
     
     systemctl enable xray
     systemctl restart xray
@@ -651,7 +766,7 @@ start_xray() {
             echo ""
             
             echo "=== Configuration Test ==="
-            /usr/local/bin/xray -test -c /usr/local/etc/xray/config.json || true
+            /usr/local/bin/xray -test "${XRAY_CONFIG_ARGS[@]}" || true
             echo ""
             
             echo "=== Reality Keys Check ==="
@@ -686,7 +801,7 @@ start_xray() {
         print_error ""
         print_error "Быстрая диагностика:"
         print_error "1. Проверьте логи: journalctl -u xray -f"
-        print_error "2. Тест конфигурации: /usr/local/bin/xray -test -c /usr/local/etc/xray/config.json"
+        print_error "2. Тест конфигурации: /usr/local/bin/xray -test ${XRAY_CONFIG_ARGS[*]}"
         print_error "3. Проверьте права: ls -la /usr/local/etc/xray/"
         print_error "4. Посмотрите отчет: cat $DIAG_FILE"
         
@@ -833,6 +948,7 @@ uninstall_all() {
 
 	# Ручная очистка Xray (на случай, если remove не сработал)
 	rm -f /etc/systemd/system/xray.service /etc/systemd/system/xray@.service 2>/dev/null || true
+	rm -f /etc/systemd/system/xray.service.d/99-vless-confdir.conf 2>/dev/null || true
 	rm -rf /usr/local/etc/xray 2>/dev/null || true
 	rm -f /usr/local/bin/xray 2>/dev/null || true
 	systemctl daemon-reload || true
@@ -914,6 +1030,7 @@ bash -c "$(curl -L https://github.com/XTLS/Xray-install/raw/main/install-release
 
 # Manual cleanup
 rm -f /etc/systemd/system/xray.service /etc/systemd/system/xray@.service 2>/dev/null || true
+rm -f /etc/systemd/system/xray.service.d/99-vless-confdir.conf 2>/dev/null || true
 rm -rf /usr/local/etc/xray 2>/dev/null || true
 rm -f /usr/local/bin/xray 2>/dev/null || true
 systemctl daemon-reload || true
@@ -1041,6 +1158,13 @@ main() {
         return
     fi
 
+    local arg
+    for arg in "$@"; do
+        if [[ "$arg" == "--confdir" ]]; then
+            USE_CONFDIR=true
+        fi
+    done
+
     print_step "Начинаем установку VLESS+Reality VPN..."
     
     # Выполнение всех этапов
@@ -1052,6 +1176,9 @@ main() {
     generate_reality_keys
     create_xray_config
     fix_xray_systemd_service
+    if [[ "$USE_CONFDIR" == true ]]; then
+        split_xray_config
+    fi
     setup_firewall
 	install_fail2ban
 	install_sudo_and_privilege_tools